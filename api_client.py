@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+API_URL = os.getenv("API_URL", "http://127.0.0.1:8000")
+REQUEST_TIMEOUT = float(os.getenv("API_TIMEOUT_SECONDS", "60"))
+POOL_SIZE = int(os.getenv("API_POOL_SIZE", "16"))
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+# The API sends a comment every 15 s on an idle stream; a longer silence
+# means a lost connection.
+STREAM_READ_TIMEOUT = float(os.getenv("API_STREAM_READ_TIMEOUT", "60"))
+STREAM_RETRY_SECONDS = 5
+
+
+@st.cache_resource
+def get_session():
+    # One keep-alive connection pool shared by every rerun and every session.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_data_version():
+    try:
+        response = get_session().get(f"{API_URL}/api/version", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()["data_version"]
+    except requests.RequestException:
+        return None
+
+
+def _get_json(path):
+    response = get_session().get(f"{API_URL}{path}", timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def _get_json_cached(path, data_version):
+    # data_version is only part of the cache key: a new version on the
+    # server means a new entry, unchanged data is served from the cache.
+    return _get_json(path)
+
+
+def fetch(path, data_version=None):
+    try:
+        if data_version is None:
+            return _get_json(path)
+        return _get_json_cached(path, data_version)
+    except requests.RequestException:
+        return None
+
+
+def _get_frame(path):
+    # Arrow IPC stream straight into a DataFrame; the response fields other
+    # than "data" (stale, next, ...) come back from the schema metadata.
+    response = get_session().get(
+        f"{API_URL}{path}", headers={"Accept": ARROW_MEDIA_TYPE}, timeout=REQUEST_TIMEOUT
+    )
+    response.raise_for_status()
+    table = pa.ipc.open_stream(response.content).read_all()
+    metadata = {
+        key.decode(): json.loads(value)
+        for key, value in (table.schema.metadata or {}).items()
+        if key != b"pandas"
+    }
+    return table.to_pandas(), metadata
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _get_frame_cached(path, data_version):
+    return _get_frame(path)
+
+
+def fetch_frame(path, data_version=None):
+    # Returns (DataFrame, metadata), or None on error.
+    try:
+        if data_version is None:
+            return _get_frame(path)
+        return _get_frame_cached(path, data_version)
+    except requests.RequestException:
+        return None
+
+
+def fetch_many(paths, data_version=None):
+    # Independent calls of a page run concurrently; results keep the order of `paths`.
+    ctx = get_script_run_ctx()
+
+    def run(path):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fetch(path, data_version)
+
+    with ThreadPoolExecutor(max_workers=min(len(paths), POOL_SIZE) or 1) as executor:
+        return list(executor.map(run, paths))
+
+
+def read_events(lines):
+    # Server-Sent Events: (event, data) of each message, comments skipped.
+    event, data = "message", []
+    for line in lines:
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif not line.startswith(":"):
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+
+class LiveKPIs:
+    # One /kpi/stream connection per Streamlit server, shared by every
+    # session: a thread applies the events, pages read the latest values.
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, name="kpi-stream", daemon=True).start()
+
+    def run(self):
+        while True:
+            try:
+                with requests.get(f"{API_URL}/kpi/stream", stream=True,
+                                  timeout=(REQUEST_TIMEOUT, STREAM_READ_TIMEOUT)) as response:
+                    response.raise_for_status()
+                    for event, data in read_events(response.iter_lines(decode_unicode=True)):
+                        self.apply(event, json.loads(data))
+            except requests.RequestException:
+                pass
+            time.sleep(STREAM_RETRY_SECONDS)
+
+    def apply(self, event, payload):
+        with self.lock:
+            if event == "snapshot":
+                self.metrics = payload["metrics"]
+            elif event == "delta":
+                # Changed rows carry their new totals and replace the old ones.
+                for metric, change in payload["changes"].items():
+                    if isinstance(change, dict):
+                        self.metrics[metric] = change
+                    else:
+                        rows = {row["_id"]: row for row in self.metrics.get(metric, [])}
+                        rows.update({row["_id"]: row for row in change})
+                        self.metrics[metric] = list(rows.values())
+
+    def get(self):
+        with self.lock:
+            return dict(self.metrics)
+
+
+@st.cache_resource
+def get_live_kpis():
+    return LiveKPIs()
@@ -1,9 +1,9 @@
 import streamlit as st
-import requests
 import pandas as pd
 import plotly.express as px
-from prophet import Prophet
-from prophet.plot import plot_plotly, plot_components_plotly
+import plotly.graph_objects as go
+from urllib.parse import urlencode
+from api_client import get_data_version, fetch, fetch_frame, fetch_many, get_live_kpis
 
 COLORS = {
     '0': '#87CEFA',
@@ -42,9 +42,56 @@ def plot_elbow_chart(inertia):
     fig.update_traces(mode='lines+markers')
     return fig
 
+def plot_forecast_chart(forecast):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=forecast['ds'], y=forecast['yhat_upper'], mode='lines',
+                             line=dict(width=0), showlegend=False, hoverinfo='skip'))
+    fig.add_trace(go.Scatter(x=forecast['ds'], y=forecast['yhat_lower'], mode='lines',
+                             line=dict(width=0), fill='tonexty', fillcolor='rgba(31, 119, 180, 0.2)',
+                             name='Intervalle'))
+    fig.add_trace(go.Scatter(x=forecast['ds'], y=forecast['yhat'], mode='lines',
+                             line=dict(color='#1f77b4'), name='Prévision'))
+    fig.add_trace(go.Scatter(x=forecast['ds'], y=forecast['y'], mode='markers',
+                             marker=dict(color='#ff7f0e', size=4), name='Ventes'))
+    fig.update_layout(title="Prévisions des ventes", xaxis_title="Date", yaxis_title="Ventes")
+    return fig
+
+def plot_forecast_components(forecast):
+    components = [c for c in ['trend', 'weekly', 'yearly'] if c in forecast.columns]
+    df = forecast.melt(id_vars='ds', value_vars=components, var_name='Composante', value_name='Valeur')
+    fig = px.line(df, x='ds', y='Valeur', facet_row='Composante', title="Composantes de la prévision",
+                  labels={'ds': 'Date'})
+    fig.update_traces(line=dict(color='#1f77b4'))
+    fig.update_yaxes(matches=None)
+    return fig
+
+@st.fragment(run_every=2)
+def show_live_sales():
+    # Reads the values kept current by the /kpi/stream listener, no API call.
+    metrics = get_live_kpis().get()
+    if not metrics:
+        st.info("Connexion au flux en direct...")
+        return
+    col1, col2 = st.columns(2)
+    col1.metric(label="💰 Total des ventes (direct)", value=f"{metrics['total-sales']['total_sales']:.2f} $")
+    col2.metric(label="💹 Total des profits (direct)", value=f"{metrics['total-profit']['total_profit']:.2f} $")
+    df = pd.DataFrame(metrics["sales-by-region"])
+    if not df.empty:
+        fig = px.bar(df.sort_values("total_sales", ascending=False), x="_id", y="total_sales",
+                     title="🌍 Ventes par région (direct)", labels={"_id": "Région", "total_sales": "Ventes"})
+        st.plotly_chart(fig, key="live_sales_by_region")
+
+SALES_METRICS = {
+    "Montant total": "Sales",
+    "Quantité vendue": "Quantity",
+    "Profits": "Profit"
+}
+
 st.set_page_config(page_title="Tableau de bord eCommerce", layout="wide")
 st.title("📊 Tableau de bord eCommerce")
 
+data_version = get_data_version()
+
 page = st.sidebar.selectbox(
     "Sélectionner une page :",
     [
@@ -58,94 +105,96 @@ page = st.sidebar.selectbox(
 if page == "Ventes":
     st.header("📈 Analyse des Ventes")
 
-    response = requests.get("http://127.0.0.1:8000/kpi/total-sales")
-    if response.status_code == 200:
-        data = response.json()["data"]
+    if st.sidebar.toggle("🔴 Mises à jour en direct"):
+        show_live_sales()
+
+    response = fetch("/kpi/bundle?page=ventes", data_version)
+    if response is not None:
+        bundle = response["data"]
+
+        data = bundle["total-sales"]
         st.metric(label="💰 Total des ventes", value=f"{data['total_sales']:.2f} $")
 
-    response = requests.get("http://127.0.0.1:8000/kpi/average-basket")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        avg_basket = data["average_basket"]
+        avg_basket = bundle["average-basket"]["average_basket"]
         st.metric(label="🛒 Panier moyen global", value=f"{avg_basket:.2f} $")
 
-    response = requests.get("http://127.0.0.1:8000/kpi/sales-per-dates")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data)
-        df["_id"] = pd.to_datetime(df["_id"])
-        fig = px.line(df, x="_id", y="total_ventes", title="📈 Croissance des ventes par date")
-        st.plotly_chart(fig)
-
-    response = requests.get("http://127.0.0.1:8000/kpi/sales-by-state")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data).nlargest(10, 'total_sales')
+        date_range = bundle["date-range"]
+        if date_range["first_date"] is not None:
+            first_date = pd.to_datetime(date_range["first_date"]).date()
+            last_date = pd.to_datetime(date_range["last_date"]).date()
+            col1, col2, col3 = st.columns(3)
+            period = col1.date_input(
+                "Période",
+                value=(max(first_date, last_date - pd.Timedelta(days=365)), last_date),
+                min_value=first_date,
+                max_value=last_date
+            )
+            granularity = col2.selectbox("Granularité", ["Jour", "Mois", "Trimestre", "Année"], index=1)
+            metric_label = col3.selectbox("Indicateur", list(SALES_METRICS))
+
+            # Only the selected window is aggregated by the API.
+            if len(period) == 2:
+                query = urlencode({
+                    "start": period[0].isoformat(),
+                    "end": period[1].isoformat(),
+                    "granularity": granularity,
+                    "metric": SALES_METRICS[metric_label]
+                })
+                sales = fetch_frame(f"/kpi/sales?{query}", data_version)
+                if sales is not None:
+                    df = sales[0]
+                    fig = px.line(df, x="_id", y="value", title=f"📈 {metric_label} par période",
+                                  labels={"_id": "Date", "value": metric_label})
+                    st.plotly_chart(fig)
+
+        df = pd.DataFrame(bundle["sales-by-state"]).nlargest(10, 'total_sales')
         fig = px.bar(df, x='total_sales', y='_id', title="🏛️ Top 10 Ventes par État", color='_id',
                      color_discrete_sequence=px.colors.sequential.Bluered)
         st.plotly_chart(fig)
 
-    response = requests.get("http://127.0.0.1:8000/kpi/sales-by-category")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data)
+        df = pd.DataFrame(bundle["sales-by-category"])
         fig = px.pie(df, names="_id", values="total_sales", title="📂 Ventes par catégorie")
         st.plotly_chart(fig, use_container_width=True, key="sales_by_category")
-    else:
-        st.warning("Impossible de récupérer les données pour les ventes par catégorie de produits.")
-
-    st.header("📊 Prévisions des Ventes")
-    response3 = requests.get("http://127.0.0.1:8000/kpi/sales-per-dates")
-    if response3.status_code == 200:
-        forecast_data = response3.json()["data"]
-        df1 = pd.DataFrame(forecast_data)
-        df1 = df1.rename(columns={'_id': 'ds', 'total_ventes': 'y'})
 
+        st.header("📊 Prévisions des Ventes")
+        # The server caches forecasts per data version and may answer with the
+        # previous version while retraining, so this call is not cached here.
         with st.spinner('Calcul des prévisions en cours...'):
-            m = Prophet()
-            m.fit(df1)
-            future = m.make_future_dataframe(periods=365)
-            forecast = m.predict(future)
+            forecast_response = fetch_frame("/api/forecast?periods=365")
 
-            fig1 = plot_plotly(m, forecast)
-            fig2 = plot_components_plotly(m, forecast)
+        if forecast_response is not None:
+            forecast, metadata = forecast_response
+            if metadata["stale"]:
+                st.info("Prévisions en cours de mise à jour, affichage de la version précédente.")
 
-            fig1.update_traces(marker=dict(color='#ff7f0e'))
-            fig2.update_traces(line=dict(color='#1f77b4'))
-
-            st.plotly_chart(fig1)
-            st.plotly_chart(fig2)
+            st.plotly_chart(plot_forecast_chart(forecast))
+            st.plotly_chart(plot_forecast_components(forecast))
+        else:
+            st.error("Erreur lors du chargement des données pour les prévisions")
     else:
-        st.error("Erreur lors du chargement des données pour les prévisions")
+        st.error("Erreur lors de la récupération des données de ventes.")
 
 if page == "Profits":
     st.header("💹 Analyse des Profits")
 
-    response = requests.get("http://127.0.0.1:8000/kpi/total-profit")
-    if response.status_code == 200:
-        data = response.json()["data"]
+    response = fetch("/kpi/bundle?page=profits", data_version)
+    if response is not None:
+        bundle = response["data"]
+
+        data = bundle["total-profit"]
         st.metric(label="💰 Total des profits", value=f"{data['total_profit']:.2f} $")
 
-    response = requests.get("http://127.0.0.1:8000/kpi/profit-by-category")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data)
+        df = pd.DataFrame(bundle["profit-by-category"])
         fig = px.pie(df, names="_id", values="total_profit", title="🏷️ Profit par catégorie")
         st.plotly_chart(fig)
 
-    response = requests.get("http://127.0.0.1:8000/kpi/profit-by-product")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data).nlargest(5, 'total_profit')
-        fig = px.bar(df, x="_id", y="total_profit", title="Top 5 Produits les plus rentables")
-        st.plotly_chart(fig)
-
-    response = requests.get("http://127.0.0.1:8000/kpi/profit-by-product")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data)
+        df = pd.DataFrame(bundle["profit-by-product"])
 
         if not df.empty:
+            top_df = df.nlargest(5, 'total_profit')
+            fig = px.bar(top_df, x="_id", y="total_profit", title="Top 5 Produits les plus rentables")
+            st.plotly_chart(fig)
+
             fig = px.bar(df, x="_id", y="total_profit", title="💹 Profits par produit")
             st.plotly_chart(fig, use_container_width=True, key="profit_by_product")
         else:
@@ -159,9 +208,8 @@ if page == "Clients":
     st.subheader("Méthode du coude")
     max_k = st.slider("Nombre maximal de clusters", min_value=2, max_value=10, value=7)
 
-    elbow_response = requests.get(f"http://localhost:8000/api/elbow?max_k={max_k}")
-    if elbow_response.status_code == 200:
-        elbow_data = elbow_response.json()
+    elbow_data, data = fetch_many([f"/api/elbow?max_k={max_k}", "/api/rfm"], data_version)
+    if elbow_data is not None:
         if "inertia" in elbow_data:
             elbow_chart = plot_elbow_chart(elbow_data["inertia"])
             st.plotly_chart(elbow_chart)
@@ -169,9 +217,7 @@ if page == "Clients":
             st.error("Erreur lors du calcul de la méthode du coude.")
 
     st.subheader("📈 Analyse RFM")
-    response = requests.get("http://localhost:8000/api/rfm")
-    if response.status_code == 200:
-        data = response.json()
+    if data is not None:
 
         st.markdown("### 📊 Moyennes par Cluster")
         col1, col2, col3 = st.columns(3)
@@ -216,17 +262,15 @@ if page == "Clients":
 if page == "Produits":
     st.header("📦 Analyse des Produits")
 
-    response = requests.get("http://127.0.0.1:8000/kpi/sales-by-product")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data).nlargest(5, 'total_sales')
+    response = fetch("/kpi/bundle?page=produits&limit=5", data_version)
+    if response is not None:
+        bundle = response["data"]
+
+        df = pd.DataFrame(bundle["sales-by-product"]).nlargest(5, 'total_sales')
         fig = px.bar(df, x="_id", y="total_sales", title="Top Produits vendus")
         st.plotly_chart(fig)
 
-    response = requests.get("http://127.0.0.1:8000/kpi/top-products-by-quantity?limit=5")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data)
+        df = pd.DataFrame(bundle["top-products-by-quantity"])
         if not df.empty:
             fig = px.bar(
                 df,
@@ -239,13 +283,8 @@ if page == "Produits":
             st.plotly_chart(fig, use_container_width=True, key="top_products_by_quantity")
         else:
             st.warning("Aucune donnée disponible pour les top produits par quantité.")
-    else:
-        st.error("Erreur lors de la récupération des données pour les top produits par quantité.")
 
-    response = requests.get("http://127.0.0.1:8000/kpi/top-categories?limit=5")
-    if response.status_code == 200:
-        data = response.json()["data"]
-        df = pd.DataFrame(data)
+        df = pd.DataFrame(bundle["top-categories"])
 
         if not df.empty:
             fig = px.bar(df, x="_id", y="total_quantity", title="🏷️ Top catégories vendues")
@@ -253,4 +292,4 @@ if page == "Produits":
         else:
             st.warning("Aucune donnée disponible pour les top catégories vendues.")
     else:
-        st.error("Erreur lors de la récupération des données pour les top catégories vendues.")
\ No newline at end of file
+        st.error("Erreur lors de la récupération des données produits.")
\ No newline at end of file
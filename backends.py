@@ -0,0 +1,160 @@
+import os
+import threading
+
+import pandas as pd
+
+from config import ANALYTICS_BACKEND, ARROW_DATA_DIR, ARROW_CACHE_DIR
+from database import get_db, aggregate, find, stream, explain, run_sync
+from materialize import ensure_orders_enriched, rebuild_orders_enriched
+from rollups import ensure_rollups, rebuild_rollups, ensure_customer_rfm, rebuild_customer_rfm
+from sketches import ensure_sketches, rebuild_sketches, build_sketch_documents
+from cube import ensure_cube, rebuild_cube, build_cube, cube_frame
+from versioning import get_data_version, bump_data_version
+from ingest import TABLES, detect_delimiter
+from shared_state import replace_file
+from columnar import run_stages, evaluate
+from pipelines import (
+    get_orders_enriched_pipeline, get_rollup_pipeline, get_rfm_pipeline, get_cube_pipeline,
+    SOURCE_COLLECTIONS, SOURCE_ENRICHED, SOURCE_ROLLUP, CUSTOMER_RFM_COLLECTION, SKETCH_COLLECTION,
+    CUBE_COLLECTION
+)
+
+
+class MongoBackend:
+    name = 'mongo'
+
+    def load(self):
+        db = get_db()
+        ensure_orders_enriched(db)
+        ensure_rollups(db)
+        ensure_customer_rfm(db)
+        ensure_sketches(db)
+        ensure_cube(db)
+
+    def rebuild(self):
+        db = get_db()
+        counts = {
+            SOURCE_COLLECTIONS[SOURCE_ENRICHED]: rebuild_orders_enriched(db),
+            SOURCE_COLLECTIONS[SOURCE_ROLLUP]: rebuild_rollups(db),
+            CUSTOMER_RFM_COLLECTION: rebuild_customer_rfm(db),
+            SKETCH_COLLECTION: rebuild_sketches(db),
+            CUBE_COLLECTION: rebuild_cube(db)
+        }
+        return counts, bump_data_version(db)
+
+    def data_version(self):
+        return get_data_version(get_db())
+
+    def bump_version(self):
+        return bump_data_version(get_db())
+
+    async def aggregate(self, collection, pipeline):
+        return await aggregate(collection, pipeline)
+
+    async def find(self, collection, filter=None):
+        return await find(collection, filter)
+
+    def stream(self, collection, pipeline):
+        return stream(collection, pipeline)
+
+    async def explain(self, collection, pipeline):
+        return await explain(collection, pipeline)
+
+
+class ArrowBackend:
+    # Loads the four CSV tables into columnar frames (cached as Parquet) and
+    # derives OrdersEnriched, SalesRollup and CustomerRFM with the very same
+    # pipeline definitions the Mongo backend runs.
+    name = 'arrow'
+
+    def __init__(self, data_dir=ARROW_DATA_DIR, cache_dir=ARROW_CACHE_DIR):
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.tables = {}
+        self.version = 0
+        self.version_offset = 0
+        self.lock = threading.Lock()
+
+    def read_table(self, name):
+        schema = TABLES[name]
+        csv_path = os.path.join(self.data_dir, schema['file'])
+        parquet_path = os.path.join(self.cache_dir, f"{name}.parquet")
+        if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+            return pd.read_parquet(parquet_path)
+
+        df = pd.read_csv(csv_path, sep=detect_delimiter(csv_path), dtype=schema['dtypes'], encoding='utf-8')
+        for column in schema['dates']:
+            df[column] = pd.to_datetime(df[column], utc=True).dt.tz_localize(None)
+        # Mirrors the ObjectId every imported document gets in MongoDB.
+        df.insert(0, '_id', range(len(df)))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        replace_file(parquet_path, lambda path: df.to_parquet(path, index=False))
+        return df
+
+    def source_version(self):
+        paths = [os.path.join(self.data_dir, schema['file']) for schema in TABLES.values()]
+        return int(max(os.path.getmtime(path) for path in paths))
+
+    def load(self):
+        tables = {name: self.read_table(name) for name in TABLES}
+        orders = tables['Orders']
+        tables[SOURCE_COLLECTIONS[SOURCE_ENRICHED]] = run_stages(orders, get_orders_enriched_pipeline(), tables)[0]
+        tables[SOURCE_COLLECTIONS[SOURCE_ROLLUP]] = run_stages(orders, get_rollup_pipeline(), tables)[0]
+        tables[CUSTOMER_RFM_COLLECTION] = run_stages(orders, get_rfm_pipeline(), tables)[0]
+        tables[SKETCH_COLLECTION] = pd.DataFrame(
+            build_sketch_documents(tables[SOURCE_COLLECTIONS[SOURCE_ENRICHED]])
+        )
+        enriched = tables[SOURCE_COLLECTIONS[SOURCE_ENRICHED]]
+        tables[CUBE_COLLECTION] = cube_frame(build_cube(
+            lambda joins: evaluate(enriched, get_cube_pipeline(joins=joins), tables)
+        ))
+        with self.lock:
+            self.tables = tables
+            self.version = self.source_version()
+
+    def rebuild(self):
+        self.load()
+        counts = {
+            name: len(self.tables[name])
+            for name in (SOURCE_COLLECTIONS[SOURCE_ENRICHED], SOURCE_COLLECTIONS[SOURCE_ROLLUP],
+                         CUSTOMER_RFM_COLLECTION, SKETCH_COLLECTION, CUBE_COLLECTION)
+        }
+        return counts, self.data_version()
+
+    def data_version(self):
+        return self.version + self.version_offset
+
+    def bump_version(self):
+        with self.lock:
+            self.version_offset += 1
+        return self.data_version()
+
+    def run(self, collection, pipeline):
+        tables = self.tables
+        return evaluate(tables[collection], pipeline, tables)
+
+    async def aggregate(self, collection, pipeline):
+        return await run_sync(self.run, collection, pipeline)
+
+    async def find(self, collection, filter=None):
+        return await run_sync(self.run, collection, [{'$match': filter}] if filter else [])
+
+    async def stream(self, collection, pipeline):
+        for document in await self.aggregate(collection, pipeline):
+            yield document
+
+    async def explain(self, collection, pipeline):
+        # No index here: every pipeline scans its whole input frame.
+        return {'stage': 'COLLSCAN', 'totalDocsExamined': len(self.tables[collection])}
+
+
+BACKENDS = {
+    MongoBackend.name: MongoBackend,
+    ArrowBackend.name: ArrowBackend
+}
+
+
+def create_backend(name=ANALYTICS_BACKEND):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown analytics backend: {name}")
+    return BACKENDS[name]()
@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+# End-to-end benchmark of the API: optionally generates a scaled dataset
+# (generate.py) and loads it into MongoDB (ingest.py), then measures every
+# endpoint: one cold request (KPI cache cleared and data version bumped,
+# so models and dimension tables are rebuilt too) followed by warm
+# requests sent by concurrent clients. Results are written as JSON, keyed
+# by commit, for comparison between runs with --compare. With --workers,
+# the API is started once per worker count (python main.py) and measured
+# over HTTP, which gives the throughput-versus-workers curve.
+
+ENDPOINTS = [
+    '/api/version',
+    '/kpi/total-sales',
+    '/kpi/total-profit',
+    '/kpi/average-basket',
+    '/kpi/sales-per-dates',
+    '/kpi/sales?granularity=Mois&metric=Sales',
+    '/kpi/sales?granularity=Jour&metric=Profit',
+    '/kpi/sales-by-state',
+    '/kpi/sales-by-category',
+    '/kpi/sales-by-product',
+    '/kpi/sales-by-product?limit=100',
+    '/kpi/sales-by-region',
+    '/kpi/sales-by-location',
+    '/kpi/sales-matrix',
+    '/kpi/cube?rows=product&cols=region&measures=Sales&format=sparse',
+    '/kpi/cube?rows=category&cols=month',
+    '/kpi/profit-by-category',
+    '/kpi/profit-by-product',
+    '/kpi/top-profitable-products',
+    '/kpi/average-basket-by-state',
+    '/kpi/average-basket-by-category',
+    '/kpi/average-basket-by-region',
+    '/kpi/top-categories',
+    '/kpi/top-products-by-quantity',
+    '/kpi/bundle?page=ventes',
+    '/kpi/bundle?page=profits',
+    '/kpi/bundle?page=produits',
+    '/api/rfm-data',
+    '/api/rfm-data?format=ndjson',
+    '/api/rfm',
+    '/api/elbow?max_k=10',
+    '/api/forecast?periods=365'
+]
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class RemoteClient:
+    # A running API (uvicorn, possibly several workers) reached over HTTP.
+
+    def __init__(self, url, timeout):
+        import requests
+        self.requests = requests
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+        self.target = self.url
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = self.requests.Session()
+        return self.local.session
+
+    def request(self, method, path, headers=None):
+        response = self.session().request(method, self.url + path, headers=headers, timeout=self.timeout)
+        return response.status_code, len(response.content)
+
+    def close(self):
+        pass
+
+
+class ServerProcess:
+    # `python main.py` with WEB_WORKERS workers, stopped on exit.
+
+    def __init__(self, workers, port, timeout):
+        self.workers = workers
+        self.port = port
+        self.timeout = timeout
+        self.process = None
+
+    def __enter__(self):
+        env = {**os.environ, 'WEB_WORKERS': str(self.workers), 'API_PORT': str(self.port)}
+        self.process = subprocess.Popen([sys.executable, 'main.py'], env=env)
+        client = RemoteClient(f"http://127.0.0.1:{self.port}", timeout=5)
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"main.py exited with code {self.process.returncode}")
+            try:
+                if client.request('GET', '/api/version')[0] == 200:
+                    return client
+            except client.requests.RequestException:
+                pass
+            time.sleep(0.5)
+        self.__exit__(None, None, None)
+        raise RuntimeError(f"API with {self.workers} workers not ready after {self.timeout}s")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class InProcessClient:
+    # The app served in this process through the ASGI test client: no
+    # network, no uvicorn, the same handlers and backends.
+
+    def __init__(self):
+        from fastapi.testclient import TestClient
+        from main import app, backend
+        self.client = TestClient(app)
+        self.client.__enter__()
+        self.target = f"in-process ({backend.name})"
+
+    def request(self, method, path, headers=None):
+        response = self.client.request(method, path, headers=headers)
+        return response.status_code, len(response.content)
+
+    def close(self):
+        self.client.__exit__(None, None, None)
+
+
+def percentile(values, q):
+    return round(float(np.percentile(values, q)), 2) if values else None
+
+
+def measure(client, path, requests, concurrency, headers=None):
+    client.request('POST', '/admin/cache/invalidate?bump_version=true')
+    start = time.perf_counter()
+    status, size = client.request('GET', path, headers)
+    cold_ms = (time.perf_counter() - start) * 1000
+
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def run(_):
+        begin = time.perf_counter()
+        try:
+            code = client.request('GET', path, headers)[0]
+        except Exception:
+            code = 'error'
+        elapsed = (time.perf_counter() - begin) * 1000
+        with lock:
+            latencies.append(elapsed)
+            statuses[code] = statuses.get(code, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(run, range(requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        'path': path,
+        'status': status,
+        'bytes': size,
+        'cold_ms': round(cold_ms, 2),
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': sum(count for code, count in statuses.items() if code == 'error' or code >= 400),
+        'statuses': {str(code): count for code, count in statuses.items()},
+        'mean_ms': round(float(np.mean(latencies)), 2) if latencies else None,
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': round(max(latencies), 2) if latencies else None,
+        'throughput_rps': round(requests / wall, 1) if wall else None
+    }
+
+
+def compare(baseline_path, current_path, metric='p50_ms'):
+    with open(baseline_path) as f:
+        baseline = {row['path']: row for row in json.load(f)['endpoints']}
+    with open(current_path) as f:
+        current = json.load(f)['endpoints']
+    print(f"{'endpoint':<50} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for row in current:
+        before = baseline.get(row['path'], {}).get(metric)
+        after = row.get(metric)
+        ratio = f"{after / before:.2f}" if before and after is not None else '-'
+        print(f"{row['path']:<50} {before if before is not None else '-':>10} "
+              f"{after if after is not None else '-':>10} {ratio:>7}")
+
+
+def measure_all(client, args, headers):
+    endpoints = []
+    for path in args.endpoints:
+        result = measure(client, path, args.requests, args.concurrency, headers)
+        endpoints.append(result)
+        print(f"{path}: cold {result['cold_ms']} ms, p50 {result['p50_ms']} ms, "
+              f"p99 {result['p99_ms']} ms, {result['throughput_rps']} req/s, {result['errors']} errors")
+    return endpoints
+
+
+def print_curve(curve):
+    counts = [run['workers'] for run in curve]
+    print(f"{'endpoint (req/s)':<50} " + ' '.join(f"{f'{n} w':>9}" for n in counts))
+    for i, row in enumerate(curve[0]['endpoints']):
+        values = [run['endpoints'][i]['throughput_rps'] for run in curve]
+        print(f"{row['path']:<50} " + ' '.join(f"{v if v is not None else '-':>9}" for v in values))
+
+
+def main(args):
+    report = {
+        'commit': git_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': {'cpus': os.cpu_count(), 'platform': platform.platform()},
+        'data_dir': args.data_dir,
+        'settings': {'requests': args.requests, 'concurrency': args.concurrency, 'arrow': args.arrow,
+                     'workers': args.workers}
+    }
+
+    if args.scale is not None:
+        from generate import generate
+        report['generate'] = generate(data_dir=args.source_dir, out_dir=args.data_dir, scale=args.scale,
+                                      seed=args.seed)
+    if args.load:
+        from database import get_db
+        from ingest import ingest
+        start = time.perf_counter()
+        reports = ingest(get_db(), data_dir=args.data_dir, drop=True)
+        report['ingest'] = {'tables': reports, 'seconds': round(time.perf_counter() - start, 3)}
+
+    # Read by config.py at import: an arrow backend, in process or started
+    # by --workers, reads the benchmark data.
+    os.environ.setdefault('ARROW_DATA_DIR', args.data_dir)
+    os.environ.setdefault('ARROW_CACHE_DIR', os.path.join(args.data_dir, 'parquet'))
+    headers = {'Accept': ARROW_MEDIA_TYPE} if args.arrow else None
+    if args.workers:
+        curve = []
+        for workers in args.workers:
+            print(f"--- {workers} worker(s)")
+            with ServerProcess(workers, args.port, args.timeout) as client:
+                curve.append({'workers': workers, 'endpoints': measure_all(client, args, headers)})
+        report['target'] = f"main.py on port {args.port}"
+        report['workers_curve'] = curve
+        print_curve(curve)
+        write_report(report, args.output)
+        return
+
+    if args.url:
+        client = RemoteClient(args.url, args.timeout)
+    else:
+        start = time.perf_counter()
+        client = InProcessClient()
+        report['startup_seconds'] = round(time.perf_counter() - start, 3)
+    report['target'] = client.target
+
+    try:
+        report['endpoints'] = measure_all(client, args, headers)
+    finally:
+        client.close()
+    write_report(report, args.output)
+
+
+def write_report(report, output):
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {output}")
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints on generated data.")
+    parser.add_argument("--data-dir", default="data", help="CSV files to load and query")
+    parser.add_argument("--scale", type=float, help="generate the data first, from --source-dir, with this scale")
+    parser.add_argument("--source-dir", default="data")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--load", action="store_true", help="load --data-dir into MongoDB (drops the collections)")
+    parser.add_argument("--url", help="benchmark a running API instead of serving it in process")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        help="start main.py with each of these worker counts and measure it (throughput curve)")
+    parser.add_argument("--port", type=int, default=8765, help="port of the API started by --workers")
+    parser.add_argument("--requests", type=int, default=50, help="warm requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--arrow", action="store_true", help="ask for Arrow IPC instead of JSON")
+    parser.add_argument("--endpoints", nargs="+", default=ENDPOINTS)
+    parser.add_argument("--output", help="JSON results file (stdout if unset)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="print the p50 ratio of two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        main(args)
@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+
+# In-process evaluator for the aggregation pipelines of pipelines.py over
+# pandas DataFrames. Documents are flattened: nested fields are columns
+# named with dotted paths ('product_details.Category', '_id.state').
+# Only the stages and operators used by pipelines.py are supported.
+
+DATE_TRUNC_FREQ = {
+    'day': 'D',
+    'week': 'W',
+    'month': 'M',
+    'quarter': 'Q',
+    'year': 'Y'
+}
+
+
+def field_path(value):
+    return value[1:] if isinstance(value, str) and value.startswith('$') else None
+
+
+def column(df, path):
+    if path in df.columns:
+        return df[path]
+    return pd.Series(None, index=df.index, dtype=object)
+
+
+def eval_expr(df, expr):
+    path = field_path(expr)
+    if path is not None:
+        return column(df, path)
+    if isinstance(expr, dict) and len(expr) == 1:
+        op, args = next(iter(expr.items()))
+        if op == '$divide':
+            a, b = (eval_expr(df, arg) for arg in args)
+            return a / b
+        if op == '$add':
+            result = eval_expr(df, args[0])
+            for arg in args[1:]:
+                result = result + eval_expr(df, arg)
+            return result
+        if op == '$max':
+            values = pd.concat([pd.Series(eval_expr(df, arg), index=df.index) for arg in args], axis=1)
+            return values.max(axis=1)
+        if op == '$dateTrunc':
+            dates = pd.to_datetime(eval_expr(df, args['date']))
+            freq = DATE_TRUNC_FREQ[args['unit']]
+            if freq == 'D':
+                return dates.dt.floor('D')
+            return dates.dt.to_period(freq).dt.start_time
+    if isinstance(expr, dict):
+        raise NotImplementedError(f"Unsupported expression: {expr}")
+    return expr
+
+
+def match_mask(df, query):
+    mask = pd.Series(True, index=df.index)
+    for key, condition in query.items():
+        if key == '$and':
+            for sub in condition:
+                mask &= match_mask(df, sub)
+            continue
+        if key == '$or':
+            any_mask = pd.Series(False, index=df.index)
+            for sub in condition:
+                any_mask |= match_mask(df, sub)
+            mask &= any_mask
+            continue
+
+        values = column(df, key)
+        if not isinstance(condition, dict):
+            mask &= values == condition
+            continue
+        for op, operand in condition.items():
+            if op == '$in':
+                mask &= values.isin(list(operand))
+            elif op == '$eq':
+                mask &= values == operand
+            elif op == '$ne':
+                mask &= values != operand
+            elif op == '$gt':
+                mask &= values > operand
+            elif op == '$gte':
+                mask &= values >= operand
+            elif op == '$lt':
+                mask &= values < operand
+            elif op == '$lte':
+                mask &= values <= operand
+            else:
+                raise NotImplementedError(f"Unsupported operator: {op}")
+    return mask.fillna(False).astype(bool)
+
+
+def prefixed(df, prefix):
+    return df.rename(columns={c: f"{prefix}.{c}" for c in df.columns})
+
+
+def unwind(df, path, lookups, tables):
+    # $lookup is resolved lazily: the join (with its fan-out and inner-join
+    # filtering) only happens at the matching $unwind, like in MongoDB.
+    spec = lookups.pop(path, None)
+    if spec is None:
+        return df
+    foreign = prefixed(tables[spec['from']], spec['as'])
+    return df.merge(
+        foreign,
+        how='inner',
+        left_on=spec['localField'],
+        right_on=f"{spec['as']}.{spec['foreignField']}"
+    ).reset_index(drop=True)
+
+
+def project(df, spec, prefix=''):
+    columns = {}
+    excluded = []
+    for key, value in spec.items():
+        name = f"{prefix}{key}"
+        if value in (0, False):
+            excluded.append(name)
+        elif value in (1, True):
+            matches = [c for c in df.columns if c == name or c.startswith(name + '.')]
+            columns.update({c: df[c] for c in matches})
+        elif isinstance(value, dict) and not any(k.startswith('$') for k in value):
+            columns.update(project(df, value, prefix=name + '.'))
+        else:
+            columns[name] = eval_expr(df, value)
+    if prefix:
+        return columns
+    if not columns:
+        return df.drop(columns=[c for c in df.columns
+                                if any(c == e or c.startswith(e + '.') for e in excluded)])
+    if '_id' not in spec:
+        columns.update({c: df[c] for c in df.columns if c == '_id' or c.startswith('_id.')})
+    return pd.DataFrame(columns, index=df.index)
+
+
+def group(df, spec):
+    key_spec = spec['_id']
+    if key_spec is None:
+        keys = {}
+    elif isinstance(key_spec, dict) and not any(k.startswith('$') for k in key_spec):
+        keys = {f"_id.{k}": eval_expr(df, v) for k, v in key_spec.items()}
+    else:
+        keys = {'_id': eval_expr(df, key_spec)}
+
+    work = pd.DataFrame(keys, index=df.index)
+    aggregations = {}
+    for name, accumulator in spec.items():
+        if name == '_id':
+            continue
+        op, arg = next(iter(accumulator.items()))
+        values = eval_expr(df, arg)
+        if not isinstance(values, pd.Series):
+            values = pd.Series(values, index=df.index)
+        work[f"__{name}"] = values
+        aggregations[name] = (f"__{name}", {
+            '$sum': 'sum', '$avg': 'mean', '$max': 'max', '$min': 'min', '$first': 'first'
+        }[op])
+
+    if df.empty:
+        return pd.DataFrame(columns=list(keys) + list(aggregations))
+    if not keys:
+        row = {name: getattr(work[source], func)() for name, (source, func) in aggregations.items()}
+        return pd.DataFrame([{'_id': None, **row}])
+    if not aggregations:
+        return work.drop_duplicates().reset_index(drop=True)
+    grouped = work.groupby(list(keys), dropna=False, sort=False)
+    return grouped.agg(**aggregations).reset_index()
+
+
+def sort(df, spec):
+    # Nulls sort as the smallest value, like in MongoDB: first ascending,
+    # last descending. pandas takes one na_position for all keys, so the
+    # keys are applied one at a time, last first, with a stable sort.
+    for key, direction in reversed(list(spec.items())):
+        df = df.sort_values(
+            by=key,
+            ascending=direction == 1,
+            kind='mergesort',
+            na_position='first' if direction == 1 else 'last'
+        )
+    return df.reset_index(drop=True)
+
+
+def run_stages(df, pipeline, tables, lookups=None):
+    lookups = dict(lookups or {})
+    for stage in pipeline:
+        name, spec = next(iter(stage.items()))
+        if name == '$match':
+            df = df[match_mask(df, spec)]
+        elif name == '$lookup':
+            lookups[spec['as']] = spec
+        elif name == '$unwind':
+            df = unwind(df, field_path(spec if isinstance(spec, str) else spec['path']), lookups, tables)
+        elif name == '$project':
+            df = project(df, spec)
+        elif name in ('$set', '$addFields'):
+            df = df.assign(**{key: eval_expr(df, value) for key, value in spec.items()})
+        elif name == '$group':
+            df = group(df, spec)
+        elif name == '$sort':
+            df = sort(df, spec)
+        elif name == '$limit':
+            if spec < 1:
+                raise ValueError("the limit must be positive")
+            df = df.head(spec)
+        elif name == '$facet':
+            raise ValueError("$facet must be the last stage")
+        else:
+            raise NotImplementedError(f"Unsupported stage: {name}")
+    return df, lookups
+
+
+def to_documents(df):
+    documents = []
+    records = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+    for record in records:
+        document = {}
+        for key, value in record.items():
+            if isinstance(value, np.generic):
+                value = value.item()
+            target = document
+            parts = key.split('.')
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+        documents.append(document)
+    return documents
+
+
+def evaluate(df, pipeline, tables):
+    facet = pipeline[-1].get('$facet') if pipeline else None
+    stages = pipeline[:-1] if facet is not None else pipeline
+    df, lookups = run_stages(df, stages, tables)
+    if facet is None:
+        return to_documents(df)
+    return [{
+        name: to_documents(run_stages(df, sub_pipeline, tables, lookups)[0])
+        for name, sub_pipeline in facet.items()
+    }]
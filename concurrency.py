@@ -0,0 +1,108 @@
+import asyncio
+import math
+import time
+
+from config import CONCURRENCY_LIMITS, CONCURRENCY_QUEUE_SIZE, CONCURRENCY_QUEUE_SECONDS
+from metrics import Counter
+
+COALESCED_REQUESTS = Counter(
+    'coalesced_requests_total', 'Requests served by a computation already in flight.', ['name']
+)
+REJECTED_REQUESTS = Counter(
+    'rejected_requests_total', 'Requests refused by a concurrency limit.', ['endpoint', 'status']
+)
+
+
+class SingleFlight:
+    # Identical calls in flight share one computation: the first caller
+    # starts it, the others await the same result (or exception). A caller
+    # that goes away does not cancel it for the others.
+
+    def __init__(self):
+        self.calls = {}
+
+    async def run(self, key, compute):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(compute())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self.done(key, f))
+        else:
+            COALESCED_REQUESTS.inc(str(key[0]))
+        return await asyncio.shield(future)
+
+    def done(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            # Retrieved here so an exception nobody awaits anymore is not logged as lost.
+            future.exception()
+
+    def stats(self):
+        return {'in_flight': len(self.calls)}
+
+
+class Overloaded(Exception):
+
+    def __init__(self, endpoint, status, retry_after):
+        reason = "too many queued requests" if status == 429 else "timed out waiting for a slot"
+        super().__init__(f"{endpoint}: {reason}, retry later")
+        self.endpoint = endpoint
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    # At most `limit` computations at once; `queue_size` more wait up to
+    # `timeout` seconds. A request finding the queue full is refused with
+    # 429, one that waited too long with 503; Retry-After estimates when a
+    # slot frees up from the average duration of the computations.
+
+    def __init__(self, endpoint, limit, queue_size=CONCURRENCY_QUEUE_SIZE, timeout=CONCURRENCY_QUEUE_SECONDS):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(limit)
+        self.running = 0
+        self.waiting = 0
+        self.average_seconds = 1.0
+
+    def retry_after(self):
+        return max(1, math.ceil(self.average_seconds * (self.waiting + 1) / self.limit))
+
+    def reject(self, status):
+        REJECTED_REQUESTS.inc(self.endpoint, str(status))
+        return Overloaded(self.endpoint, status, self.retry_after())
+
+    async def run(self, compute):
+        if self.running + self.waiting >= self.limit + self.queue_size:
+            raise self.reject(429)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise self.reject(503)
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        start = time.perf_counter()
+        try:
+            return await compute()
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+            self.average_seconds = 0.8 * self.average_seconds + 0.2 * (time.perf_counter() - start)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'running': self.running,
+            'waiting': self.waiting,
+            'queue_size': self.queue_size,
+            'average_seconds': round(self.average_seconds, 3)
+        }
+
+
+def create_limiters(limits=CONCURRENCY_LIMITS):
+    return {endpoint: ConcurrencyLimiter(endpoint, limit) for endpoint, limit in limits.items()}
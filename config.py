@@ -0,0 +1,125 @@
+import os
+import tempfile
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = os.getenv("MONGO_DB", "ecommerce")
+
+# Serving: `python main.py` starts WEB_WORKERS uvicorn worker processes.
+# Set it to the worker count of any other process manager too: pools and
+# shared state are sized from it.
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8000"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+
+# Size of the pymongo connection pool and of the thread pool that runs the
+# blocking driver calls; one thread per connection keeps both saturated.
+# Each worker has its own pool, MONGO_POOL_BUDGET connections are split
+# between them.
+MONGO_POOL_BUDGET = int(os.getenv("MONGO_POOL_BUDGET", "50"))
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", str(max(1, -(-MONGO_POOL_BUDGET // WEB_WORKERS)))))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(MONGO_MAX_POOL_SIZE)))
+
+# Server-side limit applied to every aggregation (maxTimeMS).
+MONGO_QUERY_TIMEOUT_MS = int(os.getenv("MONGO_QUERY_TIMEOUT_MS", "30000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+
+# KPI result cache: entries are keyed by data version, the TTL only bounds
+# how long an entry survives if the version is never bumped.
+KPI_CACHE_SIZE = int(os.getenv("KPI_CACHE_SIZE", "256"))
+KPI_CACHE_TTL_SECONDS = float(os.getenv("KPI_CACHE_TTL_SECONDS", "3600"))
+DATA_VERSION_CHECK_SECONDS = float(os.getenv("DATA_VERSION_CHECK_SECONDS", "2"))
+
+# Sales forecasts: models are fitted once per data version for the whole
+# horizon and persisted under FORECAST_DIR; shorter periods are slices.
+FORECAST_DIR = os.getenv("FORECAST_DIR", os.path.join("models", "forecast"))
+FORECAST_HORIZON_DAYS = int(os.getenv("FORECAST_HORIZON_DAYS", "730"))
+FORECAST_WORKERS = int(os.getenv("FORECAST_WORKERS", str(os.cpu_count() or 1)))
+# Data versions kept on disk per scope, and the wait before fitting a
+# version that failed again (doubled after each failure, up to the maximum).
+FORECAST_KEEP_VERSIONS = int(os.getenv("FORECAST_KEEP_VERSIONS", "2"))
+FORECAST_RETRY_SECONDS = float(os.getenv("FORECAST_RETRY_SECONDS", "60"))
+FORECAST_RETRY_MAX_SECONDS = float(os.getenv("FORECAST_RETRY_MAX_SECONDS", "3600"))
+# How often a worker checks whether another one finished fitting a version.
+FORECAST_LOCK_POLL_SECONDS = float(os.getenv("FORECAST_LOCK_POLL_SECONDS", "0.5"))
+
+# Elbow method: k values are fitted in parallel (joblib n_jobs) and
+# MiniBatchKMeans replaces KMeans above the customer threshold.
+ELBOW_MAX_K = int(os.getenv("ELBOW_MAX_K", "20"))
+ELBOW_N_JOBS = int(os.getenv("ELBOW_N_JOBS", "-1"))
+ELBOW_MINIBATCH_THRESHOLD = int(os.getenv("ELBOW_MINIBATCH_THRESHOLD", "10000"))
+
+# Recency is counted in days from this date (YYYY-MM-DD); today (UTC) if unset.
+RFM_REFERENCE_DATE = os.getenv("RFM_REFERENCE_DATE")
+
+# Query backend: "mongo" runs the pipelines on the MongoDB server, "arrow"
+# evaluates the same pipelines in process over the CSV files (cached as
+# Parquet in ARROW_CACHE_DIR) and needs no MongoDB at all.
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "mongo")
+ARROW_DATA_DIR = os.getenv("ARROW_DATA_DIR", "data")
+ARROW_CACHE_DIR = os.getenv("ARROW_CACHE_DIR", os.path.join("data", "parquet"))
+
+# Pipeline optimizer for KPIs computed from Orders and SalesRollup: group on
+# the join keys before $lookup. With PIPELINE_OPTIMIZER_VERIFY the original pipeline
+# also runs and its result is served (and logged) when they differ.
+PIPELINE_OPTIMIZER = os.getenv("PIPELINE_OPTIMIZER", "1") == "1"
+PIPELINE_OPTIMIZER_VERIFY = os.getenv("PIPELINE_OPTIMIZER_VERIFY", "0") == "1"
+
+# Dimension tables (Customers, Products, Location) cached in the API process:
+# the server only groups orders by their join keys, names, categories and
+# regions are joined in Python on the grouped rows.
+DIMENSION_JOINS = os.getenv("DIMENSION_JOINS", "1") == "1"
+
+# Query instrumentation: aggregations slower than SLOW_QUERY_MS are logged
+# (to SLOW_QUERY_LOG if set) and a sample of them is explained.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG")
+QUERY_EXPLAIN_SAMPLE_RATE = float(os.getenv("QUERY_EXPLAIN_SAMPLE_RATE", "0.05"))
+
+# Warm state (dimension tables, KPI results) written by one worker and read
+# by the others, under SHARED_STATE_DIR; on by default with several workers.
+# The directory is per user: the workers load the pickles it holds.
+SHARED_STATE = os.getenv("SHARED_STATE", "1" if WEB_WORKERS > 1 else "0") == "1"
+SHARED_STATE_DIR = os.getenv("SHARED_STATE_DIR", os.path.join(
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+    f"ecommerce-analytics-{os.getuid() if hasattr(os, 'getuid') else 'user'}-{MONGO_DB}"
+))
+
+# Live KPIs (/kpi/stream): inserts into Orders are followed through a
+# change stream ("changestream", needs a replica set), by polling the Row ID
+# ("poll"), or the first that works ("auto"); "off" only follows data
+# versions. Slow clients with LIVE_QUEUE_SIZE pending events are resent a
+# snapshot; a comment is sent every LIVE_HEARTBEAT_SECONDS on idle streams.
+LIVE_UPDATES = os.getenv("LIVE_UPDATES", "auto")
+LIVE_POLL_SECONDS = float(os.getenv("LIVE_POLL_SECONDS", "1"))
+LIVE_BATCH_SIZE = int(os.getenv("LIVE_BATCH_SIZE", "5000"))
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "100"))
+LIVE_HEARTBEAT_SECONDS = float(os.getenv("LIVE_HEARTBEAT_SECONDS", "15"))
+
+# Expensive computations per worker: at most `limit` at once per endpoint
+# ("endpoint=limit,..."), CONCURRENCY_QUEUE_SIZE more wait up to
+# CONCURRENCY_QUEUE_SECONDS; beyond that, 429 (queue full) or 503 (timeout).
+CONCURRENCY_LIMITS = {
+    endpoint: int(limit)
+    for endpoint, _, limit in (
+        item.partition("=") for item in os.getenv(
+            "CONCURRENCY_LIMITS", "rfm=1,rfm-score=4,elbow=1,rfm-data=2,basket-distribution=4"
+        ).split(",") if item
+    )
+}
+CONCURRENCY_QUEUE_SIZE = int(os.getenv("CONCURRENCY_QUEUE_SIZE", "32"))
+CONCURRENCY_QUEUE_SECONDS = float(os.getenv("CONCURRENCY_QUEUE_SECONDS", "30"))
+
+# Prometheus text endpoint (/metrics) and its request middleware.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+# Approximate KPIs (?approx=true): HyperLogLog and t-digest sketches per day
+# and dimension. 2^precision registers per HyperLogLog (1.6% standard error
+# at 12); a higher t-digest compression keeps more, smaller centroids.
+SKETCH_HLL_PRECISION = int(os.getenv("SKETCH_HLL_PRECISION", "12"))
+SKETCH_TDIGEST_COMPRESSION = float(os.getenv("SKETCH_TDIGEST_COMPRESSION", "200"))
+
+# OLAP cube (/kpi/cube): cuboids materialized besides the base cuboid, and
+# the largest dense pivot (rows x columns x measures) served.
+CUBE_CUBOIDS = int(os.getenv("CUBE_CUBOIDS", "16"))
+CUBE_MAX_DENSE_CELLS = int(os.getenv("CUBE_MAX_DENSE_CELLS", "1000000"))
@@ -0,0 +1,242 @@
+import itertools
+
+import pandas as pd
+from pymongo import ASCENDING, UpdateOne
+
+from config import CUBE_CUBOIDS
+from database import get_db
+from pipelines import (
+    CUBE_COLLECTION, CUBE_DIMENSIONS, CUBE_JOINS, CUBE_MEASURES, SOURCE_COLLECTIONS, SOURCE_ENRICHED,
+    get_cube_pipeline
+)
+
+# OLAP cube over the dimension lattice. A cuboid picks one level per
+# hierarchy and keeps the coarser levels too (a product cuboid also has the
+# sub-category and category), so any cuboid answers every query on a
+# subset of its dimensions by rolling up. The base cuboid (finest levels)
+# and the CUBE_CUBOIDS most beneficial others are materialized, chosen by
+# the greedy algorithm of Harinarayan, Rajaraman and Ullman: each step adds
+# the cuboid that most reduces the rows read to answer every cuboid.
+# Cuboids are rolled up from the base cuboid built with the joins of their
+# hierarchies only, so that the apex and the cuboids without product or
+# location levels count every order line once. A query is answered from a
+# cuboid with the same joins, and the finest cuboid of each is always
+# materialized.
+
+CUBE_HIERARCHIES = [
+    ['category', 'sub-category', 'product'],
+    ['region', 'state', 'city'],
+    ['segment'],
+    ['ship-mode'],
+    ['month']
+]
+# The OrdersEnriched join behind each hierarchy (get_cube_pipeline).
+HIERARCHY_JOINS = {'product': 0, 'location': 1}
+ENRICHED_COLLECTION = SOURCE_COLLECTIONS[SOURCE_ENRICHED]
+APEX = '*'
+INSERT_BATCH_SIZE = 10000
+
+
+def cuboid_dimensions(levels):
+    return [dimension for hierarchy, level in zip(CUBE_HIERARCHIES, levels) for dimension in hierarchy[:level]]
+
+
+def cuboid_joins(levels):
+    return tuple(join for join in CUBE_JOINS if levels[HIERARCHY_JOINS[join]])
+
+
+def cuboid_name(levels):
+    return ','.join(cuboid_dimensions(levels)) or APEX
+
+
+def parse_cuboid(name):
+    return required_levels([] if name == APEX else name.split(','))
+
+
+def all_cuboids():
+    return list(itertools.product(*[range(len(hierarchy) + 1) for hierarchy in CUBE_HIERARCHIES]))
+
+
+def required_levels(dimensions):
+    # The finest level asked for in each hierarchy.
+    levels = [0] * len(CUBE_HIERARCHIES)
+    for dimension in dimensions:
+        for i, hierarchy in enumerate(CUBE_HIERARCHIES):
+            if dimension in hierarchy:
+                levels[i] = max(levels[i], hierarchy.index(dimension) + 1)
+                break
+        else:
+            raise ValueError(f"Unknown dimension: {dimension}")
+    return tuple(levels)
+
+
+def covers(levels, other):
+    return all(a >= b for a, b in zip(levels, other))
+
+
+def answers(cuboid, levels):
+    # `cuboid` rolls up to `levels`: it holds their dimensions and counts
+    # the order lines over the same joins.
+    return covers(cuboid, levels) and cuboid_joins(cuboid) == cuboid_joins(levels)
+
+
+def base_cuboids(cuboids):
+    # The finest cuboid for each set of joins; every other one rolls up
+    # from one of them.
+    bases = {}
+    for levels in sorted(cuboids, key=sum):
+        bases[cuboid_joins(levels)] = levels
+    return bases
+
+
+def base_frame(documents, measures=CUBE_MEASURES):
+    # Grouped documents with their `_id` fields as columns.
+    frame = pd.DataFrame(documents)
+    if frame.empty:
+        return pd.DataFrame(columns=list(CUBE_DIMENSIONS) + measures)
+    keys = pd.DataFrame(frame.pop('_id').tolist(), index=frame.index)
+    return pd.concat([keys, frame[measures]], axis=1)
+
+
+def roll_up(frame, dimensions):
+    if not dimensions:
+        return frame[CUBE_MEASURES].sum().to_frame().T
+    return frame.groupby(dimensions, sort=False, dropna=False)[CUBE_MEASURES].sum().reset_index()
+
+
+def cuboid_sizes(base):
+    return {
+        levels: base.groupby(dims, dropna=False).ngroups if (dims := cuboid_dimensions(levels)) else 1
+        for levels in all_cuboids()
+    }
+
+
+def select_cuboids(sizes, count=CUBE_CUBOIDS):
+    bases = base_cuboids(sizes)
+    selected = list(bases.values())
+    cost = {levels: sizes[bases[cuboid_joins(levels)]] for levels in sizes}
+    for _ in range(count):
+        best, best_benefit = None, 0
+        for candidate in sizes:
+            if candidate in selected:
+                continue
+            benefit = sum(
+                cost[levels] - sizes[candidate]
+                for levels in sizes
+                if answers(candidate, levels) and cost[levels] > sizes[candidate]
+            )
+            if benefit > best_benefit:
+                best, best_benefit = candidate, benefit
+        if best is None:
+            break
+        selected.append(best)
+        for levels in sizes:
+            if answers(best, levels):
+                cost[levels] = min(cost[levels], sizes[best])
+    return selected
+
+
+def roll_up_cuboids(aggregate, cuboids):
+    # {levels: frame} rolled up from the base cuboid of each cuboid's joins;
+    # `aggregate(joins)` returns the get_cube_pipeline documents.
+    bases = {}
+    frames = {}
+    for levels in cuboids:
+        joins = cuboid_joins(levels)
+        if joins not in bases:
+            bases[joins] = base_frame(aggregate(joins))
+        frames[levels] = roll_up(bases[joins], cuboid_dimensions(levels))
+    return frames
+
+
+def build_cube(aggregate, count=CUBE_CUBOIDS):
+    # {levels: frame} of the materialized cuboids. The cuboid sizes are
+    # counted on the base cuboid with every join.
+    selected = select_cuboids(cuboid_sizes(base_frame(aggregate(CUBE_JOINS))), count)
+    return roll_up_cuboids(aggregate, selected)
+
+
+def cell_records(frame):
+    # Missing members become None: NaN is not a reliable upsert filter value
+    # while {dimension: None} matches the stored null.
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient='records')
+
+
+def cube_frame(cuboids):
+    # All cuboids in one table, as the arrow backend stores them.
+    frames = [frame.assign(cuboid=cuboid_name(levels)) for levels, frame in cuboids.items()]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['cuboid'] + CUBE_MEASURES)
+
+
+def nearest_cuboid(catalog, dimensions):
+    # The smallest materialized cuboid holding every dimension; `catalog`
+    # maps cuboid names to their row counts.
+    needed = required_levels(dimensions)
+    candidates = [(rows, name) for name, rows in catalog.items() if answers(parse_cuboid(name), needed)]
+    return min(candidates)[1] if candidates else None
+
+
+def to_cells(documents, dimensions, measures):
+    # Sparse pivot: one row per non-empty cell, sorted by its dimensions.
+    frame = base_frame(documents, measures) if documents else pd.DataFrame(columns=dimensions + measures)
+    if not dimensions:
+        frame = frame.drop(columns=[c for c in frame.columns if c not in measures])
+    if 'month' in frame.columns:
+        frame['month'] = pd.to_datetime(frame['month']).dt.strftime('%Y-%m')
+    frame = frame[dimensions + measures]
+    return frame.sort_values(dimensions, kind='mergesort').reset_index(drop=True) if dimensions else frame
+
+
+def to_dense(cells, rows, cols, measures):
+    # Dense pivot: one row per `rows` value, one column per measure and
+    # `cols` value ("Sales|East"), empty cells set to 0.
+    if not cols or not rows:
+        return cells
+    wide = cells.pivot_table(index=rows, columns=cols, values=measures, aggfunc='sum', fill_value=0)
+    wide.columns = ['|'.join(str(part) for part in column) for column in wide.columns]
+    return wide.reset_index()
+
+
+def rebuild_cube(db, count=CUBE_CUBOIDS):
+    cuboids = build_cube(lambda joins: list(db[ENRICHED_COLLECTION].aggregate(
+        get_cube_pipeline(joins=joins), allowDiskUse=True
+    )), count)
+    db[CUBE_COLLECTION].drop()
+    for levels, frame in cuboids.items():
+        records = cell_records(frame.assign(cuboid=cuboid_name(levels)))
+        for start in range(0, len(records), INSERT_BATCH_SIZE):
+            db[CUBE_COLLECTION].insert_many(records[start:start + INSERT_BATCH_SIZE], ordered=False)
+    db[CUBE_COLLECTION].create_index([('cuboid', ASCENDING)])
+    return db[CUBE_COLLECTION].estimated_document_count()
+
+
+def merge_into_cube(db, match):
+    # Same contract as merge_into_rollups: only for orders not counted yet.
+    # `match` selects order lines (Row ID) of OrdersEnriched.
+    cuboids = {parse_cuboid(name): name for name in db[CUBE_COLLECTION].distinct('cuboid')}
+    deltas = roll_up_cuboids(lambda joins: list(db[ENRICHED_COLLECTION].aggregate(
+        get_cube_pipeline(match, joins), allowDiskUse=True
+    )), cuboids)
+    operations = []
+    for levels, delta in deltas.items():
+        if not delta['order_lines'].sum():
+            continue
+        name, dimensions = cuboids[levels], cuboid_dimensions(levels)
+        for row in cell_records(delta):
+            key = {'cuboid': name, **{dimension: row[dimension] for dimension in dimensions}}
+            operations.append(UpdateOne(key, {'$inc': {m: row[m] for m in CUBE_MEASURES}}, upsert=True))
+    if operations:
+        db[CUBE_COLLECTION].bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def ensure_cube(db):
+    if db[CUBE_COLLECTION].estimated_document_count() == 0 \
+            and db[ENRICHED_COLLECTION].estimated_document_count() > 0:
+        return rebuild_cube(db)
+    return None
+
+
+if __name__ == "__main__":
+    count = rebuild_cube(get_db())
+    print(f"{CUBE_COLLECTION}: {count} documents")
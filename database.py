@@ -0,0 +1,147 @@
+import asyncio
+import functools
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+
+from config import (
+    MONGO_URI, MONGO_DB, MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE, DB_EXECUTOR_WORKERS,
+    MONGO_QUERY_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS
+)
+
+_client = None
+_executor = None
+
+
+def reset_after_fork():
+    # A MongoClient is not fork-safe: a forked worker drops the client and
+    # executor it inherited (they belong to the parent, so they are not
+    # closed) and opens its own on first use.
+    global _client, _executor
+    _client = None
+    _executor = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = MongoClient(
+            MONGO_URI,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS
+        )
+    return _client
+
+
+def get_db():
+    return get_client()[MONGO_DB]
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="mongo")
+    return _executor
+
+
+async def run_sync(fn, *args, **kwargs):
+    # pymongo, pandas and scikit-learn calls block; run them off the event loop.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(fn, *args, **kwargs))
+
+
+def aggregate_sync(collection, pipeline, timeout_ms=None):
+    cursor = get_db()[collection].aggregate(
+        pipeline,
+        maxTimeMS=timeout_ms or MONGO_QUERY_TIMEOUT_MS,
+        allowDiskUse=True
+    )
+    return list(cursor)
+
+
+async def aggregate(collection, pipeline, timeout_ms=None):
+    return await run_sync(aggregate_sync, collection, pipeline, timeout_ms)
+
+
+def explain_sync(collection, pipeline, timeout_ms=None):
+    # executionStats runs the pipeline: only called on sampled queries.
+    return get_db().command(
+        'explain',
+        {
+            'aggregate': collection,
+            'pipeline': pipeline,
+            'cursor': {},
+            'allowDiskUse': True,
+            'maxTimeMS': timeout_ms or MONGO_QUERY_TIMEOUT_MS
+        },
+        verbosity='executionStats'
+    )
+
+
+async def explain(collection, pipeline, timeout_ms=None):
+    return await run_sync(explain_sync, collection, pipeline, timeout_ms)
+
+
+def next_batch(cursor, size):
+    return list(itertools.islice(cursor, size))
+
+
+async def stream(collection, pipeline, batch_size=1000, timeout_ms=None):
+    # Yields documents as the cursor returns them, holding one batch at a time.
+    cursor = await run_sync(
+        get_db()[collection].aggregate,
+        pipeline,
+        maxTimeMS=timeout_ms or MONGO_QUERY_TIMEOUT_MS,
+        allowDiskUse=True,
+        batchSize=batch_size
+    )
+    try:
+        while True:
+            batch = await run_sync(next_batch, cursor, batch_size)
+            if not batch:
+                break
+            for document in batch:
+                yield document
+    finally:
+        cursor.close()
+
+
+def find_sync(collection, filter=None, projection=None, timeout_ms=None):
+    cursor = get_db()[collection].find(
+        filter or {},
+        projection,
+        max_time_ms=timeout_ms or MONGO_QUERY_TIMEOUT_MS
+    )
+    return list(cursor)
+
+
+async def find(collection, filter=None, projection=None, timeout_ms=None):
+    return await run_sync(find_sync, collection, filter, projection, timeout_ms)
+
+
+def get_round_trip_times():
+    # Heartbeat round trip per server, as measured by the driver monitors.
+    if _client is None:
+        return {}
+    return {
+        f"{host}:{port}": description.round_trip_time
+        for (host, port), description in _client.topology_description.server_descriptions().items()
+        if description.round_trip_time is not None
+    }
+
+
+def close():
+    global _client, _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+    if _client is not None:
+        _client.close()
+        _client = None
@@ -0,0 +1,64 @@
+import asyncio
+
+import pandas as pd
+
+from columnar import evaluate
+from database import run_sync
+
+DIMENSION_COLLECTIONS = ['Customers', 'Products', 'Location']
+
+
+def to_frame(documents):
+    frame = pd.DataFrame(documents)
+    return frame.drop(columns='_id', errors='ignore')
+
+
+class DimensionCache:
+    # Customers, Products and Location (a few thousand rows) kept in memory
+    # per data version, so joins run in process on the grouped results.
+
+    def __init__(self, collections=DIMENSION_COLLECTIONS, shared=None):
+        self.collections = collections
+        self.shared = shared
+        self.version = None
+        self.tables = {}
+        self.lock = asyncio.Lock()
+
+    async def get(self, version, load):
+        # `load(collection)` returns the documents of a collection.
+        if self.version != version:
+            async with self.lock:
+                if self.version != version:
+                    frames = await asyncio.gather(*[
+                        self.load_table(version, name, load) for name in self.collections
+                    ])
+                    self.tables = dict(zip(self.collections, frames))
+                    self.version = version
+        return self.tables
+
+    async def load_table(self, version, name, load):
+        # With several workers, the first one to load a table shares it.
+        if self.shared is not None:
+            found, frame = await run_sync(self.shared.get, 'dimensions', version, name)
+            if found:
+                return frame
+        frame = to_frame(await load(name))
+        if self.shared is not None:
+            await run_sync(self.shared.set, 'dimensions', version, name, frame)
+        return frame
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "rows": {name: len(frame) for name, frame in self.tables.items()}
+        }
+
+
+def join_locally(documents, pipeline, tables):
+    # Runs the join/regroup part of a split pipeline over the pre-grouped
+    # documents returned by the server.
+    if not documents:
+        return []
+    frame = pd.DataFrame(documents)
+    keys = pd.DataFrame(frame.pop('_id').tolist(), index=frame.index).add_prefix('_id.')
+    return evaluate(pd.concat([keys, frame], axis=1), pipeline, tables)
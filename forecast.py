@@ -0,0 +1,212 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from config import (
+    FORECAST_DIR, FORECAST_HORIZON_DAYS, FORECAST_WORKERS, FORECAST_KEEP_VERSIONS, FORECAST_RETRY_SECONDS,
+    FORECAST_RETRY_MAX_SECONDS, FORECAST_LOCK_POLL_SECONDS
+)
+from database import run_sync
+from metrics import MODEL_FIT_DURATION
+from shared_state import file_lock, replace_file
+
+FORECAST_COLUMNS = ['ds', 'yhat', 'yhat_lower', 'yhat_upper', 'trend', 'weekly', 'yearly']
+TOTAL_GROUP = 'all'
+
+
+def fit_forecast(group, rows, horizon):
+    # Runs in a worker process: Prophet is imported there, not in the API.
+    from prophet import Prophet
+    from prophet.serialize import model_to_json
+
+    history = pd.DataFrame(rows, columns=['ds', 'y'])
+    history['ds'] = pd.to_datetime(history['ds'])
+
+    model = Prophet()
+    model.fit(history)
+    future = model.make_future_dataframe(periods=horizon)
+    forecast = model.predict(future)
+
+    frame = forecast[[c for c in FORECAST_COLUMNS if c in forecast.columns]]
+    frame = frame.merge(history, on='ds', how='left')
+    return group, model_to_json(model), frame
+
+
+class ForecastService:
+
+    def __init__(self, directory=FORECAST_DIR, horizon=FORECAST_HORIZON_DAYS, workers=FORECAST_WORKERS,
+                 keep_versions=FORECAST_KEEP_VERSIONS, retry_seconds=FORECAST_RETRY_SECONDS,
+                 retry_max_seconds=FORECAST_RETRY_MAX_SECONDS, lock_poll_seconds=FORECAST_LOCK_POLL_SECONDS):
+        self.directory = directory
+        self.horizon = horizon
+        self.workers = workers
+        self.keep_versions = keep_versions
+        self.retry_seconds = retry_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.lock_poll_seconds = lock_poll_seconds
+        self.results = {}
+        self.jobs = {}
+        # (scope, version) -> (failures, retry time, exception) of failed fits
+        self.failures = {}
+        self.executor = None
+
+    def get_executor(self):
+        if self.executor is None:
+            # Spawned, not forked: the API process runs threads (run_sync
+            # pool, pymongo monitors) whose locks a forked child could
+            # inherit held.
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+            )
+        return self.executor
+
+    def path(self, scope, version):
+        return os.path.join(self.directory, scope, f"v{version}")
+
+    def save(self, scope, version, models, frames):
+        path = self.path(scope, version)
+        os.makedirs(path, exist_ok=True)
+        # Each file is renamed into place once written, the forecast last:
+        # load() only sees complete versions.
+        def write_models(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(models, f)
+        replace_file(os.path.join(path, "models.json"), write_models)
+        combined = pd.concat([frame.assign(group=group) for group, frame in frames.items()])
+        replace_file(os.path.join(path, "forecast.parquet"), lambda tmp_path: combined.to_parquet(tmp_path, index=False))
+
+    def prune(self, scope, version):
+        # Only the `keep_versions` latest versions stay on disk.
+        directory = os.path.join(self.directory, scope)
+        names = os.listdir(directory) if os.path.isdir(directory) else []
+        versions = [int(name[1:]) for name in names if name.startswith('v') and name[1:].isdigit()]
+        older = sorted((v for v in versions if v < version), reverse=True)
+        for old in older[max(0, self.keep_versions - 1):]:
+            shutil.rmtree(os.path.join(directory, f"v{old}"), ignore_errors=True)
+
+    def load(self, scope, version):
+        path = os.path.join(self.path(scope, version), "forecast.parquet")
+        if not os.path.exists(path):
+            return None
+        combined = pd.read_parquet(path)
+        return {
+            group: frame.drop(columns='group').reset_index(drop=True)
+            for group, frame in combined.groupby('group', sort=False)
+        }
+
+    async def train(self, scope, version, load_series):
+        # One API worker fits a version at a time (lock file shared by the
+        # processes); the others poll the lock without holding a run_sync
+        # thread, then load the files it saved.
+        path = os.path.join(self.directory, scope, "train.lock")
+        while True:
+            lock = file_lock(path, blocking=False)
+            if lock.__enter__():
+                break
+            lock.__exit__(None, None, None)
+            await asyncio.sleep(self.lock_poll_seconds)
+        try:
+            frames = await run_sync(self.load, scope, version)
+            if frames is None:
+                frames = await self.fit(scope, version, load_series)
+                await run_sync(self.prune, scope, version)
+        finally:
+            lock.__exit__(None, None, None)
+        self.results[scope] = (version, frames)
+        return frames
+
+    async def fit(self, scope, version, load_series):
+        series = await load_series()
+        loop = asyncio.get_running_loop()
+        # One process per group: per-category/region models are fitted in parallel.
+        with MODEL_FIT_DURATION.time('prophet'):
+            results = await asyncio.gather(*[
+                loop.run_in_executor(self.get_executor(), fit_forecast, group, rows, self.horizon)
+                for group, rows in series.items()
+            ])
+        models = {group: model_json for group, model_json, _ in results}
+        frames = {group: frame for group, _, frame in results}
+        await run_sync(self.save, scope, version, models, frames)
+        return frames
+
+    async def run_job(self, scope, version, load_series):
+        try:
+            frames = await self.train(scope, version, load_series)
+        except Exception as e:
+            self.record_failure(scope, version, e)
+            raise
+        finally:
+            self.jobs.pop((scope, version), None)
+        self.failures.pop((scope, version), None)
+        return frames
+
+    def record_failure(self, scope, version, error):
+        failures = self.failures.get((scope, version), (0, None, None))[0] + 1
+        delay = min(self.retry_seconds * 2 ** (failures - 1), self.retry_max_seconds)
+        # Failures of older versions are forgotten: new data gets a new attempt.
+        self.failures = {key: value for key, value in self.failures.items() if key[0] != scope or key[1] > version}
+        self.failures[(scope, version)] = (failures, time.monotonic() + delay, error)
+
+    def failure(self, scope, version):
+        # The exception of the last failed fit of this version while its retry delay runs.
+        failures, retry_at, error = self.failures.get((scope, version), (0, None, None))
+        return error if retry_at is not None and time.monotonic() < retry_at else None
+
+    def start(self, scope, version, load_series):
+        job = self.jobs.get((scope, version))
+        if job is None:
+            job = asyncio.ensure_future(self.run_job(scope, version, load_series))
+            self.jobs[(scope, version)] = job
+        return job
+
+    async def get(self, scope, version, load_series):
+        # Returns (frames, stale). While a new version trains, the previous
+        # forecast keeps being served and flagged as stale.
+        cached = self.results.get(scope)
+        if cached and cached[0] == version:
+            return cached[1], False
+
+        frames = await run_sync(self.load, scope, version)
+        if frames is not None:
+            self.results[scope] = (version, frames)
+            return frames, False
+
+        error = self.failure(scope, version) if (scope, version) not in self.jobs else None
+        if error is not None:
+            if cached:
+                return cached[1], True
+            raise error
+        job = self.start(scope, version, load_series)
+        if cached:
+            return cached[1], True
+        return await asyncio.shield(job), False
+
+    def stats(self):
+        return {
+            'failed': [
+                {'scope': scope, 'data_version': version, 'failures': failures,
+                 'retry_in': max(0.0, round(retry_at - time.monotonic(), 1)), 'error': str(error)}
+                for (scope, version), (failures, retry_at, error) in self.failures.items()
+            ]
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+def slice_forecast_frame(frame, periods):
+    last_observed = frame.loc[frame['y'].notna(), 'ds'].max()
+    return frame[frame['ds'] <= last_observed + pd.Timedelta(days=periods)]
+
+
+def slice_forecast(frame, periods):
+    frame = slice_forecast_frame(frame, periods)
+    return frame.astype(object).where(frame.notna(), None).to_dict(orient='records')
@@ -0,0 +1,207 @@
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from ingest import DATA_DIR, TABLES, detect_delimiter
+
+# Synthetic data: the four CSV files scaled by a factor. Every dimension row
+# gets `ceil(dimension_scale)` clones (clone 0 is the original row) and the
+# orders are replayed `scale` times against random clones, so customers,
+# products and postal codes keep their relationships, their share of the
+# orders and the category/region mix. Dates are jittered around the
+# original ones (seasonality is kept) and prices by a log-normal factor
+# applied to Sales and Profit alike (margins are kept).
+
+POSTAL_CODE_STEP = 100000
+CHUNK_ROWS = 500000
+
+
+def read_table(data_dir, name):
+    path = os.path.join(data_dir, TABLES[name]['file'])
+    return pd.read_csv(path, sep=detect_delimiter(path), dtype=TABLES[name]['dtypes'], encoding='utf-8')
+
+
+def write_table(frame, out_dir, name, sep, mode='w'):
+    path = os.path.join(out_dir, TABLES[name]['file'])
+    frame.to_csv(path, sep=sep, index=False, mode=mode, header=mode == 'w', encoding='utf-8')
+
+
+def clone_id(ids, k):
+    return ids if k == 0 else ids + f"-{k}"
+
+
+def clone_customers(customers, clones, rng):
+    # Clones get a new name mixed from the existing first and last names.
+    names = customers['Customer Name'].str.split(' ', n=1, expand=True)
+    first, last = names[0].to_numpy(), names[1].fillna('').to_numpy()
+    frames = [customers]
+    for k in range(1, clones):
+        frames.append(pd.DataFrame({
+            'Customer ID': clone_id(customers['Customer ID'], k),
+            'Customer Name': pd.Series(rng.choice(first, len(customers))) + ' ' + rng.choice(last, len(customers))
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def clone_products(products, clones):
+    # The KPIs group on Product Name, clones must not merge with their original.
+    frames = [products]
+    for k in range(1, clones):
+        frames.append(products.assign(**{
+            'Product ID': clone_id(products['Product ID'], k),
+            'Product Name': products['Product Name'] + f" #{k}"
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def clone_locations(locations, clones):
+    # Postal codes stay integers: clone k of 42420 is k * 100000 + 42420.
+    frames = [locations.assign(**{'Postal Code': locations['Postal Code'] + k * POSTAL_CODE_STEP})
+              for k in range(clones)]
+    return pd.concat(frames, ignore_index=True)
+
+
+class OrderReplayer:
+    # Replays the source orders once per call; a replay keeps the lines of
+    # an order together (same customer, postal code, dates, ship mode).
+
+    def __init__(self, orders, clones, jitter_days, price_sigma, rng):
+        self.orders = orders
+        self.clones = clones
+        self.jitter_days = jitter_days
+        self.price_sigma = price_sigma
+        self.rng = rng
+        self.order_index, self.order_ids = pd.factorize(orders['Order ID'])
+        parts = self.order_ids.str.rsplit('-', n=2)
+        self.id_prefix = parts.str[0] + '-' + parts.str[1] + '-'
+        self.id_number = parts.str[2]
+        self.order_date = pd.to_datetime(orders['Order Date'], utc=True)
+        self.ship_delay = pd.to_datetime(orders['Ship Date'], utc=True) - self.order_date
+        self.first_date = self.order_date.min()
+        self.last_date = self.order_date.max()
+
+    def replay(self, rep, fraction=1.0):
+        if rep == 0 and fraction >= 1.0:
+            return self.orders.copy()
+        rng = self.rng
+        n_orders = len(self.order_ids)
+        lines = np.ones(len(self.orders), dtype=bool)
+        if fraction < 1.0:
+            kept = rng.random(n_orders) < fraction
+            lines = kept[self.order_index]
+        index = self.order_index[lines]
+        orders = self.orders[lines]
+
+        # Per order: a customer clone (its postal code follows) and a date shift.
+        clone = rng.integers(0, self.clones, n_orders)[index]
+        shift = pd.to_timedelta(rng.integers(-self.jitter_days, self.jitter_days + 1, n_orders)[index], unit='D')
+        order_date = (self.order_date[lines] + shift).clip(self.first_date, self.last_date)
+        # Per line: a product clone and a price factor.
+        product_clone = rng.integers(0, self.clones, len(orders))
+        price = np.exp(rng.normal(0.0, self.price_sigma, len(orders)))
+
+        customer_ids = orders['Customer ID'] + np.where(clone > 0, '-' + clone.astype(str), '')
+        product_ids = orders['Product ID'] + np.where(product_clone > 0, '-' + product_clone.astype(str), '')
+        return pd.DataFrame({
+            'Row ID': 0,
+            'Order ID': (self.id_prefix[index] + str(rep) + self.id_number[index]).to_numpy(),
+            'Order Date': order_date.to_numpy(),
+            'Ship Date': (order_date + self.ship_delay[lines]).to_numpy(),
+            'Ship Mode': orders['Ship Mode'].to_numpy(),
+            'Customer ID': customer_ids.to_numpy(),
+            'Segment': orders['Segment'].to_numpy(),
+            'Postal Code': (orders['Postal Code'] + clone * POSTAL_CODE_STEP).to_numpy(),
+            'Product ID': product_ids.to_numpy(),
+            'Sales': (orders['Sales'] * price).round(4).to_numpy(),
+            'Quantity': orders['Quantity'].to_numpy(),
+            'Discount': orders['Discount'].to_numpy(),
+            'Profit': (orders['Profit'] * price).round(4).to_numpy()
+        })
+
+
+def format_dates(frame):
+    # Same ISO format as the source file; numpy formats ~10x faster than strftime.
+    for column in ('Order Date', 'Ship Date'):
+        values = pd.to_datetime(frame[column], utc=True).dt.tz_localize(None).to_numpy('datetime64[s]')
+        frame[column] = np.char.add(np.datetime_as_string(values, unit='s'), 'Z')
+    return frame
+
+
+def generate(data_dir=DATA_DIR, out_dir='data_synthetic', scale=10.0, dimension_scale=None, seed=0,
+             jitter_days=30, price_sigma=0.15, chunk_rows=CHUNK_ROWS):
+    if scale <= 0:
+        raise ValueError("scale must be positive")
+    dimension_scale = scale if dimension_scale is None else dimension_scale
+    clones = max(1, math.ceil(dimension_scale))
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    rows = {}
+
+    for name, clone in (('Customers', lambda df: clone_customers(df, clones, rng)),
+                        ('Products', lambda df: clone_products(df, clones)),
+                        ('Location', lambda df: clone_locations(df, clones))):
+        frame = clone(read_table(data_dir, name))
+        write_table(frame, out_dir, name, sep=';')
+        rows[name] = len(frame)
+
+    orders = read_table(data_dir, 'Orders')
+    replayer = OrderReplayer(orders, clones, jitter_days, price_sigma, rng)
+    reps = math.ceil(scale)
+    written = 0
+    buffer = []
+    buffered = 0
+    mode = 'w'
+    for rep in range(reps):
+        fraction = scale - rep if rep == reps - 1 else 1.0
+        frame = replayer.replay(rep, fraction)
+        buffer.append(frame)
+        buffered += len(frame)
+        if buffered >= chunk_rows or rep == reps - 1:
+            chunk = pd.concat(buffer, ignore_index=True)
+            chunk['Row ID'] = np.arange(written + 1, written + len(chunk) + 1)
+            write_table(format_dates(chunk), out_dir, 'Orders', sep=',', mode=mode)
+            written += len(chunk)
+            buffer, buffered, mode = [], 0, 'a'
+            print(f"Orders: {written} rows written ({written / (time.perf_counter() - start):,.0f} rows/s)")
+    rows['Orders'] = written
+
+    return {
+        'out_dir': out_dir,
+        'scale': scale,
+        'dimension_scale': dimension_scale,
+        'seed': seed,
+        'rows': rows,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a scaled synthetic copy of the CSV files.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--out-dir", default="data_synthetic")
+    parser.add_argument("--scale", type=float, default=10.0, help="orders multiplier (100 = ~1M orders)")
+    parser.add_argument("--dimension-scale", type=float, help="customers/products/postal codes multiplier (default: --scale)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jitter-days", type=int, default=30, help="order dates move by up to this many days")
+    parser.add_argument("--price-sigma", type=float, default=0.15, help="sigma of the log-normal price factor")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    report = generate(
+        data_dir=args.data_dir,
+        out_dir=args.out_dir,
+        scale=args.scale,
+        dimension_scale=args.dimension_scale,
+        seed=args.seed,
+        jitter_days=args.jitter_days,
+        price_sigma=args.price_sigma,
+        chunk_rows=args.chunk_rows
+    )
+    for name, count in report['rows'].items():
+        print(f"{name}: {count} rows")
+    print(f"Written to {report['out_dir']} in {report['seconds']}s")
@@ -0,0 +1,251 @@
+import argparse
+import csv
+import os
+import time
+
+import pandas as pd
+from pymongo import ASCENDING, ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from database import get_db
+from materialize import rebuild_orders_enriched, refresh_orders_enriched, create_enriched_indexes
+from rollups import rebuild_rollups, merge_into_rollups, rebuild_customer_rfm, merge_into_customer_rfm
+from sketches import rebuild_sketches, merge_into_sketches
+from cube import rebuild_cube, merge_into_cube
+from versioning import bump_data_version
+
+DATA_DIR = "data"
+CHUNK_SIZE = 50000
+
+# Dimensions are listed before Orders so freshly ingested orders can be
+# enriched against up-to-date dimension rows.
+TABLES = {
+    'Customers': {
+        'file': 'Customers_utf8.csv',
+        'key': ['Customer ID'],
+        'dtypes': {'Customer ID': 'string', 'Customer Name': 'string'},
+        'dates': []
+    },
+    'Products': {
+        'file': 'Products_utf8.csv',
+        # Product ID is not unique in the catalogue, the name disambiguates.
+        'key': ['Product ID', 'Product Name'],
+        'dtypes': {
+            'Product ID': 'string',
+            'Category': 'string',
+            'Sub-Category': 'string',
+            'Product Name': 'string'
+        },
+        'dates': []
+    },
+    'Location': {
+        'file': 'Location_utf8.csv',
+        'key': ['Postal Code', 'City'],
+        'dtypes': {
+            'Postal Code': 'Int64',
+            'City': 'string',
+            'State': 'string',
+            'Region': 'string',
+            'Country/Region': 'string'
+        },
+        'dates': []
+    },
+    'Orders': {
+        'file': 'Orders_utf8.csv',
+        'key': ['Row ID'],
+        'dtypes': {
+            'Row ID': 'Int64',
+            'Order ID': 'string',
+            'Ship Mode': 'string',
+            'Customer ID': 'string',
+            'Segment': 'string',
+            'Postal Code': 'Int64',
+            'Product ID': 'string',
+            'Sales': 'float64',
+            'Quantity': 'Int64',
+            'Discount': 'float64',
+            'Profit': 'float64'
+        },
+        'dates': ['Order Date', 'Ship Date']
+    }
+}
+
+# The unique indexes on the TABLES keys also serve the dimension lookups.
+INDEXES = {
+    'Orders': [
+        [('Order ID', ASCENDING)],
+        [('Order Date', ASCENDING)],
+        [('Customer ID', ASCENDING)],
+        [('Product ID', ASCENDING)],
+        [('Postal Code', ASCENDING)]
+    ]
+}
+
+# Every table is unique on its key: insert mode relies on the duplicate
+# key errors to skip rows already loaded, otherwise re-running the import
+# would load each dimension row again and multiply the joined KPIs.
+UNIQUE_INDEXES = {name: [(field, ASCENDING) for field in schema['key']] for name, schema in TABLES.items()}
+
+
+def detect_delimiter(path):
+    with open(path, encoding='utf-8') as f:
+        header = f.readline()
+    return csv.Sniffer().sniff(header, delimiters=';,').delimiter
+
+
+def read_chunks(path, schema, chunksize=CHUNK_SIZE):
+    reader = pd.read_csv(
+        path,
+        sep=detect_delimiter(path),
+        dtype=schema['dtypes'],
+        chunksize=chunksize,
+        encoding='utf-8'
+    )
+    for chunk in reader:
+        for column in schema['dates']:
+            chunk[column] = pd.to_datetime(chunk[column], utc=True).dt.tz_localize(None)
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        yield chunk.to_dict(orient='records')
+
+
+def create_unique_index(collection, keys):
+    # A non-unique index on the same keys (older imports) is replaced.
+    for index_name, info in collection.index_information().items():
+        if info['key'] == keys and not info.get('unique'):
+            collection.drop_index(index_name)
+    try:
+        collection.create_index(keys, unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        fields = ', '.join(field for field, _ in keys)
+        raise ValueError(
+            f"{collection.name} already holds several rows per ({fields}): reload it with --drop"
+        ) from e
+
+
+def create_indexes(db, name):
+    if name in UNIQUE_INDEXES:
+        create_unique_index(db[name], UNIQUE_INDEXES[name])
+    for keys in INDEXES.get(name, []):
+        db[name].create_index(keys)
+
+
+def write_batch(collection, docs, key, mode):
+    # Returns the documents actually written, duplicates skipped in insert
+    # mode are left out so incremental rollups never count them twice.
+    if mode == 'upsert':
+        operations = [
+            ReplaceOne({field: doc[field] for field in key}, doc, upsert=True)
+            for doc in docs
+        ]
+        collection.bulk_write(operations, ordered=False)
+        return docs
+    try:
+        collection.insert_many(docs, ordered=False)
+        return docs
+    except BulkWriteError as e:
+        # Duplicate keys (already loaded rows) are skipped, anything else is fatal.
+        errors = [err for err in e.details['writeErrors'] if err['code'] != 11000]
+        if errors:
+            raise
+        skipped = {err['index'] for err in e.details['writeErrors']}
+        return [doc for i, doc in enumerate(docs) if i not in skipped]
+
+
+def ingest_table(db, name, path, mode='insert', chunksize=CHUNK_SIZE, drop=False, on_batch=None):
+    schema = TABLES[name]
+    if drop:
+        db[name].drop()
+    create_indexes(db, name)
+
+    rows = written = 0
+    start = time.perf_counter()
+    for docs in read_chunks(path, schema, chunksize):
+        written_docs = write_batch(db[name], docs, schema['key'], mode)
+        written += len(written_docs)
+        rows += len(docs)
+        if on_batch and written_docs:
+            on_batch(written_docs)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {rows} rows read, {written} written ({rows / elapsed:,.0f} rows/s)")
+
+    elapsed = time.perf_counter() - start
+    return {
+        'table': name,
+        'rows': rows,
+        'written': written,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(rows / elapsed, 1) if elapsed else None
+    }
+
+
+def ingest(db, data_dir=DATA_DIR, tables=None, mode='insert', chunksize=CHUNK_SIZE, drop=False,
+           materialize=True):
+    tables = tables or list(TABLES)
+    dimensions_loaded = any(name != 'Orders' for name in tables)
+
+    # Incremental maintenance only makes sense when appending orders against
+    # unchanged dimensions, otherwise the derived collections are rebuilt once
+    # at the end. Upserts may overwrite rows already summed in the rollup, so
+    # the rollup is rebuilt in that case too.
+    incremental = materialize and not dimensions_loaded and not drop
+
+    def refresh_batch(docs):
+        match = {'Row ID': {'$in': [doc['Row ID'] for doc in docs]}}
+        refresh_orders_enriched(db, match)
+        if mode == 'insert':
+            merge_into_rollups(db, match)
+            merge_into_customer_rfm(db, match)
+            merge_into_sketches(db, match)
+            merge_into_cube(db, match)
+
+    if incremental:
+        # Collections built before the Row ID index get it before the first batch.
+        create_enriched_indexes(db)
+
+    reports = []
+    for name in TABLES:
+        if name not in tables:
+            continue
+        path = os.path.join(data_dir, TABLES[name]['file'])
+        on_batch = refresh_batch if incremental else None
+        reports.append(ingest_table(db, name, path, mode, chunksize, drop, on_batch))
+
+    if materialize and not incremental:
+        rebuild_orders_enriched(db)
+    if materialize and (not incremental or mode == 'upsert'):
+        rebuild_rollups(db)
+        rebuild_customer_rfm(db)
+        rebuild_sketches(db)
+        rebuild_cube(db)
+    # Cached KPI results are keyed by this version, bumping it invalidates them.
+    bump_data_version(db)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import the CSV files into MongoDB.")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--tables", nargs="+", choices=list(TABLES), default=list(TABLES))
+    parser.add_argument("--mode", choices=["insert", "upsert"], default="insert")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--drop", action="store_true", help="drop the collections before loading")
+    parser.add_argument("--no-materialize", action="store_true", help="do not refresh OrdersEnriched, SalesRollup, CustomerRFM, SalesSketches and SalesCube")
+    args = parser.parse_args()
+
+    reports = ingest(
+        get_db(),
+        data_dir=args.data_dir,
+        tables=args.tables,
+        mode=args.mode,
+        chunksize=args.chunksize,
+        drop=args.drop,
+        materialize=not args.no_materialize
+    )
+    total_rows = sum(r['rows'] for r in reports)
+    total_seconds = sum(r['seconds'] for r in reports)
+    for r in reports:
+        print(f"{r['table']}: {r['rows']} rows in {r['seconds']}s ({r['rows_per_second']} rows/s)")
+    if total_seconds:
+        print(f"Total: {total_rows} rows in {total_seconds:.3f}s ({total_rows / total_seconds:,.0f} rows/s)")
@@ -0,0 +1,201 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import random
+import time
+from collections import deque
+
+from config import SLOW_QUERY_MS, QUERY_EXPLAIN_SAMPLE_RATE
+from metrics import QUERY_DURATION
+
+slow_query_logger = logging.getLogger("queries.slow")
+logger = logging.getLogger(__name__)
+
+# Name of the KPI (pipeline function, bundle...) issuing the current queries.
+current_label = contextvars.ContextVar("query_label", default=None)
+
+
+def configure_slow_query_log(path):
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    slow_query_logger.addHandler(handler)
+
+
+async def labelled(label, awaitable):
+    token = current_label.set(label)
+    try:
+        return await awaitable
+    finally:
+        current_label.reset(token)
+
+
+def shape(value):
+    # The pipeline with its literals blanked out: date bounds, cursors and
+    # limits do not split the statistics of one KPI.
+    if isinstance(value, dict):
+        return {key: shape(v) for key, v in value.items()}
+    if isinstance(value, list):
+        return [shape(v) for v in value]
+    if isinstance(value, str) and value.startswith('$'):
+        return value
+    return '?'
+
+
+def fingerprint(collection, pipeline):
+    raw = json.dumps([collection, shape(pipeline)], sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()[:12]
+
+
+def summarize_explain(plan):
+    # Works across server versions: sums every totalDocsExamined/Keys and
+    # collects the index scans found anywhere in the explain output.
+    summary = {'docs_examined': 0, 'keys_examined': 0, 'indexes': set(), 'collection_scan': False}
+
+    def walk(node):
+        if isinstance(node, list):
+            for value in node:
+                walk(value)
+            return
+        if not isinstance(node, dict):
+            return
+        summary['docs_examined'] += node.get('totalDocsExamined', 0) or 0
+        summary['keys_examined'] += node.get('totalKeysExamined', 0) or 0
+        if node.get('stage') == 'IXSCAN' and node.get('indexName'):
+            summary['indexes'].add(node['indexName'])
+        if node.get('stage') == 'COLLSCAN' or (node.get('collectionScans') or 0) > 0:
+            summary['collection_scan'] = True
+        for name in node.get('indexesUsed') or []:
+            summary['indexes'].add(name)
+        for key, value in node.items():
+            if key not in ('rejectedPlans', 'allPlansExecution'):
+                walk(value)
+
+    walk(plan)
+    summary['indexes'] = sorted(summary['indexes'])
+    return summary
+
+
+class QueryStats:
+
+    def __init__(self, slow_ms=SLOW_QUERY_MS, explain_rate=QUERY_EXPLAIN_SAMPLE_RATE, recent=100):
+        self.slow_ms = slow_ms
+        self.explain_rate = explain_rate
+        self.entries = {}
+        self.slow = deque(maxlen=recent)
+
+    def record(self, operation, collection, pipeline, seconds, returned):
+        # Returns True when the query shape should be explained.
+        QUERY_DURATION.observe(operation, collection, value=seconds)
+        key = fingerprint(collection, pipeline)
+        label = current_label.get() or f"{operation} {collection}"
+        ms = seconds * 1000
+        entry = self.entries.get(key)
+        first = entry is None
+        if first:
+            entry = self.entries[key] = {
+                'fingerprint': key,
+                'label': label,
+                'operation': operation,
+                'collection': collection,
+                'count': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'returned': 0,
+                'explain': None,
+                'pipeline': pipeline
+            }
+        entry['count'] += 1
+        entry['total_ms'] += ms
+        entry['max_ms'] = max(entry['max_ms'], ms)
+        entry['returned'] += returned
+        entry['pipeline'] = pipeline
+
+        if ms >= self.slow_ms:
+            slow = {'at': time.time(), 'label': label, 'collection': collection,
+                    'ms': round(ms, 1), 'returned': returned, 'fingerprint': key}
+            self.slow.append(slow)
+            slow_query_logger.warning(
+                "%s on %s took %.0f ms (%d documents): %s",
+                label, collection, ms, returned, json.dumps(pipeline, default=str)
+            )
+        return operation == 'aggregate' and (first or random.random() < self.explain_rate)
+
+    def set_explain(self, collection, pipeline, summary):
+        entry = self.entries.get(fingerprint(collection, pipeline))
+        if entry is not None:
+            entry['explain'] = summary
+
+    def top(self, limit=20, sort='total_ms'):
+        entries = sorted(self.entries.values(), key=lambda entry: entry[sort], reverse=True)
+        return [
+            {
+                **{k: v for k, v in entry.items() if k != 'pipeline'},
+                'total_ms': round(entry['total_ms'], 1),
+                'max_ms': round(entry['max_ms'], 1),
+                'avg_ms': round(entry['total_ms'] / entry['count'], 1),
+                'avg_returned': round(entry['returned'] / entry['count'], 1),
+                'pipeline': entry['pipeline']
+            }
+            for entry in entries[:limit]
+        ]
+
+    def reset(self):
+        count = len(self.entries)
+        self.entries.clear()
+        self.slow.clear()
+        return count
+
+
+class InstrumentedBackend:
+    # Wraps a backend: times every aggregate/find/stream, counts returned
+    # documents and explains a sample of the aggregations in the background.
+
+    def __init__(self, backend, stats):
+        self.backend = backend
+        self.stats = stats
+        self.explains = set()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def explain_later(self, collection, pipeline):
+        explain = getattr(self.backend, 'explain', None)
+        if explain is None:
+            return
+
+        async def run():
+            try:
+                plan = await explain(collection, pipeline)
+                self.stats.set_explain(collection, pipeline, summarize_explain(plan))
+            except Exception:
+                logger.exception("Explain failed on %s", collection)
+
+        task = asyncio.ensure_future(run())
+        self.explains.add(task)
+        task.add_done_callback(self.explains.discard)
+
+    async def aggregate(self, collection, pipeline):
+        start = time.perf_counter()
+        result = await self.backend.aggregate(collection, pipeline)
+        if self.stats.record('aggregate', collection, pipeline, time.perf_counter() - start, len(result)):
+            self.explain_later(collection, pipeline)
+        return result
+
+    async def find(self, collection, filter=None):
+        start = time.perf_counter()
+        result = await self.backend.find(collection, filter)
+        pipeline = [{'$match': filter}] if filter else []
+        self.stats.record('find', collection, pipeline, time.perf_counter() - start, len(result))
+        return result
+
+    async def stream(self, collection, pipeline):
+        start = time.perf_counter()
+        returned = 0
+        try:
+            async for document in self.backend.stream(collection, pipeline):
+                returned += 1
+                yield document
+        finally:
+            self.stats.record('stream', collection, pipeline, time.perf_counter() - start, returned)
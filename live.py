@@ -0,0 +1,334 @@
+import asyncio
+import logging
+
+import pandas as pd
+from pymongo.errors import OperationFailure, PyMongoError
+
+from config import LIVE_UPDATES, LIVE_POLL_SECONDS, LIVE_BATCH_SIZE, LIVE_QUEUE_SIZE
+from database import get_db, run_sync
+from responses import dumps
+from versioning import get_data_state, get_orders_high_water
+
+# Live KPIs for /kpi/stream. The totals and group-bys below are held in
+# memory: a snapshot is computed once per data version (the same bundle as
+# the dashboard), then every order line inserted into Orders is joined to
+# the cached dimension tables and added to them. Clients receive Server-Sent
+# Events: a `snapshot` with every value, then `delta` events carrying only
+# the rows that changed, with their new totals (applying one twice is
+# harmless). Inserts are followed from where the data version of the
+# snapshot ends (recorded in Meta when it is bumped): through a change
+# stream started at the cluster time of the bump (replica set) or, on a
+# standalone server, by polling Orders above its highest Row ID. Updates
+# and deletes are not followed: ingest bumps the data version at the end
+# of every run, which recomputes the snapshot and corrects drift.
+
+ORDERS_COLLECTION = 'Orders'
+ORDER_FIELDS = ['Row ID', 'Customer ID', 'Product ID', 'Postal Code', 'Sales', 'Profit']
+# A start time older than the oplog.
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# metric -> (joined dimension column or None for a total, measure, result field)
+LIVE_METRICS = {
+    'total-sales': (None, 'Sales', 'total_sales'),
+    'total-profit': (None, 'Profit', 'total_profit'),
+    'sales-by-region': ('Region', 'Sales', 'total_sales'),
+    'sales-by-state': ('State', 'Sales', 'total_sales'),
+    'sales-by-category': ('Category', 'Sales', 'total_sales'),
+    'profit-by-category': ('Category', 'Profit', 'total_profit')
+}
+
+logger = logging.getLogger(__name__)
+
+
+def compute_deltas(documents, tables):
+    # Same inner joins as the KPIs on Orders ($lookup + $unwind): an order
+    # line counts once per matching customer, product and location row.
+    orders = pd.DataFrame(documents, columns=ORDER_FIELDS)
+    joined = orders.merge(
+        tables['Customers'][['Customer ID']], on='Customer ID'
+    ).merge(
+        tables['Products'][['Product ID', 'Category']], on='Product ID'
+    ).merge(
+        tables['Location'][['Postal Code', 'Region', 'State']], on='Postal Code'
+    )
+    deltas = {}
+    for metric, (column, measure, _) in LIVE_METRICS.items():
+        if column is None:
+            deltas[metric] = {None: float(orders[measure].sum())}
+        else:
+            deltas[metric] = {key: float(value) for key, value in joined.groupby(column)[measure].sum().items()}
+    return deltas
+
+
+def format_event(sequence, event, payload):
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (sequence, event.encode(), dumps(payload))
+
+
+def get_start():
+    # (highest Row ID, cluster time) of the current data version. Versions
+    # bumped before they were recorded fall back to the current Orders.
+    db = get_db()
+    state = get_data_state(db)
+    if 'orders_high_water' not in state:
+        return get_orders_high_water(db), None
+    return state['orders_high_water'], state.get('operation_time')
+
+
+class ChangeStreamSource:
+    # Inserts into Orders, read from a change stream; MongoDB only opens
+    # change streams on replica sets (a single-node one is enough).
+    name = 'changestream'
+
+    def __init__(self, batch_size=LIVE_BATCH_SIZE, await_seconds=LIVE_POLL_SECONDS):
+        self.batch_size = batch_size
+        self.await_ms = int(await_seconds * 1000)
+        self.stream = None
+
+    def open(self, start_at=None):
+        if self.stream is None:
+            try:
+                self.stream = self.watch(start_at)
+            except OperationFailure as e:
+                if start_at is None or e.code != CHANGE_STREAM_HISTORY_LOST:
+                    raise
+                logger.warning("Inserts since the data version are no longer in the oplog, following new ones")
+                self.stream = self.watch(None)
+
+    def watch(self, start_at):
+        return get_db()[ORDERS_COLLECTION].watch(
+            [{'$match': {'operationType': 'insert'}}], max_await_time_ms=self.await_ms,
+            start_at_operation_time=start_at
+        )
+
+    def next_batch(self, high_water):
+        # Blocks up to `await_seconds` when nothing was inserted.
+        self.open()
+        documents = []
+        while len(documents) < self.batch_size:
+            change = self.stream.try_next()
+            if change is None:
+                break
+            documents.append(change['fullDocument'])
+        return documents
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class PollingSource:
+    # Orders above the highest Row ID applied, through its unique index.
+    name = 'poll'
+
+    def __init__(self, batch_size=LIVE_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def open(self, start_at=None):
+        pass
+
+    def next_batch(self, high_water):
+        cursor = get_db()[ORDERS_COLLECTION].find(
+            {'Row ID': {'$gt': high_water}}, {field: 1 for field in ORDER_FIELDS}
+        ).sort('Row ID').limit(self.batch_size)
+        return list(cursor)
+
+    def close(self):
+        pass
+
+
+def create_source(mode):
+    if mode in ('auto', 'changestream'):
+        return ChangeStreamSource()
+    if mode == 'poll':
+        return PollingSource()
+    return None
+
+
+class LiveFeed:
+    # `snapshot()` returns the bundle of LIVE_METRICS for the current data
+    # version, `load_tables(version)` the dimension tables. The feed runs
+    # in the background from the first subscriber on.
+
+    def __init__(self, snapshot, load_tables, current_version, mode=LIVE_UPDATES,
+                 poll_seconds=LIVE_POLL_SECONDS, queue_size=LIVE_QUEUE_SIZE):
+        self.snapshot = snapshot
+        self.load_tables = load_tables
+        self.current_version = current_version
+        self.mode = mode
+        self.source = create_source(mode)
+        self.poll_seconds = poll_seconds
+        self.queue_size = queue_size
+        self.version = None
+        self.high_water = 0
+        self.values = {}
+        self.sequence = 0
+        self.snapshot_message = None
+        self.subscribers = set()
+        self.task = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    def current(self):
+        # The `snapshot` event of the current state, rendered once per change.
+        if self.version is None:
+            return None
+        if self.snapshot_message is None:
+            metrics = {}
+            for metric, (column, _, field) in LIVE_METRICS.items():
+                rows = [{'_id': key, field: value} for key, value in self.values.get(metric, {}).items()]
+                if column is None:
+                    metrics[metric] = rows[0] if rows else {'_id': None, field: 0}
+                else:
+                    metrics[metric] = sorted(rows, key=lambda row: row[field], reverse=True)
+            payload = {'data_version': self.version, 'high_water': self.high_water, 'metrics': metrics}
+            self.snapshot_message = format_event(self.sequence, 'snapshot', payload)
+        return self.snapshot_message
+
+    def publish(self, event, payload):
+        self.sequence += 1
+        self.snapshot_message = None
+        message = format_event(self.sequence, event, payload)
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A client too slow to keep up skips to the current state.
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(self.current())
+
+    async def refresh(self, version):
+        # The snapshot holds the orders of the data version: the change
+        # stream is reopened at the bump of that version, polling resumes
+        # above its highest Row ID.
+        if self.source is not None:
+            high_water, start_at = await run_sync(get_start)
+            await run_sync(self.source.close)
+            await self.open_source(start_at)
+        else:
+            high_water = 0
+        bundle = await self.snapshot()
+        self.values = {}
+        for metric, (column, _, field) in LIVE_METRICS.items():
+            result = bundle.get(metric)
+            rows = [result] if column is None else result or []
+            self.values[metric] = {row.get('_id'): row.get(field, 0) for row in rows if row}
+        self.version = version
+        self.high_water = high_water
+        self.sequence += 1
+        self.snapshot_message = None
+        self.publish_current()
+
+    def publish_current(self):
+        message = self.current()
+        for queue in list(self.subscribers):
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def apply(self, documents):
+        # Every insert of the change stream is new, whatever its Row ID
+        # (ingest takes it from the CSV); polled ones may repeat a batch.
+        if self.source is None or self.source.name == 'poll':
+            documents = [doc for doc in documents if (doc.get('Row ID') or 0) > self.high_water]
+        if not documents:
+            return
+        tables = await self.load_tables(self.version)
+        deltas = await run_sync(compute_deltas, documents, tables)
+        self.high_water = max([self.high_water] + [doc.get('Row ID') or 0 for doc in documents])
+        changes = {}
+        for metric, values in deltas.items():
+            column, _, field = LIVE_METRICS[metric]
+            current = self.values.setdefault(metric, {})
+            rows = []
+            for key, delta in values.items():
+                current[key] = current.get(key, 0) + delta
+                rows.append({'_id': key, field: current[key]})
+            if rows:
+                changes[metric] = rows[0] if column is None else rows
+        self.publish('delta', {
+            'data_version': self.version, 'high_water': self.high_water, 'rows': len(documents), 'changes': changes
+        })
+
+    def fall_back(self, error):
+        # With `auto`, a standalone server (no change streams) is polled instead.
+        if self.mode != 'auto' or self.source.name != 'changestream':
+            return False
+        logger.info("Change streams unavailable (%s), polling Orders instead", error)
+        self.source.close()
+        self.source = PollingSource()
+        return True
+
+    async def open_source(self, start_at=None):
+        # watch() runs the $changeStream aggregate at once: it fails here.
+        try:
+            await run_sync(self.source.open, start_at)
+        except OperationFailure as e:
+            if not self.fall_back(e):
+                raise
+            await run_sync(self.source.open, start_at)
+
+    async def step(self):
+        version = await self.current_version()
+        if version != self.version:
+            await self.refresh(version)
+        if self.source is None:
+            await asyncio.sleep(self.poll_seconds)
+            return
+        try:
+            documents = await run_sync(self.source.next_batch, self.high_water)
+        except OperationFailure as e:
+            if not self.fall_back(e):
+                raise
+            self.version = None
+            return
+        if documents:
+            await self.apply(documents)
+        elif self.source.name == 'poll':
+            await asyncio.sleep(self.poll_seconds)
+
+    async def run(self):
+        while self.subscribers:
+            try:
+                await self.step()
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError:
+                # Inserts may have been missed: start again from a snapshot.
+                logger.exception("Live feed interrupted")
+                if self.source is not None:
+                    self.source.close()
+                self.version = None
+                await asyncio.sleep(self.poll_seconds)
+            except Exception:
+                logger.exception("Live feed failed")
+                self.version = None
+                await asyncio.sleep(self.poll_seconds)
+        # Inserts are not followed without subscribers.
+        if self.source is not None:
+            await run_sync(self.source.close)
+        self.version = None
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.source is not None:
+            self.source.close()
+
+    def stats(self):
+        return {
+            'mode': self.source.name if self.source is not None else 'off',
+            'subscribers': len(self.subscribers),
+            'data_version': self.version,
+            'high_water': self.high_water,
+            'sequence': self.sequence
+        }
@@ -1,260 +1,962 @@
-from fastapi import FastAPI, HTTPException
-from pymongo import MongoClient
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pymongo.errors import ExecutionTimeout
 import pandas as pd
 import uvicorn
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
-from typing import Optional
+from pydantic import BaseModel
+from typing import Optional, List
+from datetime import date, datetime, time, timedelta
+from contextlib import asynccontextmanager
 from pipelines import *
-import pickle
+from database import run_sync, close, get_round_trip_times
+from versioning import data_version
+from backends import create_backend
+from cache import ResultCache
+from pagination import decode_cursor, split_page, ndjson_response
+from responses import ORJSONResponse, respond, wants_arrow
+from forecast import ForecastService, slice_forecast, slice_forecast_frame, TOTAL_GROUP
+from rfm import RFMMatrix
+from model_registry import RFMModelRegistry, score_customers
+from optimizer import split_pipeline, find_unique_lookups, results_match
+from dimensions import DimensionCache, join_locally
+from sketches import (
+    SketchStore, SKETCH_DIMENSIONS, get_approx_distinct_counts, get_approx_basket_distribution,
+    get_exact_basket_distribution, get_approx_average_basket, get_approx_average_basket_by_region
+)
+from cube import nearest_cuboid, to_cells, to_dense
+from shared_state import SharedState
+from live import LiveFeed, LIVE_METRICS
+from concurrency import SingleFlight, Overloaded, create_limiters
+from metrics import registry, CallbackMetric, MetricsMiddleware, CONTENT_TYPE
+from instrumentation import QueryStats, InstrumentedBackend, labelled, configure_slow_query_log
+from config import (
+    ELBOW_MAX_K, PIPELINE_OPTIMIZER, PIPELINE_OPTIMIZER_VERIFY, DIMENSION_JOINS, SLOW_QUERY_LOG,
+    METRICS_ENABLED, CUBE_MAX_DENSE_CELLS, API_HOST, API_PORT, WEB_WORKERS, SHARED_STATE, SHARED_STATE_DIR,
+    LIVE_UPDATES, LIVE_HEARTBEAT_SECONDS
+)
+import asyncio
+import logging
 import os
 
-app = FastAPI()
-client = MongoClient("mongodb://localhost:27017/")
-db = client['ecommerce']
-MODEL_PATH = "model_rfm.pkl"
+FORECAST_GROUPS = {
+    'category': 'product_details.Category',
+    'region': 'location_details.Region'
+}
+
+logger = logging.getLogger(__name__)
+if SLOW_QUERY_LOG:
+    configure_slow_query_log(SLOW_QUERY_LOG)
+query_stats = QueryStats()
+backend = InstrumentedBackend(create_backend(), query_stats)
+data_version.loader = backend.data_version
+forecasts = ForecastService()
+rfm_matrix = RFMMatrix()
+rfm_models = RFMModelRegistry()
+# Workers of one host share their warm state, per backend.
+shared_state = SharedState(os.path.join(SHARED_STATE_DIR, backend.name)) if SHARED_STATE else None
+dimensions = DimensionCache(shared=shared_state)
+sketch_store = SketchStore()
+# The arrow backend already joins in process, over the same frames.
+local_joins = DIMENSION_JOINS and backend.name == 'mongo'
+
+
+async def load_forecast_series(scope):
+    source = await get_kpi_source(SOURCE_ROLLUP)
+    collection = SOURCE_COLLECTIONS[source]
+    if scope == TOTAL_GROUP:
+        rows = await backend.aggregate(collection, get_sales_by_date_pipeline(source=source))
+        return {TOTAL_GROUP: [(row['_id'], row['total_ventes']) for row in rows]}
+
+    rows = await backend.aggregate(
+        collection,
+        get_sales_by_date_and_group_pipeline(FORECAST_GROUPS[scope], source=source)
+    )
+    series = {}
+    for row in rows:
+        series.setdefault(row['_id']['group'], []).append((row['_id']['date'], row['total_ventes']))
+    return series
+
+
+async def warm_forecast():
+    try:
+        version = await data_version.current()
+        await forecasts.get(TOTAL_GROUP, version, lambda: load_forecast_series(TOTAL_GROUP))
+    except Exception:
+        logger.exception("Forecast training failed")
+
+
+def load_backend():
+    # Workers start together: one builds the missing derived collections
+    # (or Parquet files), the others wait and find them built.
+    if shared_state is None:
+        return backend.load()
+    with shared_state.lock('load'):
+        return backend.load()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await run_sync(load_backend)
+    warmup = asyncio.create_task(warm_forecast())
+    yield
+    warmup.cancel()
+    live_feed.close()
+    forecasts.close()
+    close()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+
+kpi_cache = ResultCache()
+# Identical computations in flight are shared; expensive ones are limited per endpoint.
+flights = SingleFlight()
+limiters = create_limiters()
+
+
+CallbackMetric(
+    'kpi_cache_lookups_total', 'KPI cache lookups by outcome.',
+    lambda: {(outcome,): kpi_cache.stats()[outcome] for outcome in ('hits', 'misses')}, ['outcome'],
+    type='counter'
+)
+CallbackMetric('kpi_cache_hit_ratio', 'Share of KPI cache lookups served from the cache.',
+              lambda: {(): kpi_cache.stats()['hit_ratio']})
+CallbackMetric('kpi_cache_entries', 'Entries in the KPI cache.', lambda: {(): kpi_cache.stats()['size']})
+CallbackMetric('concurrency_limit_waiting', 'Requests queued for a slot, by endpoint.',
+               lambda: {(name, ): limiter.waiting for name, limiter in limiters.items()}, ['endpoint'])
+CallbackMetric('concurrency_limit_running', 'Computations running, by endpoint.',
+               lambda: {(name, ): limiter.running for name, limiter in limiters.items()}, ['endpoint'])
+CallbackMetric('mongo_round_trip_seconds', 'Heartbeat round trip to each MongoDB server.',
+              lambda: {(server,): rtt for server, rtt in get_round_trip_times().items()}, ['server'])
+
+
+async def run_cached(key, compute):
+    version = await data_version.current()
+    key = key + (version,)
+    found, result = kpi_cache.get(key)
+    if found:
+        return result
+    return await flights.run(key, lambda: compute_cached(key, version, compute))
+
+
+async def compute_cached(key, version, compute):
+    if shared_state is not None:
+        found, result = await run_sync(shared_state.get, 'kpi', version, key, kpi_cache.ttl)
+        if found:
+            kpi_cache.set(key, result)
+            return result
+    result = await compute()
+    kpi_cache.set(key, result)
+    if shared_state is not None:
+        await run_sync(shared_state.set, 'kpi', version, key, result)
+    return result
+
+
+async def get_unique_lookups(source):
+    lookups = [stage['$lookup'] for stage in get_source_pipeline(source) if '$lookup' in stage]
+    return await run_cached(
+        ('unique-lookups', source),
+        lambda: labelled('unique-lookups', find_unique_lookups(backend.aggregate, SOURCE_COLLECTIONS[source], lookups))
+    )
+
+
+async def get_kpi_source(source):
+    # SalesRollup rows carry no customer: they stand for Orders only while
+    # every order matches exactly one customer. Otherwise (orphaned or
+    # duplicated customers) the KPIs are computed from Orders.
+    if source == SOURCE_ROLLUP and 'customer_details' not in await get_unique_lookups(SOURCE_ORDERS):
+        return SOURCE_ORDERS
+    return source
+
+
+async def get_dimensions():
+    return await dimensions.get(await data_version.current(), backend.find)
+
+
+async def run_approx(key, query):
+    # Approximate KPIs only merge the in-memory sketches of the days asked for.
+    store = await sketch_store.get(await data_version.current(), lambda: backend.find(SKETCH_COLLECTION))
+    return await run_cached(('approx',) + key, lambda: run_sync(query, store))
+
+
+async def run_split(collection, split):
+    pre_group, rest = split
+    documents = await backend.aggregate(collection, pre_group)
+    return await run_sync(join_locally, documents, rest, await get_dimensions())
+
+
+async def run_pipeline(pipeline, source):
+    # OrdersEnriched has no joins. Orders and SalesRollup pipelines are
+    # pre-grouped on the join keys; with local joins the server only runs
+    # the pre-group and the joins happen here, otherwise it runs both parts.
+    collection = SOURCE_COLLECTIONS[source]
+    if source == SOURCE_ENRICHED or not (PIPELINE_OPTIMIZER or local_joins):
+        return await backend.aggregate(collection, pipeline)
+
+    split = split_pipeline(pipeline, await get_unique_lookups(source))
+    if split is None:
+        return await backend.aggregate(collection, pipeline)
+    if local_joins:
+        result = await run_split(collection, split)
+    else:
+        result = await backend.aggregate(collection, split[0] + split[1])
+
+    if PIPELINE_OPTIMIZER_VERIFY:
+        expected = await backend.aggregate(collection, pipeline)
+        if not results_match(expected, result):
+            logger.error("Optimized pipeline differs from the original: %s", pipeline)
+            return expected
+    return result
+
+
+async def run_kpi(pipeline_fn, *args, source=SOURCE_ROLLUP):
+    source = await get_kpi_source(source)
+    return await run_cached(
+        (pipeline_fn.__name__, args, source),
+        lambda: labelled(pipeline_fn.__name__, run_pipeline(pipeline_fn(*args, source=source), source))
+    )
+
+
+# (sort field, direction) pairs for keyset pagination, the last one unique.
+SALES_BY_PRODUCT_KEYS = [('total_sales', -1), ('_id', 1)]
+PROFIT_BY_PRODUCT_KEYS = [('total_profit', -1), ('_id', 1)]
+SALES_MATRIX_KEYS = [('total_sales', -1), ('_id.product', 1), ('_id.region', 1)]
+RFM_DATA_KEYS = [('_id', 1)]
+
+
+async def run_page(request, collection, pipeline, keys, cache_key, limit=None, after=None, format="json",
+                   transform=None, source=None):
+    # Cursor pagination (`limit`/`after`) or NDJSON streaming for result sets
+    # that grow with the product and customer catalogues.
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be json or ndjson")
+    cursor = decode_cursor(after)
+    if cursor is not None and len(cursor) != len(keys):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if format == "ndjson":
+        pipeline = get_paginated_pipeline(pipeline, keys, cursor)
+        if limit is not None:
+            pipeline.append({'$limit': limit})
+        return ndjson_response(backend.stream(collection, pipeline), transform)
+
+    pipeline = get_paginated_pipeline(pipeline, keys, cursor, limit)
+    rows = await run_cached(
+        cache_key + ('page', limit, after),
+        lambda: labelled(
+            cache_key[0],
+            run_pipeline(pipeline, source) if source is not None else backend.aggregate(collection, pipeline)
+        )
+    )
+    rows, next_cursor = split_page(rows, keys, limit, transform)
+    return respond(request, rows, next=next_cursor)
+
+
+async def run_kpi_page(request, pipeline_fn, keys, limit=None, after=None, format="json",
+                       source=SOURCE_ROLLUP):
+    source = await get_kpi_source(source)
+    return await run_page(
+        request, SOURCE_COLLECTIONS[source], pipeline_fn(source=source), keys,
+        (pipeline_fn.__name__, source), limit, after, format, source=source
+    )
+
+
+# metric name -> (pipeline function, takes a limit, default for single-document KPIs)
+BUNDLE_METRICS = {
+    'total-sales': (get_total_sales_pipeline, False, {"total_sales": 0}),
+    'date-range': (get_date_range_pipeline, False, {"first_date": None, "last_date": None}),
+    'average-basket': (get_average_basket_pipeline, False, {"average_basket": 0}),
+    'sales-per-dates': (get_sales_by_date_pipeline, False, None),
+    'sales-by-state': (get_sales_by_state_pipeline, False, None),
+    'sales-by-category': (get_sales_by_category_pipeline, False, None),
+    'sales-by-product': (get_sales_by_product_pipeline, False, None),
+    'sales-by-region': (get_sales_by_region_pipeline, False, None),
+    'sales-by-location': (get_sales_by_location_pipeline, False, None),
+    'total-profit': (get_total_profit_pipeline, False, {"total_profit": 0}),
+    'profit-by-category': (get_profit_by_category_pipeline, False, None),
+    'profit-by-product': (get_profit_by_product_pipeline, False, None),
+    'top-profitable-products': (get_top_profitable_products_pipeline, True, None),
+    'average-basket-by-state': (get_average_basket_by_state_pipeline, False, None),
+    'average-basket-by-category': (get_average_basket_by_category_pipeline, False, None),
+    'top-categories': (get_top_categories_pipeline, True, None),
+    'top-products-by-quantity': (get_top_products_by_quantity_pipeline, True, None)
+}
+
+BUNDLE_PAGES = {
+    'ventes': ['total-sales', 'average-basket', 'date-range', 'sales-by-state', 'sales-by-category'],
+    'profits': ['total-profit', 'profit-by-category', 'profit-by-product'],
+    'produits': ['sales-by-product', 'top-products-by-quantity', 'top-categories']
+}
+
+
+async def run_bundle(metrics, limit, source=SOURCE_ROLLUP):
+    source = await get_kpi_source(source)
+    pipelines = {}
+    for name in metrics:
+        pipeline_fn, takes_limit, _ = BUNDLE_METRICS[name]
+        args = (limit,) if takes_limit else ()
+        pipelines[name] = pipeline_fn(*args, source=source)
+
+    async def compute():
+        splits = {}
+        if local_joins and source != SOURCE_ENRICHED:
+            unique_lookups = await get_unique_lookups(source)
+            splits = {name: split_pipeline(pipeline, unique_lookups) for name, pipeline in pipelines.items()}
+            splits = {name: split for name, split in splits.items() if split is not None}
+        server_pipelines = {
+            name: splits[name][0] if name in splits else pipeline for name, pipeline in pipelines.items()
+        }
+        result = await backend.aggregate(SOURCE_COLLECTIONS[source], get_bundle_pipeline(server_pipelines))
+        facets = result[0] if result else {}
+        if splits:
+            tables = await get_dimensions()
+            for name, (_, rest) in splits.items():
+                facets[name] = await run_sync(join_locally, facets.get(name, []), rest, tables)
+        data = {}
+        for name in metrics:
+            rows = facets.get(name, [])
+            default = BUNDLE_METRICS[name][2]
+            data[name] = (rows[0] if rows else default) if default is not None else rows
+        return data
+
+    return await run_cached(
+        ('bundle', tuple(metrics), limit, source),
+        lambda: labelled(f"bundle({','.join(metrics)})", compute())
+    )
+
+
+# Orders files are static for the arrow backend: only data versions are followed.
+live_feed = LiveFeed(
+    lambda: run_bundle(list(LIVE_METRICS), 5),
+    lambda version: dimensions.get(version, backend.find),
+    data_version.current,
+    mode=LIVE_UPDATES if backend.name == 'mongo' else 'off'
+)
+CallbackMetric('live_stream_subscribers', 'Clients connected to /kpi/stream.',
+               lambda: {(): len(live_feed.subscribers)})
+
+
+def get_date_bounds(start, end):
+    if start is not None and end is not None and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+    # `end` is inclusive: the range stops at midnight the day after.
+    start_date = datetime.combine(start, time()) if start else None
+    end_date = datetime.combine(end + timedelta(days=1), time()) if end else None
+    return start_date, end_date
+
+
+def get_sketch_dimension(by):
+    if by not in SKETCH_DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown dimension: {by}")
+    return SKETCH_DIMENSIONS[by]
+
+
+def parse_quantiles(quantiles):
+    try:
+        values = [float(q) for q in quantiles.split(",") if q.strip()]
+    except ValueError:
+        values = None
+    if not values or not all(0 <= q <= 1 for q in values):
+        raise HTTPException(status_code=400, detail="quantiles must be numbers between 0 and 1")
+    return values
+
+
+def parse_cube_dimensions(value):
+    dimensions = [d.strip() for d in value.split(",") if d.strip()]
+    unknown = [d for d in dimensions if d not in CUBE_DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown dimension: {', '.join(unknown)}")
+    return dimensions
+
+
+def parse_cube_filters(filters):
+    # `dimension:value`, repeatable; values of one dimension are ORed.
+    parsed = {}
+    for item in filters:
+        dimension, _, value = item.partition(":")
+        parse_cube_dimensions(dimension)
+        if dimension == "month":
+            try:
+                value = datetime.strptime(value, "%Y-%m")
+            except ValueError:
+                raise HTTPException(status_code=400, detail="month filters are YYYY-MM")
+        parsed.setdefault(dimension, []).append(value)
+    return parsed
+
+
+async def get_cube_catalog():
+    rows = await run_cached(('cube-catalog',), lambda: backend.aggregate(CUBE_COLLECTION, get_cube_catalog_pipeline()))
+    return {row['_id']: row['rows'] for row in rows}
+
+
+async def limited(endpoint, compute):
+    limiter = limiters.get(endpoint)
+    return await (limiter.run(compute) if limiter is not None else compute())
+
+
+def http_error(e):
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, ExecutionTimeout):
+        return HTTPException(status_code=504, detail="Query timed out")
+    if isinstance(e, Overloaded):
+        return HTTPException(status_code=e.status, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/admin/materialize")
+async def materialize_orders():
+    try:
+        counts, version = await run_sync(backend.rebuild)
+        return {**counts, "data_version": version}
+    except Exception as e:
+        raise http_error(e)
+
+
+@app.get("/admin/cache")
+async def get_cache_stats():
+    return {
+        "data_version": await data_version.current(),
+        **kpi_cache.stats(),
+        "dimensions": dimensions.stats(),
+        "sketches": sketch_store.stats(),
+        "shared": await run_sync(shared_state.stats) if shared_state is not None else None,
+        "live": live_feed.stats(),
+        "flights": flights.stats(),
+        "limits": {name: limiter.stats() for name, limiter in limiters.items()},
+        "forecast": forecasts.stats(),
+        "pid": os.getpid()
+    }
+
+
+@app.post("/admin/cache/invalidate")
+async def invalidate_cache(bump_version: bool = False):
+    try:
+        version = await run_sync(backend.bump_version) if bump_version else None
+        if shared_state is not None:
+            await run_sync(shared_state.clear, 'kpi')
+        return {"invalidated": kpi_cache.invalidate(), "data_version": version}
+    except Exception as e:
+        raise http_error(e)
 
-@app.get("/api/rfm-data")
-async def get_rfm_data():
-    try:
-        orders = list(db.Orders.aggregate(get_rfm_pipeline()))
-        df = pd.DataFrame(orders)
-        df = df.rename(columns={
-            '_id': 'Customer ID',
-            'last_purchase': 'Order Date',
-            'total_sales': 'Monetary',
-            'frequency': 'Frequency'
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/debug/queries")
+async def get_query_stats(limit: int = 20, sort: str = "total_ms"):
+    if sort not in ("total_ms", "max_ms", "count", "returned"):
+        raise HTTPException(status_code=400, detail=f"Unknown sort: {sort}")
+    return {
+        "slow_query_ms": query_stats.slow_ms,
+        "queries": query_stats.top(limit, sort),
+        "slow": list(query_stats.slow)
+    }
+
+
+@app.post("/debug/queries/reset")
+async def reset_query_stats():
+    return {"reset": query_stats.reset()}
+
+
+@app.get("/api/version")
+async def get_version():
+    try:
+        return {"data_version": await data_version.current()}
+    except Exception as e:
+        raise http_error(e)
+
+
+@app.get("/api/forecast")
+async def get_forecast(request: Request, periods: int = 365, by: Optional[str] = None):
+    try:
+        scope = by or TOTAL_GROUP
+        if scope != TOTAL_GROUP and scope not in FORECAST_GROUPS:
+            raise HTTPException(status_code=400, detail=f"Unknown forecast grouping: {by}")
+        if not 1 <= periods <= forecasts.horizon:
+            raise HTTPException(status_code=400, detail=f"periods must be between 1 and {forecasts.horizon}")
+
+        version = await data_version.current()
+        frames, stale = await forecasts.get(
+            scope, version, lambda: labelled(f"forecast({scope})", load_forecast_series(scope))
+        )
+        if wants_arrow(request):
+            # One table, grouped forecasts are stacked with a `group` column.
+            frame = pd.concat([
+                slice_forecast_frame(frame, periods).assign(group=group)
+                for group, frame in frames.items()
+            ], ignore_index=True)
+            if scope == TOTAL_GROUP:
+                frame = frame.drop(columns='group')
+            return respond(request, frame, data_version=version, periods=periods, stale=stale)
+
+        data = {group: slice_forecast(frame, periods) for group, frame in frames.items()}
+        return ORJSONResponse({
+            "data_version": version,
+            "periods": periods,
+            "stale": stale,
+            "data": data[TOTAL_GROUP] if scope == TOTAL_GROUP else data
         })
-        return {"data": df.to_dict(orient='records')}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+
+RFM_DATA_COLUMNS = {
+    '_id': 'Customer ID',
+    'last_purchase': 'Order Date',
+    'total_sales': 'Monetary',
+    'frequency': 'Frequency'
+}
+
+
+def rename_rfm_row(row):
+    return {RFM_DATA_COLUMNS.get(key, key): value for key, value in row.items()}
+
+
+@app.get("/api/rfm-data")
+async def get_rfm_data(request: Request, limit: Optional[int] = Query(None, ge=1),
+                       after: Optional[str] = None, format: str = "json"):
+    try:
+        if limit is not None or after is not None or format != "json":
+            return await run_page(
+                request, CUSTOMER_RFM_COLLECTION, [], RFM_DATA_KEYS, (CUSTOMER_RFM_COLLECTION,),
+                limit, after, format, transform=rename_rfm_row
+            )
+        version = await data_version.current()
+        df = await flights.run(('rfm-data', version), lambda: limited('rfm-data', load_rfm_data))
+        return respond(request, df)
+    except Exception as e:
+        raise http_error(e)
+
+
+async def load_rfm_data():
+    orders = await backend.find(CUSTOMER_RFM_COLLECTION)
+    df = pd.DataFrame(orders)
+    return df.rename(columns=RFM_DATA_COLUMNS)
+
+
+async def get_rfm_model():
+    version = await data_version.current()
+    model = await run_sync(rfm_models.get, version)
+    if model is None:
+        model = await flights.run(('rfm-model', version), lambda: limited('rfm', lambda: train_rfm_model(version)))
+    return model
+
+
+async def train_rfm_model(version):
+    orders = await backend.find(CUSTOMER_RFM_COLLECTION)
+    return await run_sync(rfm_models.train, version, orders)
+
+
+async def get_rfm_matrix():
+    version = await data_version.current()
+    if rfm_matrix.version != version:
+        await flights.run(('rfm-matrix', version), lambda: update_rfm_matrix(version))
+    return rfm_matrix
+
+
+async def update_rfm_matrix(version):
+    orders = await backend.find(CUSTOMER_RFM_COLLECTION)
+    await run_sync(rfm_matrix.update, version, orders)
 
 
 @app.get("/api/rfm")
 async def get_rfm_analysis():
     try:
+        model = await get_rfm_model()
+        return model['cluster_stats']
+    except Exception as e:
+        raise http_error(e)
 
-        if os.path.exists(MODEL_PATH):
-            with open(MODEL_PATH, "rb") as f:
-                cluster_stats = pickle.load(f)
-        else:
-            orders = list(db.Orders.aggregate(get_rfm_pipeline()))
-            df = pd.DataFrame(orders)
-            df = df.rename(columns={
-                '_id': 'Customer ID',
-                'last_purchase': 'Order Date',
-                'total_sales': 'Monetary',
-                'frequency': 'Frequency'
-            })
-
-            df['Order Date'] = pd.to_datetime(df['Order Date'], format='%Y-%m-%dT%H:%M:%S')
 
-            last_date = df['Order Date'].max()
+class ScoreRequest(BaseModel):
+    customer_ids: List[str]
 
-            df['Recency'] = (last_date - df['Order Date']).dt.days
-            df['Recency'] = df['Recency'].max() - df['Recency']
 
-            scaler = StandardScaler()
-            rfm_normalized = scaler.fit_transform(df[['Recency', 'Frequency', 'Monetary']])
+async def score(customer_ids):
+    model = await get_rfm_model()
+    return await limited('rfm-score', lambda: score_with(model, customer_ids))
 
-            kmeans = KMeans(n_clusters=3, random_state=42)
-            df['Cluster'] = kmeans.fit_predict(rfm_normalized)
 
-            cluster_stats = {
-                'averages': {
-                    'recency': df.groupby('Cluster')['Recency'].mean().to_dict(),
-                    'frequency': df.groupby('Cluster')['Frequency'].mean().to_dict(),
-                    'monetary': df.groupby('Cluster')['Monetary'].mean().to_dict()
-                },
-                'distribution': df['Cluster'].value_counts(normalize=True).to_dict()
-            }
+async def score_with(model, customer_ids):
+    orders = await backend.find(CUSTOMER_RFM_COLLECTION, {'_id': {'$in': customer_ids}})
+    scores = await run_sync(score_customers, model, orders)
+    scored = {row['Customer ID'] for row in scores}
+    return {
+        "model": rfm_models.info(model),
+        "data": scores,
+        "unknown": [customer_id for customer_id in customer_ids if customer_id not in scored]
+    }
 
-            with open(MODEL_PATH, "wb") as f:
-                pickle.dump(cluster_stats, f)
 
-        return cluster_stats
+@app.get("/api/rfm/score")
+async def score_customer(customer_id: str):
+    try:
+        return await score([customer_id])
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
+@app.post("/api/rfm/score")
+async def score_customer_batch(request: ScoreRequest):
+    try:
+        if not request.customer_ids:
+            raise HTTPException(status_code=400, detail="customer_ids must not be empty")
+        return await score(list(dict.fromkeys(request.customer_ids)))
+    except Exception as e:
+        raise http_error(e)
+
 
 @app.get("/api/elbow")
 async def elbow_method(max_k: int = 10):
     try:
-        orders = list(db.Orders.aggregate(get_rfm_pipeline()))
-        df = pd.DataFrame(orders)
-        df = df.rename(columns={
-            '_id': 'Customer ID',
-            'last_purchase': 'Order Date',
-            'total_sales': 'Monetary',
-            'frequency': 'Frequency'
-        })
+        if not 1 <= max_k <= ELBOW_MAX_K:
+            raise HTTPException(status_code=400, detail=f"max_k must be between 1 and {ELBOW_MAX_K}")
+        matrix = await get_rfm_matrix()
+        inertia = await flights.run(
+            ('elbow', matrix.version, max_k), lambda: limited('elbow', lambda: run_sync(matrix.elbow, max_k))
+        )
+        return {"inertia": inertia}
+    except Exception as e:
+        raise http_error(e)
 
-        date_max = pd.to_datetime(df['Order Date']).max()
-        df['Recency'] = (date_max - pd.to_datetime(df['Order Date'])).dt.days
-        df['Recency'] = df['Recency'].max() - df['Recency']
 
-        scaler = StandardScaler()
-        rfm_normalized = scaler.fit_transform(df[['Recency', 'Frequency', 'Monetary']])
+@app.get("/kpi/bundle")
+async def get_kpi_bundle(page: Optional[str] = None, metrics: Optional[str] = None, limit: int = Query(5, ge=1)):
+    try:
+        if page is not None:
+            if page not in BUNDLE_PAGES:
+                raise HTTPException(status_code=400, detail=f"Unknown page: {page}")
+            names = BUNDLE_PAGES[page]
+        elif metrics:
+            names = [name.strip() for name in metrics.split(",") if name.strip()]
+            unknown = [name for name in names if name not in BUNDLE_METRICS]
+            if unknown:
+                raise HTTPException(status_code=400, detail=f"Unknown metrics: {', '.join(unknown)}")
+        else:
+            raise HTTPException(status_code=400, detail="Either page or metrics is required")
 
-        inertia = []
-        for k in range(1, max_k + 1):
-            kmeans = KMeans(n_clusters=k, random_state=42)
-            kmeans.fit(rfm_normalized)
-            inertia.append(kmeans.inertia_)
+        data = await run_bundle(names, limit)
+        return ORJSONResponse({"data": data})
+    except Exception as e:
+        raise http_error(e)
 
-        return {"inertia": inertia}
+
+@app.get("/kpi/sales")
+async def get_sales(request: Request, start: Optional[date] = None, end: Optional[date] = None,
+                    granularity: str = "Mois", metric: str = "Sales"):
+    try:
+        if granularity not in DATE_GRANULARITIES:
+            raise HTTPException(status_code=400, detail=f"Unknown granularity: {granularity}")
+        if metric not in METRIC_FIELDS:
+            raise HTTPException(status_code=400, detail=f"Unknown metric: {metric}")
+
+        start_date, end_date = get_date_bounds(start, end)
+        result = await run_kpi(get_sales_pipeline, start_date, end_date, granularity, metric)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 @app.get("/kpi/sales-per-dates")
-async def orders_per_dates():
+async def orders_per_dates(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_sales_by_date_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_sales_by_date_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 @app.get("/kpi/total-sales")
-async def get_total_sales():
+async def get_total_sales(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_total_sales_pipeline()))
-        return {"data": result[0] if result else {"total_sales": 0}}
+        result = await run_kpi(get_total_sales_pipeline)
+        return respond(request, result[0] if result else {"total_sales": 0})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/sales-by-state")
-async def get_sales_by_state():
+async def get_sales_by_state(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_sales_by_state_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_sales_by_state_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/sales-by-category")
-async def get_sales_by_category():
+async def get_sales_by_category(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_sales_by_category_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_sales_by_category_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/sales-by-product")
-async def get_sales_by_product():
+async def get_sales_by_product(request: Request, limit: Optional[int] = Query(None, ge=1),
+                               after: Optional[str] = None, format: str = "json"):
     try:
-        result = list(db.Orders.aggregate(get_sales_by_product_pipeline()))
-        return {"data": result}
+        if limit is not None or after is not None or format != "json":
+            return await run_kpi_page(request, get_sales_by_product_pipeline, SALES_BY_PRODUCT_KEYS, limit, after, format)
+        result = await run_kpi(get_sales_by_product_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 @app.get("/kpi/total-profit")
-async def get_total_profit():
+async def get_total_profit(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_total_profit_pipeline()))
-        return {"data": result[0] if result else {"total_profit": 0}}
+        result = await run_kpi(get_total_profit_pipeline)
+        return respond(request, result[0] if result else {"total_profit": 0})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/profit-by-category")
-async def get_profit_by_category():
+async def get_profit_by_category(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_profit_by_category_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_profit_by_category_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/profit-by-product")
-async def get_profit_by_product():
+async def get_profit_by_product(request: Request, limit: Optional[int] = Query(None, ge=1),
+                                after: Optional[str] = None, format: str = "json"):
     try:
-        result = list(db.Orders.aggregate(get_profit_by_product_pipeline()))
-        return {"data": result}
+        if limit is not None or after is not None or format != "json":
+            return await run_kpi_page(request, get_profit_by_product_pipeline, PROFIT_BY_PRODUCT_KEYS, limit, after, format)
+        result = await run_kpi(get_profit_by_product_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/top-profitable-products")
 
-async def get_top_profitable_products(limit: Optional[int] = 5):
+async def get_top_profitable_products(request: Request, limit: int = Query(5, ge=1)):
     try:
-        result = list(db.Orders.aggregate(get_top_profitable_products_pipeline(limit)))
-        return {"data": result}
+        result = await run_kpi(get_top_profitable_products_pipeline, limit)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/average-basket")
-async def get_average_basket():
+async def get_average_basket(request: Request, start: Optional[date] = None, end: Optional[date] = None,
+                             approx: bool = False):
     try:
-        result = list(db.Orders.aggregate(get_average_basket_pipeline()))
-        return {"data": result[0] if result else {"average_basket": 0}}
+        start_date, end_date = get_date_bounds(start, end)
+        if approx:
+            result = await run_approx(
+                ('average-basket', start_date, end_date),
+                lambda store: get_approx_average_basket(store, start_date, end_date)
+            )
+            return respond(request, result, approx=True)
+        result = await run_kpi(get_average_basket_pipeline, start_date, end_date)
+        return respond(request, result[0] if result else {"average_basket": 0})
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/average-basket-by-state")
-async def get_average_basket_by_state():
+async def get_average_basket_by_state(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_average_basket_by_state_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_average_basket_by_state_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/average-basket-by-category")
-async def get_average_basket_by_category():
+async def get_average_basket_by_category(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_average_basket_by_category_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_average_basket_by_category_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 
 @app.get("/kpi/sales-by-location")
-async def get_sales_by_location():
+async def get_sales_by_location(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_sales_by_location_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_sales_by_location_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/sales-by-region")
-async def get_sales_by_region():
+async def get_sales_by_region(request: Request):
     try:
-        result = list(db.Orders.aggregate(get_sales_by_region_pipeline()))
-        return {"data": result}
+        result = await run_kpi(get_sales_by_region_pipeline)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/average-basket-by-region")
-async def get_average_basket_by_region():
+async def get_average_basket_by_region(request: Request, start: Optional[date] = None,
+                                       end: Optional[date] = None, approx: bool = False):
     try:
-        result = list(db.Orders.aggregate(get_average_basket_by_region_pipeline()))
-        return {"data": result}
+        start_date, end_date = get_date_bounds(start, end)
+        if approx:
+            result = await run_approx(
+                ('average-basket-by-region', start_date, end_date),
+                lambda store: get_approx_average_basket_by_region(store, start_date, end_date)
+            )
+            return respond(request, result, approx=True)
+        result = await run_kpi(get_average_basket_by_region_pipeline, start_date, end_date, source=SOURCE_ENRICHED)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
+
+@app.get("/kpi/distinct-counts")
+async def get_distinct_counts(request: Request, by: str = "all", start: Optional[date] = None,
+                              end: Optional[date] = None, approx: bool = False):
+    try:
+        group_field = get_sketch_dimension(by)
+        start_date, end_date = get_date_bounds(start, end)
+        if approx:
+            result = await run_approx(
+                ('distinct-counts', by, start_date, end_date),
+                lambda store: get_approx_distinct_counts(store, by, start_date, end_date)
+            )
+            return respond(request, result, approx=True)
+        # Dimensions come from OrdersEnriched, totals from Orders (no duplicated lines).
+        source = SOURCE_ENRICHED if group_field else SOURCE_ORDERS
+        orders, customers = await asyncio.gather(*[
+            run_kpi(get_distinct_count_pipeline, field, group_field, start_date, end_date, source=source)
+            for field in ('Order ID', 'Customer ID')
+        ])
+        counts = {row['_id']: row['count'] for row in customers}
+        result = [
+            {'_id': row['_id'], 'orders': row['count'], 'customers': counts.get(row['_id'], 0)}
+            for row in orders
+        ]
+        return respond(request, result)
+    except Exception as e:
+        raise http_error(e)
+
+@app.get("/kpi/basket-distribution")
+async def get_basket_distribution(request: Request, by: str = "all", quantiles: str = "0.25,0.5,0.75,0.9,0.99",
+                                  start: Optional[date] = None, end: Optional[date] = None,
+                                  approx: bool = False):
+    try:
+        group_field = get_sketch_dimension(by)
+        values = parse_quantiles(quantiles)
+        start_date, end_date = get_date_bounds(start, end)
+        if approx:
+            result = await run_approx(
+                ('basket-distribution', by, tuple(values), start_date, end_date),
+                lambda store: get_approx_basket_distribution(store, by, values, start_date, end_date)
+            )
+            return respond(request, result, approx=True)
+        # Exact quantiles need every basket value in the API.
+        source = SOURCE_ENRICHED if group_field else SOURCE_ORDERS
+
+        async def compute():
+            rows = await run_kpi(get_basket_values_pipeline, group_field, start_date, end_date, source=source)
+            return await run_sync(get_exact_basket_distribution, rows, values)
+
+        result = await run_cached(
+            ('basket-distribution-exact', by, tuple(values), start_date, end_date),
+            lambda: limited('basket-distribution', compute)
+        )
+        return respond(request, result)
+    except Exception as e:
+        raise http_error(e)
+
+@app.get("/kpi/stream")
+async def stream_kpis():
+    # Server-Sent Events: a `snapshot` of LIVE_METRICS, then a `delta` with
+    # the changed rows after each batch of inserted orders.
+    async def events():
+        queue = live_feed.subscribe()
+        try:
+            message = live_feed.current()
+            if message is not None:
+                yield message
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), LIVE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keep-alive\n\n"
+        finally:
+            live_feed.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/kpi/top-categories")
-async def get_top_categories(limit: Optional[int] = 5):
+async def get_top_categories(request: Request, limit: int = Query(5, ge=1)):
     try:
-        result = list(db.Orders.aggregate(get_top_categories_pipeline(limit)))
-        return {"data": result}
+        result = await run_kpi(get_top_categories_pipeline, limit)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/top-products-by-quantity")
-async def get_top_products_by_quantity(limit: Optional[int] = 5):
+async def get_top_products_by_quantity(request: Request, limit: int = Query(5, ge=1)):
     try:
-        result = list(db.Orders.aggregate(get_top_products_by_quantity_pipeline(limit)))
-        return {"data": result}
+        result = await run_kpi(get_top_products_by_quantity_pipeline, limit)
+        return respond(request, result)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 @app.get("/kpi/sales-matrix")
-async def get_sales_matrix():
+async def get_sales_matrix(request: Request, limit: Optional[int] = Query(None, ge=1),
+                           after: Optional[str] = None, format: str = "json"):
+    try:
+        if limit is not None or after is not None or format != "json":
+            return await run_kpi_page(request, get_sales_matrix_pipeline, SALES_MATRIX_KEYS, limit, after, format)
+        result = await run_kpi(get_sales_matrix_pipeline)
+        return respond(request, result)
+    except Exception as e:
+        raise http_error(e)
+
+@app.get("/kpi/cube")
+async def get_cube(request: Request, rows: str, cols: str = "", filter: List[str] = Query([]),
+                   measures: str = ",".join(CUBE_MEASURES), format: str = "dense"):
+    # Any pivot of the cube dimensions, answered from the smallest
+    # materialized cuboid that holds them (filtered dimensions included).
     try:
-        result = list(db.Orders.aggregate(get_sales_matrix_pipeline()))
-        return {"data": result}
+        row_dims, col_dims = parse_cube_dimensions(rows), parse_cube_dimensions(cols)
+        filters = parse_cube_filters(filter)
+        selected = [m.strip() for m in measures.split(",") if m.strip()]
+        if not selected or any(m not in CUBE_MEASURES for m in selected):
+            raise HTTPException(status_code=400, detail=f"measures must be among {', '.join(CUBE_MEASURES)}")
+        if format not in ("dense", "sparse"):
+            raise HTTPException(status_code=400, detail="format must be dense or sparse")
+        dimensions = list(dict.fromkeys(row_dims + col_dims))
+        cuboid = nearest_cuboid(await get_cube_catalog(), dimensions + list(filters))
+        if cuboid is None:
+            raise HTTPException(status_code=503, detail="The cube is not built yet")
+        dense = format == "dense" and bool(col_dims)
+
+        async def compute():
+            documents = await labelled('cube', backend.aggregate(
+                CUBE_COLLECTION, get_cube_query_pipeline(cuboid, dimensions, filters, selected)
+            ))
+            cells = await run_sync(to_cells, documents, dimensions, selected)
+            if dense:
+                columns = cells[col_dims].drop_duplicates().shape[0]
+                size = cells[row_dims].drop_duplicates().shape[0] * columns * len(selected)
+                if size > CUBE_MAX_DENSE_CELLS:
+                    raise HTTPException(status_code=400,
+                                        detail=f"{size} cells exceed CUBE_MAX_DENSE_CELLS, use format=sparse")
+                cells = await run_sync(to_dense, cells, row_dims, col_dims, selected)
+            return cells.to_dict(orient="records")
+
+        # The pivot itself is cached, not only the cuboid rows it reads.
+        cells = await run_cached(
+            ('cube', cuboid, tuple(row_dims), tuple(col_dims),
+             tuple(sorted((d, tuple(v)) for d, v in filters.items())), tuple(selected), dense),
+            compute
+        )
+        return respond(request, cells, cuboid=cuboid, format=format)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise http_error(e)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8000)
\ No newline at end of file
+    # Several workers need an import string: each worker process imports the app.
+    uvicorn.run("main:app" if WEB_WORKERS > 1 else app, host=API_HOST, port=API_PORT, workers=WEB_WORKERS)
\ No newline at end of file
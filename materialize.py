@@ -0,0 +1,64 @@
+from pymongo import ASCENDING
+from pipelines import get_orders_enriched_pipeline, SOURCE_COLLECTIONS, SOURCE_ENRICHED
+from database import get_db
+
+ENRICHED_COLLECTION = SOURCE_COLLECTIONS[SOURCE_ENRICHED]
+
+
+def create_enriched_indexes(db):
+    collection = db[ENRICHED_COLLECTION]
+    collection.create_index([('order_ref', ASCENDING)])
+    collection.create_index([('Order Date', ASCENDING)])
+    # Incremental ingest selects each batch of order lines by Row ID.
+    collection.create_index([('Row ID', ASCENDING)])
+
+
+def rebuild_orders_enriched(db):
+    db.Orders.aggregate(
+        get_orders_enriched_pipeline() + [{'$out': ENRICHED_COLLECTION}],
+        allowDiskUse=True
+    )
+    create_enriched_indexes(db)
+    return db[ENRICHED_COLLECTION].estimated_document_count()
+
+
+def refresh_orders_enriched(db, match):
+    # Re-derives the enriched rows of the orders selected by `match`, e.g.
+    # freshly ingested orders or orders touching an updated product.
+    order_ids = [doc['_id'] for doc in db.Orders.find(match, {'_id': 1})]
+    if not order_ids:
+        return 0
+
+    db[ENRICHED_COLLECTION].delete_many({'order_ref': {'$in': order_ids}})
+    db.Orders.aggregate(
+        get_orders_enriched_pipeline({'_id': {'$in': order_ids}}) + [
+            {
+                '$merge': {
+                    'into': ENRICHED_COLLECTION,
+                    'on': '_id',
+                    'whenMatched': 'replace',
+                    'whenNotMatched': 'insert'
+                }
+            }
+        ],
+        allowDiskUse=True
+    )
+    return len(order_ids)
+
+
+def refresh_dimension(db, field, values):
+    # field is one of the Orders join keys: 'Customer ID', 'Product ID', 'Postal Code'
+    return refresh_orders_enriched(db, {field: {'$in': list(values)}})
+
+
+def ensure_orders_enriched(db):
+    if db[ENRICHED_COLLECTION].estimated_document_count() == 0 \
+            and db.Orders.estimated_document_count() > 0:
+        return rebuild_orders_enriched(db)
+    create_enriched_indexes(db)
+    return None
+
+
+if __name__ == "__main__":
+    count = rebuild_orders_enriched(get_db())
+    print(f"{ENRICHED_COLLECTION}: {count} documents")
@@ -0,0 +1,193 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Minimal Prometheus text exposition (format 0.0.4): counters, gauges and
+# histograms with labels, plus gauges read from a callback at scrape time.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(v)}" for key, v in items]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self.lock:
+            self.values[labels] = value
+
+
+class CallbackMetric(Metric):
+    # `callback()` returns {label values tuple: value}, read on each scrape.
+
+    def __init__(self, name, help, callback, labels=(), type='gauge', registry=registry):
+        super().__init__(name, help, labels, registry)
+        self.callback = callback
+        self.type = type
+
+    def samples(self):
+        return [
+            f"{self.name}{format_labels(self.labels, key)} {format_value(v)}"
+            for key, v in self.callback().items()
+        ]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=registry):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, *labels, value):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.labels, key, [('le', format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Timer:
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(*self.labels, value=time.perf_counter() - self.start)
+
+
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route.', ['method', 'route', 'status']
+)
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests being served.')
+QUERY_DURATION = Histogram(
+    'backend_query_duration_seconds', 'Round trip of backend queries (aggregate, find, stream).',
+    ['operation', 'collection']
+)
+MODEL_FIT_DURATION = Histogram(
+    'model_fit_duration_seconds', 'Duration of model fits.', ['model'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+)
+
+
+class MetricsMiddleware:
+    # Pure ASGI middleware: does not buffer responses, so streaming
+    # endpoints are measured until their last chunk.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = {'code': 500}
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # The route template, not the raw path, keeps label cardinality bounded.
+            route = scope.get('route')
+            REQUEST_DURATION.observe(
+                scope['method'], route.path if route is not None else 'unmatched', str(status['code']),
+                value=time.perf_counter() - start
+            )
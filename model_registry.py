@@ -0,0 +1,97 @@
+import os
+import pickle
+import threading
+from datetime import datetime, timezone
+
+from shared_state import file_lock, replace_file
+from rfm import build_rfm_frame, get_reference_date, fit_rfm_model, RFM_FEATURES
+
+MODEL_PATH = "model_rfm.pkl"
+
+
+class RFMModelRegistry:
+    # Keeps the fitted scaler and KMeans together with the data version they
+    # were trained on; a model from another version is never served. The
+    # file is shared by the API workers: one trains, the others reload it.
+
+    def __init__(self, path=MODEL_PATH):
+        self.path = path
+        self.model = None
+        self.loaded_mtime = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        self.loaded_mtime = os.path.getmtime(self.path)
+        with open(self.path, "rb") as f:
+            model = pickle.load(f)
+        # Older files only held the cluster summary or an older recency
+        # definition, they cannot score customers consistently.
+        if not isinstance(model, dict) or 'recency_reference' not in model:
+            return None
+        return model
+
+    def save(self, model):
+        # Written aside then renamed: a reader never loads a partial pickle.
+        def write(path):
+            with open(path, "wb") as f:
+                pickle.dump(model, f)
+        replace_file(self.path, write)
+
+    def changed(self):
+        return os.path.exists(self.path) and os.path.getmtime(self.path) != self.loaded_mtime
+
+    def get(self, version):
+        with self.lock:
+            if self.model is None or (self.model['data_version'] != version and self.changed()):
+                self.model = self.load() or self.model
+            if self.model is not None and self.model['data_version'] == version:
+                return self.model
+            return None
+
+    def train(self, version, orders):
+        # One worker trains at a time; the others then find its model.
+        with file_lock(self.path + ".lock"):
+            model = self.get(version)
+            if model is not None:
+                return model
+            return self.fit(version, orders)
+
+    def fit(self, version, orders):
+        frame = build_rfm_frame(orders)
+        reference_date = get_reference_date(frame)
+        scaler, kmeans, cluster_stats = fit_rfm_model(frame)
+        model = {
+            'data_version': version,
+            'trained_at': datetime.now(timezone.utc),
+            'features': RFM_FEATURES,
+            'recency_reference': reference_date,
+            'scaler': scaler,
+            'kmeans': kmeans,
+            'cluster_stats': cluster_stats
+        }
+        with self.lock:
+            self.save(model)
+            self.model = model
+        return model
+
+    def info(self, model):
+        return {
+            'data_version': model['data_version'],
+            'trained_at': model['trained_at'],
+            'recency_reference': model['recency_reference'],
+            'n_clusters': int(model['kmeans'].n_clusters)
+        }
+
+
+def score_customers(model, orders):
+    # Vectorized scoring of CustomerRFM documents, using the recency
+    # reference date of the training data.
+    if not orders:
+        return []
+    df = build_rfm_frame(orders, model['recency_reference'])
+
+    matrix = model['scaler'].transform(df[model['features']])
+    df['Cluster'] = model['kmeans'].predict(matrix)
+    return df[['Customer ID'] + model['features'] + ['Cluster']].to_dict(orient='records')
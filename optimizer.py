@@ -0,0 +1,243 @@
+import asyncio
+import json
+import math
+import time
+
+# Rewrites "join every row, then group" pipelines into "group on the join
+# keys, join the groups, regroup". $lookup/$unwind multiply rows by the
+# number of matching dimension documents (and drop unmatched ones), so a
+# join whose fields are not used can only be dropped when it matches
+# exactly one document for every row: the `unique_lookups`.
+
+REGROUP_OPERATORS = {'$sum': '$sum', '$min': '$min', '$max': '$max'}
+
+
+def field_paths(expr):
+    if isinstance(expr, str):
+        if expr.startswith('$') and not expr.startswith('$$'):
+            yield expr[1:]
+    elif isinstance(expr, dict):
+        for value in expr.values():
+            yield from field_paths(value)
+    elif isinstance(expr, list):
+        for value in expr:
+            yield from field_paths(value)
+
+
+def lookup_prefix(pipeline):
+    # Leading $lookup/$unwind stages: {as: spec} in order, and the rest.
+    lookups = {}
+    unwound = set()
+    index = 0
+    for index, stage in enumerate(pipeline):
+        if '$lookup' in stage:
+            lookups[stage['$lookup']['as']] = stage['$lookup']
+        elif '$unwind' in stage and isinstance(stage['$unwind'], str):
+            unwound.add(stage['$unwind'][1:])
+        else:
+            return lookups, unwound, pipeline[index:]
+    return lookups, unwound, []
+
+
+def references(path, name):
+    return path == name or path.startswith(name + '.')
+
+
+def split_pipeline(pipeline, unique_lookups=()):
+    # Returns (pre-group, rest): the pre-group only reads the collection,
+    # the rest only needs its output and the dimension collections. None
+    # when the rewrite does not apply (no leading joins, no $group after
+    # them, accumulators reading joined fields, order-dependent accumulators).
+    lookups, unwound, rest = lookup_prefix(pipeline)
+    if not lookups or set(lookups) != unwound or not rest or '$group' not in rest[0]:
+        return None
+    group = rest[0]['$group']
+
+    key_paths = set(field_paths(group['_id']))
+    used = {name for name in lookups if any(references(p, name) for p in key_paths)}
+    kept = [name for name in lookups if name in used or name not in unique_lookups]
+
+    pre_keys = {}
+    for path in sorted(p for p in key_paths if not any(references(p, name) for name in lookups)):
+        if path == '_id' or '.' in path:
+            return None
+        pre_keys[path] = '$' + path
+    for name in kept:
+        local_field = lookups[name]['localField']
+        pre_keys[local_field] = '$' + local_field
+
+    pre_group = {'_id': {f"k{i}": expr for i, expr in enumerate(pre_keys.values())}}
+    regroup = {'_id': group['_id']}
+    averages = {}
+    for name, accumulator in group.items():
+        if name == '_id':
+            continue
+        if name in pre_keys:
+            return None
+        op, arg = next(iter(accumulator.items()))
+        if any(references(p, lookup) for p in field_paths(arg) for lookup in lookups):
+            return None
+        if op in REGROUP_OPERATORS:
+            pre_group[name] = {op: arg}
+            regroup[name] = {REGROUP_OPERATORS[op]: '$' + name}
+        elif op == '$avg':
+            pre_group[f"{name}__sum"] = {'$sum': arg}
+            pre_group[f"{name}__count"] = {'$sum': 1}
+            regroup[f"{name}__sum"] = {'$sum': f"${name}__sum"}
+            regroup[f"{name}__count"] = {'$sum': f"${name}__count"}
+            averages[name] = {'$divide': [f"${name}__sum", f"${name}__count"]}
+        else:
+            return None
+
+    rewritten = [{'$set': {field: f"$_id.k{i}" for i, field in enumerate(pre_keys)}}]
+    rewritten += [{'$lookup': lookups[name]} for name in kept]
+    rewritten += [{'$unwind': '$' + name} for name in kept]
+    rewritten.append({'$group': regroup})
+    if averages:
+        rewritten.append({'$set': averages})
+        rewritten.append({'$project': {
+            f"{name}__{part}": 0 for name in averages for part in ('sum', 'count')
+        }})
+    return [{'$group': pre_group}], rewritten + rest[1:]
+
+
+def optimize_pipeline(pipeline, unique_lookups=()):
+    # The rewritten pipeline, or `pipeline` itself when the rewrite does not apply.
+    split = split_pipeline(pipeline, unique_lookups)
+    return split[0] + split[1] if split else pipeline
+
+
+def get_lookup_check_pipelines(lookup):
+    # The join keys actually used, and how many of them match exactly one document.
+    keys = [{'$group': {'_id': '$' + lookup['localField']}}]
+    return (
+        keys + [{'$group': {'_id': None, 'keys': {'$sum': 1}}}],
+        keys + [
+            {'$lookup': {**lookup, 'localField': '_id'}},
+            {'$unwind': '$' + lookup['as']},
+            {'$group': {'_id': '$_id', 'matches': {'$sum': 1}}},
+            {'$group': {'_id': None, 'keys': {'$sum': 1}, 'max_matches': {'$max': '$matches'}}}
+        ]
+    )
+
+
+async def find_unique_lookups(aggregate, collection, lookups):
+    # Names of the lookups matching one and only one document per row of
+    # `collection` in the current data; `aggregate(collection, pipeline)`.
+    unique = []
+    for lookup in lookups:
+        keys_pipeline, matches_pipeline = get_lookup_check_pipelines(lookup)
+        keys, matches = await asyncio.gather(
+            aggregate(collection, keys_pipeline),
+            aggregate(collection, matches_pipeline)
+        )
+        if keys and matches and keys[0]['keys'] == matches[0]['keys'] and matches[0]['max_matches'] == 1:
+            unique.append(lookup['as'])
+    return unique
+
+
+def canonical(value):
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, dict):
+        return {key: canonical(v) for key, v in value.items()}
+    if isinstance(value, list):
+        return [canonical(v) for v in value]
+    return value
+
+
+def results_match(expected, actual, rel_tol=1e-9):
+    # Order-insensitive among equal sort keys, floats compared with a
+    # tolerance: grouping in another order changes the summation order.
+    if len(expected) != len(actual):
+        return False
+    key = lambda document: json.dumps(canonical(document.get('_id')), sort_keys=True, default=str)
+    for a, b in zip(sorted(expected, key=key), sorted(actual, key=key)):
+        if a.keys() != b.keys():
+            return False
+        for field in a:
+            x, y = a[field], b[field]
+            if isinstance(x, float) or isinstance(y, float):
+                if x is None or y is None or not math.isclose(x, y, rel_tol=rel_tol, abs_tol=1e-6):
+                    return False
+            elif x != y:
+                return False
+    return True
+
+
+def get_check_pipelines():
+    # The KPIs the test mode compares, by name.
+    import pipelines
+
+    return {
+        'sales-by-state': pipelines.get_sales_by_state_pipeline,
+        'sales-by-category': pipelines.get_sales_by_category_pipeline,
+        'sales-by-product': pipelines.get_sales_by_product_pipeline,
+        'sales-by-region': pipelines.get_sales_by_region_pipeline,
+        'sales-by-location': pipelines.get_sales_by_location_pipeline,
+        'sales-matrix': pipelines.get_sales_matrix_pipeline,
+        'profit-by-category': pipelines.get_profit_by_category_pipeline,
+        'profit-by-product': pipelines.get_profit_by_product_pipeline,
+        'top-profitable-products': pipelines.get_top_profitable_products_pipeline,
+        'average-basket-by-state': pipelines.get_average_basket_by_state_pipeline,
+        'average-basket-by-category': pipelines.get_average_basket_by_category_pipeline,
+        'average-basket-by-region': pipelines.get_average_basket_by_region_pipeline,
+        'top-categories': pipelines.get_top_categories_pipeline,
+        'top-products-by-quantity': pipelines.get_top_products_by_quantity_pipeline
+    }
+
+
+async def check(backend, pipelines, source, tables=None):
+    # Test mode: runs every pipeline as written and rewritten, compares.
+    # With `tables` (dimension frames) the rewritten part after the
+    # pre-group runs in process, as with DIMENSION_JOINS.
+    from pipelines import SOURCE_COLLECTIONS, get_source_pipeline
+    from dimensions import join_locally
+
+    collection = SOURCE_COLLECTIONS[source]
+    lookups = [stage['$lookup'] for stage in get_source_pipeline(source) if '$lookup' in stage]
+    unique_lookups = await find_unique_lookups(backend.aggregate, collection, lookups)
+    print(f"unique lookups: {', '.join(unique_lookups) or '-'}")
+
+    failures = 0
+    for name, pipeline_fn in pipelines.items():
+        pipeline = pipeline_fn(source=source)
+        split = split_pipeline(pipeline, unique_lookups)
+        start = time.perf_counter()
+        expected = await backend.aggregate(collection, pipeline)
+        middle = time.perf_counter()
+        if split is None:
+            actual = await backend.aggregate(collection, pipeline)
+        elif tables is not None:
+            actual = join_locally(await backend.aggregate(collection, split[0]), split[1], tables)
+        else:
+            actual = await backend.aggregate(collection, split[0] + split[1])
+        end = time.perf_counter()
+        ok = results_match(expected, actual)
+        failures += not ok
+        status = "ok" if ok else "MISMATCH"
+        rewritten = "rewritten" if split is not None else "unchanged"
+        print(f"{name}: {status} ({rewritten}, {middle - start:.3f}s -> {end - middle:.3f}s)")
+    return failures
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from backends import create_backend
+    from dimensions import DimensionCache
+    from pipelines import SOURCE_COLLECTIONS, SOURCE_ORDERS
+
+    parser = argparse.ArgumentParser(description="Compare KPI pipelines with their rewritten form.")
+    parser.add_argument("--source", choices=list(SOURCE_COLLECTIONS), default=SOURCE_ORDERS)
+    parser.add_argument("--local-joins", action="store_true", help="join the dimensions in process")
+    args = parser.parse_args()
+
+    backend = create_backend()
+    backend.load()
+
+    async def main():
+        tables = await DimensionCache().get(backend.data_version(), backend.find) if args.local_joins else None
+        return await check(backend, get_check_pipelines(), args.source, tables)
+
+    sys.exit(1 if asyncio.run(main()) else 0)
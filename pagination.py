@@ -0,0 +1,55 @@
+import base64
+import json
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+from responses import dumps
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def get_path(document, path):
+    for part in path.split('.'):
+        document = document.get(part) if isinstance(document, dict) else None
+    return document
+
+
+def encode_cursor(values):
+    raw = json.dumps(jsonable_encoder(values)).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    if token is None:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def split_page(rows, keys, limit, transform=None):
+    # Returns (rows, next cursor), the cursor is None on the last page.
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([get_path(rows[-1], field) for field, _ in keys])
+    if transform is not None:
+        rows = [transform(row) for row in rows]
+    return rows, next_cursor
+
+
+def ndjson_response(documents, transform=None):
+    async def lines():
+        async for document in documents:
+            if transform is not None:
+                document = transform(document)
+            yield dumps(document) + b"\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
@@ -1,5 +1,22 @@
-def get_rfm_pipeline():
-    return [
+SOURCE_ORDERS = 'orders'
+SOURCE_ENRICHED = 'enriched'
+SOURCE_ROLLUP = 'rollup'
+
+CUSTOMER_RFM_COLLECTION = 'CustomerRFM'
+SKETCH_COLLECTION = 'SalesSketches'
+CUBE_COLLECTION = 'SalesCube'
+
+SOURCE_COLLECTIONS = {
+    SOURCE_ORDERS: 'Orders',
+    SOURCE_ENRICHED: 'OrdersEnriched',
+    SOURCE_ROLLUP: 'SalesRollup'
+}
+
+ROLLUP_MEASURES = ['Sales', 'Profit', 'Quantity', 'order_lines']
+
+def get_rfm_pipeline(match=None):
+    pipeline = [{'$match': match}] if match else []
+    return pipeline + [
         {
             '$project': {
                 'Customer ID': 1,
@@ -18,7 +35,7 @@ def get_rfm_pipeline():
         }
     ]
 
-def get_sales_by_date_pipeline():
+def get_sales_by_date_pipeline(source=SOURCE_ORDERS):
     return [
         {
             '$group': {
@@ -34,6 +51,17 @@ def get_sales_by_date_pipeline():
             }
         }]
 
+def get_sales_by_date_and_group_pipeline(group_field, source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
+        {
+            '$group': {
+                '_id': {'date': '$Order Date', 'group': '$' + group_field},
+                'total_ventes': {'$sum': '$Sales'}
+            }
+        },
+        {'$sort': {'_id.date': 1}}
+    ]
+
 def get_base_lookup_pipeline():
     return [
         {
@@ -65,13 +93,103 @@ def get_base_lookup_pipeline():
         {'$unwind': '$location_details'}
     ]
 
-def get_total_sales_pipeline():
+def get_rollup_lookup_pipeline():
+    # Rollup rows carry no customer, so only products and locations are
+    # joined: the API reads Orders instead unless every order matches
+    # exactly one customer (main.get_kpi_source).
+    return [
+        stage for stage in get_base_lookup_pipeline()
+        if stage.get('$lookup', {}).get('from') != 'Customers'
+        and stage.get('$unwind') != '$customer_details'
+    ]
+
+def get_source_pipeline(source=SOURCE_ENRICHED):
+    # OrdersEnriched already embeds the joined dimensions under the same
+    # field names; raw Orders and the rollup are joined on the fly.
+    if source == SOURCE_ORDERS:
+        return get_base_lookup_pipeline()
+    if source == SOURCE_ROLLUP:
+        return get_rollup_lookup_pipeline()
+    return []
+
+def get_count_expr(source=SOURCE_ORDERS):
+    # A rollup row stands for `order_lines` order rows.
+    return '$order_lines' if source == SOURCE_ROLLUP else 1
+
+def get_rollup_pipeline(match=None):
+    pipeline = [{'$match': match}] if match else []
+    return pipeline + [
+        {
+            '$group': {
+                '_id': {
+                    'Order Date': {'$dateTrunc': {'date': '$Order Date', 'unit': 'day'}},
+                    'Product ID': '$Product ID',
+                    'Postal Code': '$Postal Code'
+                },
+                'Sales': {'$sum': '$Sales'},
+                'Profit': {'$sum': '$Profit'},
+                'Quantity': {'$sum': '$Quantity'},
+                'order_lines': {'$sum': 1}
+            }
+        },
+        {
+            '$set': {
+                'Order Date': '$_id.Order Date',
+                'Product ID': '$_id.Product ID',
+                'Postal Code': '$_id.Postal Code'
+            }
+        }
+    ]
+
+def get_orders_enriched_pipeline(match=None):
+    pipeline = [{'$match': match}] if match else []
+    return pipeline + get_base_lookup_pipeline() + [
+        {
+            '$project': {
+                '_id': {
+                    'order': '$_id',
+                    'customer': '$customer_details._id',
+                    'product': '$product_details._id',
+                    'location': '$location_details._id'
+                },
+                'order_ref': '$_id',
+                'Row ID': 1,
+                'Order ID': 1,
+                'Order Date': 1,
+                'Ship Date': 1,
+                'Ship Mode': 1,
+                'Customer ID': 1,
+                'Segment': 1,
+                'Postal Code': 1,
+                'Product ID': 1,
+                'Sales': 1,
+                'Quantity': 1,
+                'Discount': 1,
+                'Profit': 1,
+                'customer_details': {
+                    'Customer Name': '$customer_details.Customer Name'
+                },
+                'product_details': {
+                    'Category': '$product_details.Category',
+                    'Sub-Category': '$product_details.Sub-Category',
+                    'Product Name': '$product_details.Product Name'
+                },
+                'location_details': {
+                    'City': '$location_details.City',
+                    'State': '$location_details.State',
+                    'Region': '$location_details.Region'
+                }
+            }
+        }
+    ]
+
+def get_total_sales_pipeline(source=SOURCE_ORDERS):
     return [
         {'$group': {'_id': None, 'total_sales': {'$sum': '$Sales'}}}
     ]
 
-def get_sales_by_state_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_sales_by_state_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$location_details.State',
@@ -81,8 +199,8 @@ def get_sales_by_state_pipeline():
         {'$sort': {'total_sales': -1}}
     ]
 
-def get_sales_by_category_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_sales_by_category_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$product_details.Category',
@@ -92,8 +210,8 @@ def get_sales_by_category_pipeline():
         {'$sort': {'total_sales': -1}}
     ]
 
-def get_sales_by_product_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_sales_by_product_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$product_details.Product Name',
@@ -104,13 +222,13 @@ def get_sales_by_product_pipeline():
     ]
 
 
-def get_total_profit_pipeline():
+def get_total_profit_pipeline(source=SOURCE_ORDERS):
     return [
         {'$group': {'_id': None, 'total_profit': {'$sum': '$Profit'}}}
     ]
 
-def get_profit_by_category_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_profit_by_category_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$product_details.Category',
@@ -120,8 +238,8 @@ def get_profit_by_category_pipeline():
         {'$sort': {'total_profit': -1}}
     ]
 
-def get_profit_by_product_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_profit_by_product_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$product_details.Product Name',
@@ -131,17 +249,17 @@ def get_profit_by_product_pipeline():
         {'$sort': {'total_profit': -1}}
     ]
 
-def get_top_profitable_products_pipeline(limit=5):
-    return get_profit_by_product_pipeline() + [{'$limit': limit}]
-
-def get_average_basket_pipeline():
+def get_top_profitable_products_pipeline(limit=5, source=SOURCE_ENRICHED):
+    return get_profit_by_product_pipeline(source) + [{'$limit': limit}]
 
-        return [
+def get_average_basket_pipeline(start_date=None, end_date=None, source=SOURCE_ORDERS):
+        match = get_date_match_stage(start_date, end_date)
+        return ([match] if match else []) + [
             {
                 '$group': {
                     '_id': None,
                     'total_sales': {'$sum': '$Sales'},
-                    'order_count': {'$sum': 1}
+                    'order_count': {'$sum': get_count_expr(source)}
                 }
             },
             {
@@ -152,13 +270,13 @@ def get_average_basket_pipeline():
             }
         ]
 
-def get_average_basket_by_state_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_average_basket_by_state_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$location_details.State',
                 'total_sales': {'$sum': '$Sales'},
-                'order_count': {'$sum': 1}
+                'order_count': {'$sum': get_count_expr(source)}
             }
         },
         {
@@ -170,13 +288,13 @@ def get_average_basket_by_state_pipeline():
         {'$sort': {'average_basket': -1}}
     ]
 
-def get_average_basket_by_category_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_average_basket_by_category_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$product_details.Category',
                 'total_sales': {'$sum': '$Sales'},
-                'order_count': {'$sum': 1}
+                'order_count': {'$sum': get_count_expr(source)}
             }
         },
         {
@@ -189,8 +307,8 @@ def get_average_basket_by_category_pipeline():
     ]
 
 
-def get_sales_by_location_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_sales_by_location_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': {
@@ -203,8 +321,8 @@ def get_sales_by_location_pipeline():
         {'$sort': {'total_sales': -1}}
     ]
 
-def get_sales_by_region_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_sales_by_region_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$location_details.Region',
@@ -214,8 +332,9 @@ def get_sales_by_region_pipeline():
         {'$sort': {'total_sales': -1}}
     ]
 
-def get_average_basket_by_region_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_average_basket_by_region_pipeline(start_date=None, end_date=None, source=SOURCE_ENRICHED):
+    match = get_date_match_stage(start_date, end_date)
+    return ([match] if match else []) + get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': {
@@ -235,8 +354,8 @@ def get_average_basket_by_region_pipeline():
     ]
 
 
-def get_top_categories_pipeline(limit=5):
-    return get_base_lookup_pipeline() + [
+def get_top_categories_pipeline(limit=5, source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$product_details.Category',
@@ -248,8 +367,8 @@ def get_top_categories_pipeline(limit=5):
         {'$limit': limit}
     ]
 
-def get_top_products_by_quantity_pipeline(limit=5):
-    return get_base_lookup_pipeline() + [
+def get_top_products_by_quantity_pipeline(limit=5, source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': '$product_details.Product Name',
@@ -260,8 +379,8 @@ def get_top_products_by_quantity_pipeline(limit=5):
         {'$limit': limit}
     ]
 
-def get_sales_matrix_pipeline():
-    return get_base_lookup_pipeline() + [
+def get_sales_matrix_pipeline(source=SOURCE_ENRICHED):
+    return get_source_pipeline(source) + [
         {
             '$group': {
                 '_id': {
@@ -275,42 +394,189 @@ def get_sales_matrix_pipeline():
     ]
 
 
-def get_date_match_stage(start_date, end_date, date_filter):
-    date_formats = {
-        "Jour": "%Y-%m-%d",
-        "Mois": "%Y-%m",
-        "Trimestre": "%Y-Q%q",
-        "Année": "%Y"
-    }
+def get_bundle_pipeline(pipelines):
+    # Runs several KPI pipelines in one pass with $facet. Leading $lookup
+    # stages are hoisted before the $facet so each join runs once per
+    # document; the $unwind stages stay in each facet, so totals are not
+    # affected by the fan-out of the dimension KPIs.
+    lookups = []
+    facets = {}
+    for name, pipeline in pipelines.items():
+        stages = list(pipeline)
+        while stages and '$lookup' in stages[0]:
+            lookup = stages.pop(0)
+            if lookup not in lookups:
+                lookups.append(lookup)
+        facets[name] = stages
+    return lookups + [{'$facet': facets}]
+
+
+def get_keyset_match_stage(keys, values):
+    # Rows strictly after `values` in the order given by `keys`, a list of
+    # (field, direction) pairs, for cursor-based pagination.
+    clauses = []
+    for i, (field, direction) in enumerate(keys):
+        clause = {prev_field: value for (prev_field, _), value in zip(keys[:i], values[:i])}
+        clause[field] = {'$lt' if direction == -1 else '$gt': values[i]}
+        clauses.append(clause)
+    return {'$match': {'$or': clauses}}
+
+
+def get_paginated_pipeline(pipeline, keys, after=None, limit=None):
+    # Replaces the trailing $sort with a total order on `keys` (the last
+    # key must be unique) and fetches one extra row to detect a next page.
+    stages = list(pipeline)
+    if stages and '$sort' in stages[-1]:
+        stages.pop()
+    stages.append({'$sort': {field: direction for field, direction in keys}})
+    if after is not None:
+        stages.append(get_keyset_match_stage(keys, after))
+    if limit is not None:
+        stages.append({'$limit': limit + 1})
+    return stages
+
 
-    return {
-        '$match': {
-            'Order Date': {
-                '$gte': start_date,
-                '$lte': end_date
+# Dashboard labels -> $dateTrunc units and summed fields.
+DATE_GRANULARITIES = {
+    "Jour": "day",
+    "Mois": "month",
+    "Trimestre": "quarter",
+    "Année": "year"
+}
+
+METRIC_FIELDS = {
+    "Sales": "$Sales",
+    "Quantity": "$Quantity",
+    "Profit": "$Profit"
+}
+
+
+def get_date_match_stage(start_date=None, end_date=None):
+    # Half-open range [start_date, end_date) on the indexed Order Date.
+    date_range = {}
+    if start_date is not None:
+        date_range['$gte'] = start_date
+    if end_date is not None:
+        date_range['$lt'] = end_date
+    return {'$match': {'Order Date': date_range}} if date_range else None
+
+
+def get_metric_field(metric):
+    return METRIC_FIELDS[metric]
+
+
+def get_sales_pipeline(start_date=None, end_date=None, date_filter="Mois", metric="Sales", source=SOURCE_ROLLUP):
+    # Only Order Date and the measures are needed: no lookup, and the $match
+    # comes first so only the requested window is read from the index.
+    match = get_date_match_stage(start_date, end_date)
+    return ([match] if match else []) + [
+        {
+            '$group': {
+                '_id': {'$dateTrunc': {'date': '$Order Date', 'unit': DATE_GRANULARITIES[date_filter]}},
+                'value': {'$sum': get_metric_field(metric)}
+            }
+        },
+        {'$sort': {'_id': 1}}
+    ]
+
+
+def get_date_range_pipeline(source=SOURCE_ORDERS):
+    return [
+        {
+            '$group': {
+                '_id': None,
+                'first_date': {'$min': '$Order Date'},
+                'last_date': {'$max': '$Order Date'}
             }
         }
-    }
+    ]
 
 
-def get_metric_field(metric):
-    metric_mapping = {
-        "Montant total": "$Sales",
-        "Quantité vendue": "$Quantity",
-        "Profits": "$Profit"
-    }
-    return metric_mapping[metric]
+def get_distinct_count_pipeline(field, group_field=None, start_date=None, end_date=None, source=SOURCE_ENRICHED):
+    # Exact number of distinct `field` values (Order ID, Customer ID) per
+    # group; without a group nothing needs to be joined.
+    match = get_date_match_stage(start_date, end_date)
+    return ([match] if match else []) + (get_source_pipeline(source) if group_field else []) + [
+        {'$group': {'_id': {'group': '$' + group_field if group_field else None, 'value': '$' + field}}},
+        {'$group': {'_id': '$_id.group', 'count': {'$sum': 1}}},
+        {'$sort': {'_id': 1}}
+    ]
+
+
+def get_basket_values_pipeline(group_field=None, start_date=None, end_date=None, source=SOURCE_ENRICHED):
+    # One row per order and group with its basket value (sum of Sales).
+    match = get_date_match_stage(start_date, end_date)
+    return ([match] if match else []) + (get_source_pipeline(source) if group_field else []) + [
+        {
+            '$group': {
+                '_id': {'group': '$' + group_field if group_field else None, 'order': '$Order ID'},
+                'basket': {'$sum': '$Sales'}
+            }
+        }
+    ]
+
 
+# Dimensions of the OLAP cube (cube.py) and the expressions they group on.
+CUBE_DIMENSIONS = {
+    'category': '$product_details.Category',
+    'sub-category': '$product_details.Sub-Category',
+    'product': '$product_details.Product Name',
+    'region': '$location_details.Region',
+    'state': '$location_details.State',
+    'city': '$location_details.City',
+    'segment': '$Segment',
+    'ship-mode': '$Ship Mode',
+    'month': {'$dateTrunc': {'date': '$Order Date', 'unit': 'month'}}
+}
+CUBE_MEASURES = ['Sales', 'Profit', 'Quantity', 'order_lines']
+CUBE_JOINS = ('product', 'location')
 
-def get_sales_pipeline(start_date, end_date, date_filter, metric):
-    metric_field = get_metric_field(metric)
+
+def get_cube_pipeline(match=None, joins=CUBE_JOINS):
+    # A base cuboid: every dimension, summed measures. Segment and Ship
+    # Mode are not in the rollup, so it is built from OrdersEnriched. A line
+    # joined to duplicated customers, products or postal codes appears
+    # several times there; it is counted once per match of `joins` only
+    # ('product', 'location'), like the KPIs computed on Orders.
+    pipeline = [{'$match': match}] if match else []
+    return pipeline + [
+        {
+            '$group': {
+                '_id': {'order': '$order_ref', **{join: f'$_id.{join}' for join in joins}},
+                **{dimension: {'$first': expr} for dimension, expr in CUBE_DIMENSIONS.items()},
+                **{measure: {'$first': '$' + measure} for measure in ('Sales', 'Profit', 'Quantity')}
+            }
+        },
+        {
+            '$group': {
+                '_id': {dimension: '$' + dimension for dimension in CUBE_DIMENSIONS},
+                'Sales': {'$sum': '$Sales'},
+                'Profit': {'$sum': '$Profit'},
+                'Quantity': {'$sum': '$Quantity'},
+                'order_lines': {'$sum': 1}
+            }
+        }
+    ]
+
+
+def get_cube_catalog_pipeline():
     return [
-        get_date_match_stage(start_date, end_date, date_filter),
-        get_base_lookup_pipeline(),
+        {'$group': {'_id': '$cuboid', 'rows': {'$sum': 1}}},
+        {'$sort': {'rows': 1}}
+    ]
+
+
+def get_cube_query_pipeline(cuboid, dimensions, filters=None, measures=CUBE_MEASURES):
+    # Rolls the rows of a materialized cuboid up to `dimensions`;
+    # `filters` maps a dimension to the values to keep.
+    match = {'cuboid': cuboid}
+    match.update({dimension: {'$in': list(values)} for dimension, values in (filters or {}).items()})
+    return [
+        {'$match': match},
         {
             '$group': {
-                '_id': '$region',
-                'value': {'$sum': metric_field}
+                '_id': {dimension: '$' + dimension for dimension in dimensions} or None,
+                **{measure: {'$sum': '$' + measure} for measure in measures}
             }
         }
-        ]
\ No newline at end of file
+    ]
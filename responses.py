@@ -0,0 +1,76 @@
+import json
+
+import orjson
+import pandas as pd
+import pyarrow as pa
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+
+def encode_default(obj):
+    if isinstance(obj, pd.Timestamp):
+        return obj.isoformat()
+    if obj is pd.NaT or obj is pd.NA:
+        return None
+    return jsonable_encoder(obj)
+
+
+def dumps(content):
+    return orjson.dumps(content, default=encode_default, option=ORJSON_OPTIONS)
+
+
+class ORJSONResponse(JSONResponse):
+    # Handles datetimes and numpy scalars natively, without the
+    # jsonable_encoder pass when returned directly from an endpoint.
+    def render(self, content):
+        return dumps(content)
+
+
+def wants_arrow(request):
+    return ARROW_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def flatten(document, prefix=""):
+    # Nested fields become dotted columns ('_id.product'), as in columnar.py.
+    row = {}
+    for key, value in document.items():
+        if isinstance(value, dict):
+            row.update(flatten(value, f"{prefix}{key}."))
+        else:
+            row[f"{prefix}{key}"] = value
+    return row
+
+
+def to_arrow_table(data):
+    if isinstance(data, pd.DataFrame):
+        return pa.Table.from_pandas(data, preserve_index=False)
+    if isinstance(data, dict):
+        data = [data]
+    return pa.Table.from_pylist([flatten(document) for document in data])
+
+
+def arrow_response(data, metadata=None):
+    table = to_arrow_table(data)
+    if metadata:
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            **{key: json.dumps(jsonable_encoder(value)) for key, value in metadata.items()}
+        })
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(sink.getvalue().to_pybytes(), media_type=ARROW_MEDIA_TYPE)
+
+
+def respond(request, data, **metadata):
+    # Content negotiation: Arrow IPC stream when asked for, JSON otherwise.
+    # Extra fields (cursor, version, ...) go in the Arrow schema metadata.
+    if wants_arrow(request):
+        return arrow_response(data, metadata)
+    if isinstance(data, pd.DataFrame):
+        data = data.to_dict(orient="records")
+    return ORJSONResponse({**metadata, "data": data})
+
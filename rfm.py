@@ -0,0 +1,113 @@
+import threading
+
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+
+from config import ELBOW_N_JOBS, ELBOW_MINIBATCH_THRESHOLD, RFM_REFERENCE_DATE
+from metrics import MODEL_FIT_DURATION
+
+RFM_FEATURES = ['Recency', 'Frequency', 'Monetary']
+
+
+def rfm_orders_frame(orders):
+    df = pd.DataFrame(orders)
+    df = df.rename(columns={
+        '_id': 'Customer ID',
+        'last_purchase': 'Order Date',
+        'total_sales': 'Monetary',
+        'frequency': 'Frequency'
+    })
+
+    # Order Date is stored as a BSON datetime by ingest.py; this is a
+    # no-op then and only parses legacy string imports.
+    df['Order Date'] = pd.to_datetime(df['Order Date'])
+    return df
+
+
+def get_reference_date(frame):
+    # The last purchase of the data unless RFM_REFERENCE_DATE is set, so
+    # recency only changes with the data.
+    if RFM_REFERENCE_DATE:
+        return pd.Timestamp(RFM_REFERENCE_DATE)
+    return frame['Order Date'].max()
+
+
+def build_rfm_frame(orders, reference_date=None):
+    df = rfm_orders_frame(orders)
+    if reference_date is None:
+        reference_date = get_reference_date(df)
+    df['Recency'] = (reference_date - df['Order Date']).dt.days
+    return df
+
+
+def fit_inertia(matrix, k, minibatch=False):
+    if minibatch:
+        model = MiniBatchKMeans(n_clusters=k, random_state=42, n_init=3)
+    else:
+        model = KMeans(n_clusters=k, random_state=42)
+    model.fit(matrix)
+    return k, model.inertia_
+
+
+class RFMMatrix:
+    # Standardized RFM matrix of one data version, with the inertia of every
+    # k already fitted so slider moves inside a known range cost nothing.
+
+    def __init__(self, n_jobs=ELBOW_N_JOBS, minibatch_threshold=ELBOW_MINIBATCH_THRESHOLD):
+        self.n_jobs = n_jobs
+        self.minibatch_threshold = minibatch_threshold
+        self.version = None
+        self.frame = None
+        self.matrix = None
+        self.inertia = {}
+        self.lock = threading.Lock()
+
+    def update(self, version, orders):
+        frame = build_rfm_frame(orders)
+        matrix = StandardScaler().fit_transform(frame[RFM_FEATURES])
+        with self.lock:
+            self.frame = frame
+            self.matrix = matrix
+            self.inertia = {}
+            self.version = version
+
+    def elbow(self, max_k):
+        # The fits run outside the lock: other requests and update() do not
+        # wait for them. `inertia` stays the cache of `matrix` even if
+        # update() replaces both meanwhile.
+        with self.lock:
+            matrix = self.matrix
+            inertia = self.inertia
+            missing = [k for k in range(1, max_k + 1) if k not in inertia]
+        if missing:
+            minibatch = len(matrix) > self.minibatch_threshold
+            with MODEL_FIT_DURATION.time('elbow'):
+                results = Parallel(n_jobs=self.n_jobs)(
+                    delayed(fit_inertia)(matrix, k, minibatch) for k in missing
+                )
+            with self.lock:
+                inertia.update(results)
+        with self.lock:
+            return [inertia[k] for k in range(1, max_k + 1)]
+
+
+def fit_rfm_model(frame, n_clusters=3):
+    scaler = StandardScaler()
+    with MODEL_FIT_DURATION.time('standard_scaler'):
+        rfm_normalized = scaler.fit_transform(frame[RFM_FEATURES])
+
+    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    with MODEL_FIT_DURATION.time('kmeans'):
+        frame = frame.assign(Cluster=kmeans.fit_predict(rfm_normalized))
+
+    cluster_stats = {
+        'averages': {
+            'recency': frame.groupby('Cluster')['Recency'].mean().to_dict(),
+            'frequency': frame.groupby('Cluster')['Frequency'].mean().to_dict(),
+            'monetary': frame.groupby('Cluster')['Monetary'].mean().to_dict()
+        },
+        'distribution': frame['Cluster'].value_counts(normalize=True).to_dict()
+    }
+    return scaler, kmeans, cluster_stats
@@ -0,0 +1,105 @@
+from pymongo import ASCENDING
+from pipelines import (
+    get_rollup_pipeline, get_rfm_pipeline, SOURCE_COLLECTIONS, SOURCE_ROLLUP, ROLLUP_MEASURES,
+    CUSTOMER_RFM_COLLECTION
+)
+from database import get_db
+
+ROLLUP_COLLECTION = SOURCE_COLLECTIONS[SOURCE_ROLLUP]
+
+
+def create_rollup_indexes(db):
+    collection = db[ROLLUP_COLLECTION]
+    collection.create_index([('Order Date', ASCENDING)])
+    collection.create_index([('Product ID', ASCENDING)])
+    collection.create_index([('Postal Code', ASCENDING)])
+
+
+def rebuild_rollups(db):
+    db.Orders.aggregate(
+        get_rollup_pipeline() + [{'$out': ROLLUP_COLLECTION}],
+        allowDiskUse=True
+    )
+    create_rollup_indexes(db)
+    return db[ROLLUP_COLLECTION].estimated_document_count()
+
+
+def merge_into_rollups(db, match):
+    # Adds the contribution of orders selected by `match` to the rollup. Only
+    # call it for orders that were not counted yet, sums are not idempotent.
+    db.Orders.aggregate(
+        get_rollup_pipeline(match) + [
+            {
+                '$merge': {
+                    'into': ROLLUP_COLLECTION,
+                    'on': '_id',
+                    'whenMatched': [
+                        {
+                            '$set': {
+                                field: {'$add': ['$' + field, '$$new.' + field]}
+                                for field in ROLLUP_MEASURES
+                            }
+                        }
+                    ],
+                    'whenNotMatched': 'insert'
+                }
+            }
+        ],
+        allowDiskUse=True
+    )
+
+
+def ensure_rollups(db):
+    if db[ROLLUP_COLLECTION].estimated_document_count() == 0 \
+            and db.Orders.estimated_document_count() > 0:
+        return rebuild_rollups(db)
+    return None
+
+
+def rebuild_customer_rfm(db):
+    # One document per customer with the get_rfm_pipeline() output shape:
+    # _id (Customer ID), last_purchase, total_sales, frequency.
+    db.Orders.aggregate(
+        get_rfm_pipeline() + [{'$out': CUSTOMER_RFM_COLLECTION}],
+        allowDiskUse=True
+    )
+    return db[CUSTOMER_RFM_COLLECTION].estimated_document_count()
+
+
+def merge_into_customer_rfm(db, match):
+    # Same contract as merge_into_rollups: only for orders not counted yet.
+    db.Orders.aggregate(
+        get_rfm_pipeline(match) + [
+            {
+                '$merge': {
+                    'into': CUSTOMER_RFM_COLLECTION,
+                    'on': '_id',
+                    'whenMatched': [
+                        {
+                            '$set': {
+                                'last_purchase': {'$max': ['$last_purchase', '$$new.last_purchase']},
+                                'total_sales': {'$add': ['$total_sales', '$$new.total_sales']},
+                                'frequency': {'$add': ['$frequency', '$$new.frequency']}
+                            }
+                        }
+                    ],
+                    'whenNotMatched': 'insert'
+                }
+            }
+        ],
+        allowDiskUse=True
+    )
+
+
+def ensure_customer_rfm(db):
+    if db[CUSTOMER_RFM_COLLECTION].estimated_document_count() == 0 \
+            and db.Orders.estimated_document_count() > 0:
+        return rebuild_customer_rfm(db)
+    return None
+
+
+if __name__ == "__main__":
+    count = rebuild_rollups(get_db())
+    print(f"{ROLLUP_COLLECTION}: {count} documents")
+    count = rebuild_customer_rfm(get_db())
+    print(f"{CUSTOMER_RFM_COLLECTION}: {count} documents")
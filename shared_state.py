@@ -0,0 +1,193 @@
+import contextlib
+import hashlib
+import os
+import pickle
+import shutil
+import stat
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single worker, locks are not needed
+    fcntl = None
+
+from config import SHARED_STATE_DIR
+
+# Warm state shared by the API workers of a host. A value is computed by
+# one worker and written to SHARED_STATE_DIR (tmpfs under /dev/shm, that
+# is shared memory, where it exists); the other workers read it instead of
+# computing it again. Values are stored per namespace and data version:
+# data frames as Arrow IPC files read through a memory map (numeric
+# columns are not copied), anything else pickled. Files are written under
+# a temporary name then renamed, so a reader never sees a partial value.
+# Loading a pickle runs code: the directory must belong to the user
+# running the API and be writable by nobody else.
+
+
+@contextlib.contextmanager
+def file_lock(path, blocking=True):
+    # Exclusive lock between processes, held for the `with` block. Without
+    # `blocking`, yields False at once when another process holds it.
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def secure_directory(path):
+    # Creates `path` (mode 0700) and refuses it if another user could write
+    # there: `path` must be this user's, its parents this user's or root's,
+    # a parent writable by others only if sticky (/dev/shm, /tmp).
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if not hasattr(os, 'getuid'):  # Windows: the temporary directory is per user
+        return
+    current = os.path.abspath(path)
+    while True:
+        info = os.lstat(current)
+        owners = (os.getuid(),) if current == os.path.abspath(path) else (os.getuid(), 0)
+        shared = info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+        if stat.S_ISLNK(info.st_mode) or info.st_uid not in owners \
+                or (shared and (current == os.path.abspath(path) or not info.st_mode & stat.S_ISVTX)):
+            raise PermissionError(f"Unsafe shared state directory {current}: owned by another user or writable by others")
+        parent = os.path.dirname(current)
+        if parent == current:
+            return
+        current = parent
+
+
+def replace_file(path, write):
+    # `write(tmp_path)` then an atomic rename over `path`.
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_frame(path, frame):
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def read_frame(path):
+    # The frame keeps the memory map open for as long as it references it.
+    return pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas()
+
+
+def write_pickle(path, value):
+    with open(path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+FORMATS = [('.arrow', read_frame), ('.pkl', read_pickle)]
+
+
+class SharedState:
+
+    def __init__(self, directory=SHARED_STATE_DIR):
+        secure_directory(directory)
+        self.directory = directory
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def path(self, namespace, version, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, namespace, f"v{version}", digest)
+
+    def lock(self, name):
+        return file_lock(os.path.join(self.directory, f"{name}.lock"))
+
+    def get(self, namespace, version, key, max_age=None):
+        # (found, value); values older than `max_age` seconds are ignored.
+        base = self.path(namespace, version, key)
+        for suffix, read in FORMATS:
+            try:
+                if max_age is not None and time.time() - os.path.getmtime(base + suffix) > max_age:
+                    continue
+                value = read(base + suffix)
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError, pa.ArrowInvalid):
+                continue
+            self.hits += 1
+            return True, value
+        self.misses += 1
+        return False, None
+
+    def set(self, namespace, version, key, value):
+        # Returns False when the value cannot be serialized or its version
+        # was pruned meanwhile; it then stays local to this worker.
+        base = self.path(namespace, version, key)
+        try:
+            os.makedirs(os.path.dirname(base), mode=0o700, exist_ok=True)
+            if isinstance(value, pd.DataFrame):
+                try:
+                    replace_file(base + '.arrow', lambda path: write_frame(path, value))
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                    replace_file(base + '.pkl', lambda path: write_pickle(path, value))
+            else:
+                replace_file(base + '.pkl', lambda path: write_pickle(path, value))
+        except (pickle.PicklingError, TypeError, AttributeError, OSError):
+            return False
+        self.writes += 1
+        self.prune(namespace, version)
+        return True
+
+    def prune(self, namespace, version):
+        # Older data versions are removed once a newer one is written.
+        if self.versions.get(namespace) == version:
+            return
+        self.versions[namespace] = version
+        directory = os.path.join(self.directory, namespace)
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            try:
+                older = name.startswith('v') and int(name[1:]) < version
+            except ValueError:
+                older = False
+            if older:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    def clear(self, namespace):
+        shutil.rmtree(os.path.join(self.directory, namespace), ignore_errors=True)
+        self.versions.pop(namespace, None)
+
+    def stats(self):
+        files = 0
+        size = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(('.arrow', '.pkl')):
+                    try:
+                        size += os.path.getsize(os.path.join(root, name))
+                    except FileNotFoundError:  # pruned by another worker
+                        continue
+                    files += 1
+        return {
+            'directory': self.directory,
+            'files': files,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'writes': self.writes
+        }
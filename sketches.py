@@ -0,0 +1,567 @@
+import asyncio
+import math
+import zlib
+
+import numpy as np
+import pandas as pd
+from pymongo import ASCENDING, ReplaceOne
+
+from config import SKETCH_HLL_PRECISION, SKETCH_TDIGEST_COMPRESSION
+from database import get_db
+from pipelines import SKETCH_COLLECTION, SOURCE_COLLECTIONS, SOURCE_ENRICHED
+
+# Mergeable sketches per day and dimension value, so approximate KPIs can
+# combine any date range without reading the orders again:
+# - HyperLogLog for distinct orders and customers (relative standard
+#   error 1.04 / sqrt(2^precision)),
+# - t-digest for the distribution of line Sales and of baskets (Sales
+#   summed per order and dimension value).
+# Line counts, sums, minimum and maximum are kept exactly, so averages are
+# exact; only distinct counts and quantiles are estimates.
+
+ENRICHED_COLLECTION = SOURCE_COLLECTIONS[SOURCE_ENRICHED]
+ALL = 'all'
+SKETCH_DIMENSIONS = {
+    ALL: None,
+    'region': 'location_details.Region',
+    'state': 'location_details.State',
+    'category': 'product_details.Category'
+}
+SKETCH_KEY = ['date', 'dimension', 'value']
+SKETCH_FIELDS = ['order_ref', 'Order Date', 'Order ID', 'Customer ID', 'Sales'] + [
+    field for field in SKETCH_DIMENSIONS.values() if field
+]
+BATCH_SIZE = 500000
+# Two-sided 95% interval of the HyperLogLog estimate.
+Z_95 = 1.96
+
+
+def hash_values(values):
+    return pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy()
+
+
+def bit_length(values):
+    values = values.copy()
+    length = np.zeros(len(values), dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = values >= np.uint64(1 << shift)
+        length[high] += shift
+        values[high] >>= np.uint64(shift)
+    return length + (values > 0)
+
+
+def register_ranks(hashes, precision):
+    # Register: the first `precision` bits of the hash; rank: position of
+    # the first 1 among the remaining bits.
+    width = 64 - precision
+    index = (hashes >> np.uint64(width)).astype(np.int64)
+    rest = hashes & np.uint64((1 << width) - 1)
+    return index, (width - bit_length(rest) + 1).astype(np.uint8)
+
+
+def encode_registers(precision, index, rank):
+    # Sparse (index, rank) pairs while they are smaller than the dense
+    # registers: most days of a state only see a handful of customers.
+    if len(index) * 3 < 1 << precision:
+        payload = b'S' + np.asarray(index, dtype='<u2').tobytes() + np.asarray(rank, dtype=np.uint8).tobytes()
+    else:
+        registers = np.zeros(1 << precision, dtype=np.uint8)
+        registers[index] = rank
+        payload = b'D' + registers.tobytes()
+    return bytes([precision]) + zlib.compress(payload)
+
+
+def decode_registers(data):
+    # (precision, index, rank) of the non-empty registers.
+    precision = data[0]
+    payload = zlib.decompress(data[1:])
+    if payload[:1] == b'D':
+        registers = np.frombuffer(payload, dtype=np.uint8, offset=1)
+        index = np.flatnonzero(registers)
+        return precision, index, registers[index]
+    count = (len(payload) - 1) // 3
+    index = np.frombuffer(payload, dtype='<u2', count=count, offset=1).astype(np.int64)
+    return precision, index, np.frombuffer(payload, dtype=np.uint8, offset=1 + 2 * count)
+
+
+class HyperLogLog:
+
+    def __init__(self, precision=SKETCH_HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    @classmethod
+    def from_bytes(cls, data):
+        precision, index, rank = decode_registers(data)
+        registers = np.zeros(1 << precision, dtype=np.uint8)
+        registers[index] = rank
+        return cls(precision, registers)
+
+    def to_bytes(self):
+        index = np.flatnonzero(self.registers)
+        return encode_registers(self.precision, index, self.registers[index])
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precisions")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.ldexp(1.0, -self.registers.astype(np.int64)).sum()
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities.
+            return m * math.log(m / zeros)
+        return float(raw)
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(len(self.registers))
+
+
+def k_scale(q, compression):
+    return compression / (2 * math.pi) * np.arcsin(2 * np.clip(q, 0.0, 1.0) - 1)
+
+
+def compress_centroids(groups, means, weights, compression):
+    # Centroids sorted by (group, mean); neighbours whose left quantile
+    # falls in the same unit of the k scale are merged, which keeps small
+    # centroids in the tails and large ones around the median.
+    order = np.lexsort((means, groups))
+    groups, means, weights = groups[order], means[order], weights[order]
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    sizes = np.diff(np.r_[starts, len(groups)])
+    cumulative = np.cumsum(weights)
+    before = np.repeat(cumulative[starts] - weights[starts], sizes)
+    totals = np.repeat(np.add.reduceat(weights, starts), sizes)
+    bucket = np.floor(k_scale((cumulative - weights - before) / totals, compression))
+    new = np.flatnonzero(np.r_[True, (groups[1:] != groups[:-1]) | (bucket[1:] != bucket[:-1])])
+    merged_weights = np.add.reduceat(weights, new)
+    return groups[new], np.add.reduceat(means * weights, new) / merged_weights, merged_weights
+
+
+class TDigest:
+
+    def __init__(self, means, weights, total=0.0, minimum=math.nan, maximum=math.nan,
+                 compression=SKETCH_TDIGEST_COMPRESSION):
+        self.means = np.asarray(means, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.total = float(total)
+        self.minimum = float(minimum)
+        self.maximum = float(maximum)
+        self.compression = compression
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = np.frombuffer(zlib.decompress(data), dtype='<f8')
+        compression, total, minimum, maximum = values[:4]
+        count = (len(values) - 4) // 2
+        return cls(values[4:4 + count], values[4 + count:], total, minimum, maximum, compression)
+
+    def to_bytes(self):
+        header = [self.compression, self.total, self.minimum, self.maximum]
+        return zlib.compress(np.concatenate([header, self.means, self.weights]).astype('<f8').tobytes())
+
+    @classmethod
+    def merge_all(cls, digests, compression=SKETCH_TDIGEST_COMPRESSION):
+        digests = [digest for digest in digests if len(digest.weights)]
+        if not digests:
+            return cls([], [], compression=compression)
+        means = np.concatenate([digest.means for digest in digests])
+        _, means, weights = compress_centroids(
+            np.zeros(len(means), dtype=np.int64), means,
+            np.concatenate([digest.weights for digest in digests]), compression
+        )
+        return cls(
+            means, weights,
+            sum(digest.total for digest in digests),
+            min(digest.minimum for digest in digests),
+            max(digest.maximum for digest in digests),
+            compression
+        )
+
+    @property
+    def count(self):
+        return float(self.weights.sum())
+
+    def mean(self):
+        return self.total / self.count if len(self.weights) else None
+
+    def quantile(self, q):
+        if not len(self.weights):
+            return None
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(
+            q * self.count, np.r_[0.0, centers, self.count], np.r_[self.minimum, self.means, self.maximum]
+        ))
+
+    def rank_error(self, q):
+        # Half the weight of the centroid holding the q-th value, as a share
+        # of all values: the estimate is within this many ranks of the truth.
+        if not len(self.weights):
+            return None
+        cumulative = np.cumsum(self.weights)
+        index = min(int(np.searchsorted(cumulative, q * self.count)), len(cumulative) - 1)
+        return float(self.weights[index] / 2 / self.count)
+
+
+def encode_grouped_registers(groups, group_count, hashes, precision):
+    index, rank = register_ranks(hashes, precision)
+    registers = pd.DataFrame({'group': groups, 'index': index, 'rank': rank}) \
+        .groupby(['group', 'index'], sort=True)['rank'].max()
+    owners = registers.index.get_level_values(0).to_numpy()
+    index = registers.index.get_level_values(1).to_numpy()
+    rank = registers.to_numpy()
+    bounds = np.searchsorted(owners, np.arange(group_count + 1))
+    return [encode_registers(precision, index[a:b], rank[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def encode_grouped_digests(groups, group_count, values, compression):
+    values = np.asarray(values, dtype=float)
+    owners, means, weights = compress_centroids(groups, values, np.ones(len(values)), compression)
+    stats = pd.DataFrame({'group': groups, 'value': values}).groupby('group')['value'].agg(['sum', 'min', 'max'])
+    stats = stats.reindex(range(group_count))
+    bounds = np.searchsorted(owners, np.arange(group_count + 1))
+    return [
+        TDigest(means[a:b], weights[a:b], total, minimum, maximum, compression).to_bytes()
+        for a, b, total, minimum, maximum in zip(
+            bounds[:-1], bounds[1:], stats['sum'].fillna(0.0), stats['min'], stats['max']
+        )
+    ]
+
+
+def build_sketch_documents(frame, precision=SKETCH_HLL_PRECISION, compression=SKETCH_TDIGEST_COMPRESSION):
+    # `frame`: one row per enriched order line with the SKETCH_FIELDS
+    # columns. Returns one document per day and dimension value.
+    if frame.empty:
+        return []
+    documents = []
+    for dimension, field in SKETCH_DIMENSIONS.items():
+        # A line joined to duplicated products or postal codes appears
+        # several times in OrdersEnriched; the totals count it once, like
+        # the KPIs computed on Orders and SalesRollup.
+        lines = frame.drop_duplicates('order_ref') if field is None else frame
+        days = pd.to_datetime(lines['Order Date']).dt.floor('D').to_numpy()
+        order_ids = lines['Order ID'].to_numpy()
+        order_hashes = hash_values(lines['Order ID'])
+        customer_hashes = hash_values(lines['Customer ID'])
+        sales = lines['Sales'].to_numpy(dtype=float)
+        values = lines[field].to_numpy() if field else np.full(len(lines), ALL, dtype=object)
+        grouped = pd.DataFrame({'date': days, 'value': values}).groupby(['date', 'value'], sort=True)
+        groups = grouped.ngroup().to_numpy()
+        sizes = grouped.size()
+        group_count = len(sizes)
+        baskets = pd.DataFrame({'group': groups, 'order': order_ids, 'sales': sales}) \
+            .groupby(['group', 'order'], sort=False)['sales'].sum()
+        columns = {
+            'orders': encode_grouped_registers(groups, group_count, order_hashes, precision),
+            'customers': encode_grouped_registers(groups, group_count, customer_hashes, precision),
+            'sales': encode_grouped_digests(groups, group_count, sales, compression),
+            'baskets': encode_grouped_digests(
+                baskets.index.get_level_values(0).to_numpy(), group_count, baskets.to_numpy(), compression
+            )
+        }
+        totals = np.bincount(groups, weights=sales, minlength=group_count)
+        for i, ((date, value), lines) in enumerate(sizes.items()):
+            documents.append({
+                'date': pd.Timestamp(date).to_pydatetime(),
+                'dimension': dimension,
+                'value': value,
+                'lines': int(lines),
+                'total_sales': float(totals[i]),
+                **{name: column[i] for name, column in columns.items()}
+            })
+    return documents
+
+
+class Sketches:
+    # The sketches of one or several days, for one dimension value.
+
+    def __init__(self, lines, total_sales, orders, customers, sales, baskets):
+        self.lines = lines
+        self.total_sales = total_sales
+        self.orders = orders
+        self.customers = customers
+        self.sales = sales
+        self.baskets = baskets
+
+    def to_document(self):
+        return {
+            'lines': self.lines,
+            'total_sales': self.total_sales,
+            'orders': self.orders.to_bytes(),
+            'customers': self.customers.to_bytes(),
+            'sales': self.sales.to_bytes(),
+            'baskets': self.baskets.to_bytes()
+        }
+
+
+def merge_documents(documents):
+    orders = [HyperLogLog.from_bytes(document['orders']) for document in documents]
+    customers = [HyperLogLog.from_bytes(document['customers']) for document in documents]
+    return Sketches(
+        sum(int(document['lines']) for document in documents),
+        sum(float(document['total_sales']) for document in documents),
+        HyperLogLog(orders[0].precision, np.maximum.reduce([sketch.registers for sketch in orders])),
+        HyperLogLog(customers[0].precision, np.maximum.reduce([sketch.registers for sketch in customers])),
+        TDigest.merge_all([TDigest.from_bytes(document['sales']) for document in documents]),
+        TDigest.merge_all([TDigest.from_bytes(document['baskets']) for document in documents])
+    )
+
+
+def stack_registers(blobs):
+    # Non-empty registers of every day, concatenated, with day offsets.
+    decoded = [decode_registers(blob) for blob in blobs]
+    offsets = np.r_[0, np.cumsum([len(index) for _, index, _ in decoded])]
+    return (
+        decoded[0][0], offsets,
+        np.concatenate([index for _, index, _ in decoded]),
+        np.concatenate([rank for _, _, rank in decoded])
+    )
+
+
+def stack_digests(blobs):
+    digests = [TDigest.from_bytes(blob) for blob in blobs]
+    return {
+        'offsets': np.r_[0, np.cumsum([len(digest.means) for digest in digests])],
+        'means': np.concatenate([digest.means for digest in digests]),
+        'weights': np.concatenate([digest.weights for digest in digests]),
+        'totals': np.array([digest.total for digest in digests]),
+        'minimums': np.array([digest.minimum for digest in digests]),
+        'maximums': np.array([digest.maximum for digest in digests]),
+        'compression': digests[0].compression
+    }
+
+
+class SketchSeries:
+    # The documents of one dimension value sorted by date and decoded into
+    # contiguous arrays: the sketches of a date range are array slices.
+
+    def __init__(self, documents):
+        self.dates = np.array([pd.Timestamp(d['date']).to_datetime64() for d in documents], dtype='datetime64[ns]')
+        self.lines = np.array([int(d['lines']) for d in documents])
+        self.total_sales = np.array([float(d['total_sales']) for d in documents])
+        self.registers = {name: stack_registers([d[name] for d in documents]) for name in ('orders', 'customers')}
+        self.digests = {name: stack_digests([d[name] for d in documents]) for name in ('sales', 'baskets')}
+
+    def hyperloglog(self, name, low, high):
+        precision, offsets, index, rank = self.registers[name]
+        sketch = HyperLogLog(precision)
+        np.maximum.at(sketch.registers, index[offsets[low]:offsets[high]], rank[offsets[low]:offsets[high]])
+        return sketch
+
+    def tdigest(self, name, low, high):
+        stacked = self.digests[name]
+        start, stop = stacked['offsets'][low], stacked['offsets'][high]
+        means, weights = stacked['means'][start:stop], stacked['weights'][start:stop]
+        compression = stacked['compression']
+        if not len(means):
+            return TDigest([], [], compression=compression)
+        _, means, weights = compress_centroids(np.zeros(len(means), dtype=np.int64), means, weights, compression)
+        return TDigest(
+            means, weights, stacked['totals'][low:high].sum(),
+            np.nanmin(stacked['minimums'][low:high]), np.nanmax(stacked['maximums'][low:high]), compression
+        )
+
+    def merge(self, start_date=None, end_date=None):
+        # Sketches over the days in [start_date, end_date), None if there is none.
+        low = np.searchsorted(self.dates, np.datetime64(start_date)) if start_date else 0
+        high = np.searchsorted(self.dates, np.datetime64(end_date)) if end_date else len(self.dates)
+        if high <= low:
+            return None
+        return Sketches(
+            int(self.lines[low:high].sum()),
+            float(self.total_sales[low:high].sum()),
+            self.hyperloglog('orders', low, high),
+            self.hyperloglog('customers', low, high),
+            self.tdigest('sales', low, high),
+            self.tdigest('baskets', low, high)
+        )
+
+
+class SketchStore:
+    # Sketches of the current data version by dimension and value, decoded
+    # once per version; a query merges the days of its range.
+
+    def __init__(self):
+        self.version = None
+        self.index = {}
+        self.documents = 0
+        self.lock = asyncio.Lock()
+
+    async def get(self, version, load):
+        # `load()` returns every sketch document.
+        if self.version != version:
+            async with self.lock:
+                if self.version != version:
+                    documents = await load()
+                    self.index = index_documents(documents)
+                    self.documents = len(documents)
+                    self.version = version
+        return self
+
+    def query(self, dimension, start_date=None, end_date=None):
+        # {value: Sketches} over the days in [start_date, end_date).
+        result = {}
+        for value, series in self.index.get(dimension, {}).items():
+            sketches = series.merge(start_date, end_date)
+            if sketches is not None:
+                result[value] = sketches
+        return result
+
+    def stats(self):
+        return {"version": self.version, "documents": self.documents}
+
+
+def index_documents(documents):
+    index = {}
+    for document in sorted(documents, key=lambda d: pd.Timestamp(d['date'])):
+        index.setdefault(document['dimension'], {}).setdefault(document['value'], []).append(document)
+    return {
+        dimension: {value: SketchSeries(docs) for value, docs in values.items()}
+        for dimension, values in index.items()
+    }
+
+
+def count_bounds(sketch):
+    estimate = sketch.estimate()
+    error = sketch.relative_error()
+    return round(estimate), {
+        'low': max(0, math.floor(estimate * (1 - Z_95 * error))),
+        'high': math.ceil(estimate * (1 + Z_95 * error)),
+        'relative_error': round(error, 4)
+    }
+
+
+def row_id(dimension, value):
+    return None if dimension == ALL else value
+
+
+def get_approx_distinct_counts(store, dimension, start_date=None, end_date=None):
+    rows = []
+    for value, sketches in sorted(store.query(dimension, start_date, end_date).items()):
+        orders, orders_error = count_bounds(sketches.orders)
+        customers, customers_error = count_bounds(sketches.customers)
+        rows.append({
+            '_id': row_id(dimension, value),
+            'orders': orders,
+            'customers': customers,
+            'error': {'orders': orders_error, 'customers': customers_error}
+        })
+    return rows
+
+
+def get_approx_basket_distribution(store, dimension, quantiles, start_date=None, end_date=None):
+    rows = []
+    for value, sketches in sorted(store.query(dimension, start_date, end_date).items()):
+        baskets = sketches.baskets
+        rows.append({
+            '_id': row_id(dimension, value),
+            'count': int(baskets.count),
+            'mean': baskets.mean(),
+            'quantiles': {str(q): baskets.quantile(q) for q in quantiles},
+            'error': {str(q): baskets.rank_error(q) for q in quantiles}
+        })
+    return rows
+
+
+def get_exact_basket_distribution(rows, quantiles):
+    # Same output as the approximate version, from get_basket_values_pipeline rows.
+    if not rows:
+        return []
+    frame = pd.DataFrame({
+        'group': [row['_id'].get('group') for row in rows],
+        'basket': [row['basket'] for row in rows]
+    })
+    result = []
+    for group, baskets in frame.groupby('group', dropna=False, sort=True)['basket']:
+        values = baskets.to_numpy()
+        result.append({
+            '_id': None if pd.isna(group) else group,
+            'count': len(values),
+            'mean': float(values.mean()),
+            'quantiles': {str(q): float(np.quantile(values, q)) for q in quantiles}
+        })
+    return result
+
+
+def get_approx_average_basket(store, start_date=None, end_date=None):
+    # get_average_basket_pipeline: Sales per order line.
+    sketches = store.query(ALL, start_date, end_date).get(ALL)
+    return {"average_basket": sketches.total_sales / sketches.lines if sketches else 0}
+
+
+def get_approx_average_basket_by_region(store, start_date=None, end_date=None):
+    # get_average_basket_by_region_pipeline: Sales per order.
+    rows = [
+        {'_id': value, 'average_basket': sketches.baskets.mean()}
+        for value, sketches in store.query('region', start_date, end_date).items()
+    ]
+    return sorted(rows, key=lambda row: row['average_basket'], reverse=True)
+
+
+def read_enriched(db, match=None):
+    projection = {field: 1 for field in SKETCH_FIELDS}
+    return to_frame(list(db[ENRICHED_COLLECTION].find(match or {}, projection)))
+
+
+def to_frame(documents):
+    return pd.json_normalize(documents) if documents else pd.DataFrame(columns=SKETCH_FIELDS)
+
+
+def read_enriched_by_day(db, batch_size=BATCH_SIZE):
+    # Frames of about `batch_size` lines sorted by date, never splitting a
+    # day, so each sketch document is built from a single frame.
+    cursor = db[ENRICHED_COLLECTION].find({}, {field: 1 for field in SKETCH_FIELDS}) \
+        .sort('Order Date', ASCENDING)
+    pending = []
+    for document in cursor:
+        if len(pending) >= batch_size and document['Order Date'].date() != pending[-1]['Order Date'].date():
+            yield to_frame(pending)
+            pending = []
+        pending.append(document)
+    if pending:
+        yield to_frame(pending)
+
+
+def create_sketch_indexes(db):
+    db[SKETCH_COLLECTION].create_index([(field, ASCENDING) for field in SKETCH_KEY], unique=True)
+
+
+def rebuild_sketches(db, batch_size=BATCH_SIZE):
+    db[SKETCH_COLLECTION].drop()
+    create_sketch_indexes(db)
+    for frame in read_enriched_by_day(db, batch_size):
+        documents = build_sketch_documents(frame)
+        if documents:
+            db[SKETCH_COLLECTION].insert_many(documents, ordered=False)
+    return db[SKETCH_COLLECTION].estimated_document_count()
+
+
+def merge_into_sketches(db, match):
+    # Same contract as merge_into_rollups: only for orders not counted yet.
+    # An order whose lines arrive in two batches counts as two baskets.
+    operations = []
+    for document in build_sketch_documents(read_enriched(db, match)):
+        key = {field: document[field] for field in SKETCH_KEY}
+        existing = db[SKETCH_COLLECTION].find_one(key)
+        if existing is not None:
+            document = {**key, **merge_documents([existing, document]).to_document()}
+        operations.append(ReplaceOne(key, document, upsert=True))
+    if operations:
+        db[SKETCH_COLLECTION].bulk_write(operations, ordered=False)
+    return len(operations)
+
+
+def ensure_sketches(db):
+    if db[SKETCH_COLLECTION].estimated_document_count() == 0 \
+            and db[ENRICHED_COLLECTION].estimated_document_count() > 0:
+        return rebuild_sketches(db)
+    return None
+
+
+if __name__ == "__main__":
+    count = rebuild_sketches(get_db())
+    print(f"{SKETCH_COLLECTION}: {count} documents")
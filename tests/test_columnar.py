@@ -0,0 +1,191 @@
+import math
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+import pipelines
+from backends import ArrowBackend
+from columnar import evaluate
+from config import MONGO_URI
+from ingest import TABLES, ingest
+from pipelines import (
+    SOURCE_COLLECTIONS, SOURCE_ENRICHED, SOURCE_ORDERS, SOURCE_ROLLUP, CUSTOMER_RFM_COLLECTION
+)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+SOURCES = [SOURCE_ORDERS, SOURCE_ENRICHED, SOURCE_ROLLUP]
+KPI_PIPELINES = [
+    pipelines.get_sales_by_state_pipeline,
+    pipelines.get_sales_by_category_pipeline,
+    pipelines.get_sales_by_product_pipeline,
+    pipelines.get_profit_by_category_pipeline,
+    pipelines.get_sales_by_region_pipeline,
+    pipelines.get_top_categories_pipeline,
+    pipelines.get_sales_matrix_pipeline,
+    pipelines.get_sales_by_location_pipeline
+]
+
+
+def normalize(value):
+    # Mongo and pandas agree up to float summation order and date types.
+    if isinstance(value, dict):
+        return {key: normalize(value[key]) for key in sorted(value)}
+    if isinstance(value, list):
+        return sorted((normalize(item) for item in value), key=repr)
+    if isinstance(value, float):
+        return None if math.isnan(value) else float(f"{value:.9g}")
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return pd.Timestamp(value).floor('ms').to_pydatetime()
+    return value
+
+
+@pytest.fixture(scope='module')
+def arrow(tmp_path_factory):
+    backend = ArrowBackend(data_dir=DATA_DIR, cache_dir=str(tmp_path_factory.mktemp('parquet')))
+    backend.load()
+    return backend
+
+
+def joined_orders(tables):
+    # Orders with the three inner joins of get_base_lookup_pipeline, fan-out included.
+    return tables['Orders'].merge(
+        tables['Customers'][['Customer ID']], on='Customer ID'
+    ).merge(
+        tables['Products'][['Product ID', 'Category']], on='Product ID'
+    ).merge(
+        tables['Location'][['Postal Code', 'Region']], on='Postal Code'
+    )
+
+
+def test_lookup_unwind_is_an_inner_join_with_fan_out():
+    orders = pd.DataFrame({
+        'Row ID': [1, 2, 3, 4],
+        'Product ID': ['P1', 'P2', 'P3', 'P1'],
+        'Sales': [10.0, 20.0, 40.0, 80.0]
+    })
+    products = pd.DataFrame({
+        'Product ID': ['P1', 'P1', 'P2'],  # P1 twice, P3 missing
+        'Category': ['Furniture', 'Office Supplies', 'Technology']
+    })
+    pipeline = [
+        {'$lookup': {'from': 'Products', 'localField': 'Product ID', 'foreignField': 'Product ID',
+                     'as': 'product_details'}},
+        {'$unwind': '$product_details'},
+        {'$group': {'_id': '$product_details.Category', 'total_sales': {'$sum': '$Sales'},
+                    'lines': {'$sum': 1}}},
+        {'$sort': {'total_sales': -1}}
+    ]
+    assert evaluate(orders, pipeline, {'Products': products}) == [
+        {'_id': 'Furniture', 'total_sales': 90.0, 'lines': 2},
+        {'_id': 'Office Supplies', 'total_sales': 90.0, 'lines': 2},
+        {'_id': 'Technology', 'total_sales': 20.0, 'lines': 1}
+    ]
+
+
+def test_facet_keeps_totals_unaffected_by_the_fan_out():
+    orders = pd.DataFrame({
+        'Customer ID': ['C1', 'C1'], 'Product ID': ['P1', 'P2'], 'Postal Code': [1, 1], 'Sales': [10.0, 20.0]
+    })
+    tables = {
+        'Customers': pd.DataFrame({'Customer ID': ['C1']}),
+        'Products': pd.DataFrame({'Product ID': ['P1', 'P1', 'P2'], 'Category': ['A', 'B', 'C']}),
+        'Location': pd.DataFrame({'Postal Code': [1], 'Region': ['East']})
+    }
+    bundle = pipelines.get_bundle_pipeline({
+        'total-sales': pipelines.get_total_sales_pipeline(SOURCE_ORDERS),
+        'sales-by-category': pipelines.get_sales_by_category_pipeline(SOURCE_ORDERS)
+    })
+    result = evaluate(orders, bundle, tables)[0]
+    assert result['total-sales'] == [{'_id': None, 'total_sales': 30.0}]
+    assert normalize(result['sales-by-category']) == normalize([
+        {'_id': 'A', 'total_sales': 10.0}, {'_id': 'B', 'total_sales': 10.0}, {'_id': 'C', 'total_sales': 20.0}
+    ])
+
+
+def test_sort_puts_nulls_first_ascending_and_last_descending():
+    df = pd.DataFrame({'region': ['East', None, 'West', None], 'total': [1.0, 2.0, None, 4.0]})
+    assert [row['total'] for row in evaluate(df, [{'$sort': {'total': -1}}], {})] == [4.0, 2.0, 1.0, None]
+    assert [row['total'] for row in evaluate(df, [{'$sort': {'total': 1}}], {})] == [None, 1.0, 2.0, 4.0]
+    assert [(row['region'], row['total']) for row in evaluate(df, [{'$sort': {'region': 1, 'total': -1}}], {})] == [
+        (None, 4.0), (None, 2.0), ('East', 1.0), ('West', None)
+    ]
+
+
+@pytest.mark.parametrize('limit', [0, -1])
+def test_limit_must_be_positive(limit):
+    df = pd.DataFrame({'total': [1.0, 2.0]})
+    with pytest.raises(ValueError):
+        evaluate(df, [{'$limit': limit}], {})
+
+
+@pytest.mark.parametrize('source', SOURCES)
+def test_kpis_match_pandas_joins_on_the_sample_data(arrow, source):
+    expected = joined_orders(arrow.tables)
+    collection = SOURCE_COLLECTIONS[source]
+    for pipeline_fn, column, field in ((pipelines.get_sales_by_category_pipeline, 'Category', 'total_sales'),
+                                       (pipelines.get_sales_by_region_pipeline, 'Region', 'total_sales')):
+        rows = arrow.run(collection, pipeline_fn(source=source))
+        totals = expected.groupby(column)['Sales'].sum()
+        assert normalize(rows) == normalize([{'_id': key, field: value} for key, value in totals.items()])
+        assert [row[field] for row in rows] == sorted((row[field] for row in rows), reverse=True)
+
+
+def test_sample_data_has_product_fan_out(arrow):
+    # Product ID is not unique in Products: the KPIs above exercise the fan-out.
+    products = arrow.tables['Products']
+    assert products['Product ID'].duplicated().any()
+    assert len(arrow.tables[SOURCE_COLLECTIONS[SOURCE_ENRICHED]]) == len(joined_orders(arrow.tables))
+
+
+@pytest.fixture(scope='module')
+def mongo_db():
+    # The sample CSVs loaded into a scratch database; skipped without a server.
+    client = MongoClient(os.getenv('TEST_MONGO_URI', MONGO_URI), serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except PyMongoError:
+        pytest.skip("no MongoDB server")
+    db = client['ecommerce_columnar_test']
+    client.drop_database(db.name)
+    ingest(db, data_dir=DATA_DIR, drop=True)
+    yield db
+    client.drop_database(db.name)
+    client.close()
+
+
+@pytest.mark.parametrize('source', SOURCES)
+@pytest.mark.parametrize('pipeline_fn', KPI_PIPELINES, ids=lambda fn: fn.__name__)
+def test_kpis_match_mongo(arrow, mongo_db, source, pipeline_fn):
+    collection = SOURCE_COLLECTIONS[source]
+    pipeline = pipeline_fn(source=source)
+    expected = list(mongo_db[collection].aggregate(pipeline, allowDiskUse=True))
+    assert normalize(arrow.run(collection, pipeline)) == normalize(expected)
+
+
+@pytest.mark.parametrize('collection', list(TABLES))
+def test_tables_match_mongo(arrow, mongo_db, collection):
+    fields = [field for field in TABLES[collection]['dtypes'] if field != '_id']
+    projection = {'_id': 0, **{field: 1 for field in fields}}
+    expected = list(mongo_db[collection].find({}, projection))
+    rows = evaluate(arrow.tables[collection], [{'$project': {field: 1 for field in fields}}], {})
+
+    def present(row):
+        return {key: value for key, value in row.items() if key != '_id' and value is not None}
+
+    assert normalize([present(row) for row in rows]) == normalize([present(row) for row in expected])
+
+
+def test_bundle_and_rfm_match_mongo(arrow, mongo_db):
+    bundle = pipelines.get_bundle_pipeline({
+        'total-sales': pipelines.get_total_sales_pipeline(SOURCE_ROLLUP),
+        'sales-by-region': pipelines.get_sales_by_region_pipeline(SOURCE_ROLLUP),
+        'top-categories': pipelines.get_top_categories_pipeline(5, SOURCE_ROLLUP)
+    })
+    rollup = SOURCE_COLLECTIONS[SOURCE_ROLLUP]
+    assert normalize(arrow.run(rollup, bundle)) == normalize(list(mongo_db[rollup].aggregate(bundle)))
+    rfm = list(mongo_db[CUSTOMER_RFM_COLLECTION].find())
+    assert normalize(arrow.run(CUSTOMER_RFM_COLLECTION, [])) == normalize(rfm)
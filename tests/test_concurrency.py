@@ -0,0 +1,150 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI
+
+from concurrency import ConcurrencyLimiter, Overloaded, SingleFlight
+from main import http_error
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_single_flight_shares_one_computation():
+    flights = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {'total_sales': 1.0}
+
+    async def scenario():
+        results = await asyncio.gather(*[flights.run(('kpi', 1), compute) for _ in range(5)])
+        again = await flights.run(('kpi', 1), compute)
+        return results, again
+
+    results, again = run(scenario())
+    assert calls == [1, 1]  # five callers in flight, then a new computation
+    assert all(result is results[0] for result in results)
+    assert again == {'total_sales': 1.0}
+    assert flights.stats() == {'in_flight': 0}
+
+
+def test_single_flight_keys_are_independent():
+    flights = SingleFlight()
+
+    async def scenario():
+        async def value(v):
+            await asyncio.sleep(0.01)
+            return v
+        return await asyncio.gather(flights.run(('a',), lambda: value(1)), flights.run(('b',), lambda: value(2)))
+
+    assert run(scenario()) == [1, 2]
+
+
+def test_single_flight_propagates_errors_to_every_caller():
+    flights = SingleFlight()
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise ValueError("pipeline failed")
+
+    async def scenario():
+        return await asyncio.gather(*[flights.run(('kpi',), failing) for _ in range(3)], return_exceptions=True)
+
+    errors = run(scenario())
+    assert calls == [1]
+    assert all(isinstance(error, ValueError) and str(error) == "pipeline failed" for error in errors)
+    assert flights.stats() == {'in_flight': 0}
+
+
+def test_single_flight_survives_a_cancelled_caller():
+    flights = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def scenario():
+        first = asyncio.ensure_future(flights.run(('rfm',), compute))
+        second = asyncio.ensure_future(flights.run(('rfm',), compute))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second, first.cancelled()
+
+    assert run(scenario()) == (42, True)
+
+
+def test_limiter_runs_at_most_limit_at_once():
+    limiter = ConcurrencyLimiter('elbow', 2, queue_size=10, timeout=5)
+    running = []
+    peak = []
+
+    async def compute():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.02)
+        running.pop()
+        return True
+
+    async def scenario():
+        return await asyncio.gather(*[limiter.run(compute) for _ in range(8)])
+
+    assert run(scenario()) == [True] * 8
+    assert max(peak) == 2
+    assert limiter.stats()['running'] == 0 and limiter.stats()['waiting'] == 0
+
+
+def test_limiter_rejects_with_429_then_503():
+    async def scenario(timeout):
+        limiter = ConcurrencyLimiter('rfm', 1, queue_size=1, timeout=timeout)
+
+        async def slow():
+            await asyncio.sleep(0.3)
+            return 'ok'
+
+        return await asyncio.gather(*[limiter.run(slow) for _ in range(3)], return_exceptions=True)
+
+    first, queued, refused = run(scenario(timeout=5))
+    assert (first, queued) == ('ok', 'ok')
+    assert isinstance(refused, Overloaded) and refused.status == 429 and refused.retry_after >= 1
+
+    first, timed_out, refused = run(scenario(timeout=0.05))
+    assert first == 'ok'
+    assert isinstance(timed_out, Overloaded) and timed_out.status == 503
+    assert isinstance(refused, Overloaded) and refused.status == 429
+
+
+def test_overloaded_responses_carry_retry_after():
+    limiter = ConcurrencyLimiter('basket-distribution', 1, queue_size=1, timeout=0.1)
+    app = FastAPI()
+
+    @app.get("/slow")
+    async def slow():
+        try:
+            return await limiter.run(lambda: asyncio.sleep(0.3, result={'ok': True}))
+        except Exception as e:
+            raise http_error(e)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*[client.get("/slow") for _ in range(3)])
+
+    responses = run(scenario())
+    assert sorted(response.status_code for response in responses) == [200, 429, 503]
+    for response in responses:
+        if response.status_code != 200:
+            assert int(response.headers['Retry-After']) >= 1
+            assert 'basket-distribution' in response.json()['detail']
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_http_error_maps_overloaded(status):
+    error = http_error(Overloaded('elbow', status, 7))
+    assert error.status_code == status and error.headers == {'Retry-After': '7'}
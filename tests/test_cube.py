@@ -0,0 +1,92 @@
+import asyncio
+import os
+from datetime import datetime
+
+import httpx
+from pymongo import UpdateOne
+
+import cube
+import main
+from backends import ArrowBackend
+from instrumentation import InstrumentedBackend, QueryStats
+from pipelines import CUBE_COLLECTION
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+class FakeCollection:
+
+    def __init__(self, documents=None, cuboids=None):
+        self.documents = documents or []
+        self.cuboids = cuboids or []
+        self.operations = []
+
+    def aggregate(self, pipeline, **kwargs):
+        return list(self.documents)
+
+    def distinct(self, field):
+        return self.cuboids
+
+    def bulk_write(self, operations, ordered=True):
+        self.operations.extend(operations)
+
+
+def base_document(city, sales):
+    keys = {dimension: None for dimension in cube.CUBE_DIMENSIONS}
+    keys.update({'category': 'Furniture', 'region': 'East', 'city': city, 'month': datetime(2023, 1, 1)})
+    return {'_id': keys, 'Sales': sales, 'Profit': 1.0, 'Quantity': 2, 'order_lines': 1}
+
+
+def test_merge_into_cube_filters_missing_members_on_none():
+    # One order line without a city (no matching Location row).
+    enriched = FakeCollection([base_document(None, 10.0), base_document('Boston', 5.0)])
+    cells = FakeCollection(cuboids=['region,state,city', 'category'])
+    db = {cube.ENRICHED_COLLECTION: enriched, CUBE_COLLECTION: cells}
+
+    assert cube.merge_into_cube(db, {'Row ID': {'$in': [1, 2]}}) == 3
+    filters = [operation._filter for operation in cells.operations]
+    assert all(isinstance(operation, UpdateOne) for operation in cells.operations)
+    assert {'cuboid': 'region,state,city', 'region': 'East', 'state': None, 'city': None} in filters
+    for key in filters:
+        assert all(value is None or value == value for value in key.values()), key
+
+
+def test_roll_up_keeps_missing_members_as_one_cell():
+    base = cube.base_frame([base_document(None, 10.0), base_document(None, 5.0), base_document('Boston', 1.0)])
+    records = cube.cell_records(cube.roll_up(base, ['city']))
+    assert sorted(records, key=lambda row: row['city'] or '') == [
+        {'city': None, 'Sales': 15.0, 'Profit': 2.0, 'Quantity': 4, 'order_lines': 2},
+        {'city': 'Boston', 'Sales': 1.0, 'Profit': 1.0, 'Quantity': 2, 'order_lines': 1}
+    ]
+
+
+def get_json(path, params):
+    async def fetch():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.get(path, params=params)
+            response.raise_for_status()
+            return response.json()
+    return asyncio.run(fetch())
+
+
+def test_apex_matches_total_sales(monkeypatch, tmp_path):
+    # The sample data has duplicated Product IDs and Postal Codes, so some
+    # order lines appear several times in OrdersEnriched.
+    arrow = ArrowBackend(data_dir=DATA_DIR, cache_dir=str(tmp_path / 'parquet'))
+    arrow.load()
+    monkeypatch.setattr(main, 'backend', InstrumentedBackend(arrow, QueryStats()))
+    monkeypatch.setattr(main.data_version, 'loader', arrow.data_version)
+    monkeypatch.setattr(main.data_version, 'version', None)
+    main.kpi_cache.invalidate()
+
+    orders = arrow.tables['Orders']
+    apex = get_json('/kpi/cube', {'rows': ''})['data']
+    total = get_json('/kpi/total-sales', {})['data']
+    assert len(apex) == 1
+    assert abs(apex[0]['Sales'] - total['total_sales']) < 1e-6
+    assert apex[0]['order_lines'] == len(orders)
+
+    segments = get_json('/kpi/cube', {'rows': 'segment', 'measures': 'Sales'})['data']
+    expected = orders.groupby('Segment')['Sales'].sum()
+    assert {row['segment']: round(row['Sales'], 6) for row in segments} == expected.round(6).to_dict()
@@ -0,0 +1,133 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from database import run_sync
+from forecast import ForecastService, TOTAL_GROUP
+from shared_state import file_lock
+
+
+def forecast_frame():
+    return pd.DataFrame({'ds': pd.date_range('2023-01-01', periods=3), 'yhat': [1.0, 2.0, 3.0], 'y': [1.0, 2.0, None]})
+
+
+def test_workers_fit_each_version_once(tmp_path):
+    # Two services on one directory stand for two API workers.
+    services = [ForecastService(directory=str(tmp_path)) for _ in range(2)]
+    fits = []
+
+    def counting_fit(service):
+        async def fit(scope, version, load_series):
+            fits.append(version)
+            await asyncio.sleep(0.2)
+            frames = {TOTAL_GROUP: forecast_frame()}
+            service.save(scope, version, {TOTAL_GROUP: '{}'}, frames)
+            return frames
+        return fit
+
+    for service in services:
+        service.fit = counting_fit(service)
+
+    async def scenario():
+        return await asyncio.gather(*[service.get(TOTAL_GROUP, 1, None) for service in services])
+
+    results = asyncio.run(scenario())
+    assert fits == [1]
+    for frames, stale in results:
+        assert not stale
+        pd.testing.assert_frame_equal(frames[TOTAL_GROUP], forecast_frame())
+
+
+def test_waiting_for_another_fit_leaves_the_executor_free(tmp_path, monkeypatch):
+    # A single run_sync thread: a blocking wait on the lock would take it.
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr('database._executor', executor)
+    service = ForecastService(directory=str(tmp_path), lock_poll_seconds=0.01)
+
+    async def fit(scope, version, load_series):
+        frames = {TOTAL_GROUP: forecast_frame()}
+        service.save(scope, version, {TOTAL_GROUP: '{}'}, frames)
+        return frames
+
+    service.fit = fit
+
+    async def scenario():
+        # Another API worker is fitting this scope.
+        with file_lock(str(tmp_path / TOTAL_GROUP / "train.lock")):
+            task = asyncio.ensure_future(service.train(TOTAL_GROUP, 1, None))
+            await asyncio.sleep(0.05)
+            assert await asyncio.wait_for(run_sync(lambda: 'free'), 1) == 'free'
+            assert not task.done()
+        return await asyncio.wait_for(task, 5)
+
+    try:
+        frames = asyncio.run(scenario())
+    finally:
+        executor.shutdown()
+    pd.testing.assert_frame_equal(frames[TOTAL_GROUP], forecast_frame())
+
+
+def test_only_the_latest_versions_stay_on_disk(tmp_path):
+    service = ForecastService(directory=str(tmp_path), keep_versions=2)
+    frames = {TOTAL_GROUP: forecast_frame()}
+    for version in (1, 2, 3, 10):
+        service.save(TOTAL_GROUP, version, {TOTAL_GROUP: '{}'}, frames)
+        service.prune(TOTAL_GROUP, version)
+    (tmp_path / TOTAL_GROUP / "train.lock").touch()
+    service.prune(TOTAL_GROUP, 10)
+    assert sorted(path.name for path in (tmp_path / TOTAL_GROUP).iterdir()) == ["train.lock", "v10", "v3"]
+
+
+def test_failed_fit_is_not_retried_before_its_delay(tmp_path, monkeypatch):
+    service = ForecastService(directory=str(tmp_path), retry_seconds=60, retry_max_seconds=100)
+    fits = []
+
+    async def failing_fit(scope, version, load_series):
+        fits.append(version)
+        raise RuntimeError("Prophet failed")
+
+    service.fit = failing_fit
+    clock = [1000.0]
+    monkeypatch.setattr('forecast.time.monotonic', lambda: clock[0])
+
+    async def attempt(version):
+        try:
+            await service.get(TOTAL_GROUP, version, None)
+        except RuntimeError as e:
+            return str(e)
+
+    assert asyncio.run(attempt(1)) == "Prophet failed"
+    assert asyncio.run(attempt(1)) == "Prophet failed"
+    assert fits == [1]
+    clock[0] += 61
+    asyncio.run(attempt(1))
+    assert fits == [1, 1]
+    # The delay doubled to 120 s, capped at 100 s.
+    assert service.stats()['failed'][0]['retry_in'] == 100
+    clock[0] += 50
+    asyncio.run(attempt(1))
+    assert fits == [1, 1]
+    # A new data version is fitted at once and replaces the old failure.
+    asyncio.run(attempt(2))
+    assert fits == [1, 1, 2]
+    assert [failure['data_version'] for failure in service.stats()['failed']] == [2]
+
+
+def test_failed_fit_keeps_serving_the_previous_forecast(tmp_path):
+    service = ForecastService(directory=str(tmp_path))
+
+    async def failing_fit(scope, version, load_series):
+        raise RuntimeError("Prophet failed")
+
+    service.fit = failing_fit
+    service.results[TOTAL_GROUP] = (1, {TOTAL_GROUP: forecast_frame()})
+
+    async def scenario():
+        frames, stale = await service.get(TOTAL_GROUP, 2, None)
+        await asyncio.gather(*service.jobs.values(), return_exceptions=True)
+        return stale, await service.get(TOTAL_GROUP, 2, None)
+
+    stale, (frames, stale_again) = asyncio.run(scenario())
+    assert stale and stale_again
+    assert service.failure(TOTAL_GROUP, 2) is not None
@@ -0,0 +1,145 @@
+import asyncio
+
+import pandas as pd
+from bson import Timestamp
+from pymongo.errors import OperationFailure
+
+import live
+from live import LiveFeed
+
+
+class StandaloneChangeStream:
+    # watch() on a standalone mongod: the $changeStream aggregate fails.
+    name = 'changestream'
+
+    def __init__(self):
+        self.closed = False
+
+    def open(self, start_at=None):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    def next_batch(self, high_water):
+        raise AssertionError("never opened")
+
+    def close(self):
+        self.closed = True
+
+
+class EmptyPolling:
+    name = 'poll'
+
+    def open(self, start_at=None):
+        pass
+
+    def next_batch(self, high_water):
+        return []
+
+    def close(self):
+        pass
+
+
+def test_auto_falls_back_to_polling_when_open_fails(monkeypatch):
+    monkeypatch.setattr(live, 'PollingSource', EmptyPolling)
+    monkeypatch.setattr(live, 'get_start', lambda: (42, None))
+
+    async def snapshot():
+        return {'total-sales': {'_id': None, 'total_sales': 10.0}, 'sales-by-region': [
+            {'_id': 'East', 'total_sales': 10.0}
+        ]}
+
+    async def load_tables(version):
+        return {}
+
+    async def current_version():
+        return 3
+
+    async def scenario():
+        stream = StandaloneChangeStream()
+        feed = LiveFeed(snapshot, load_tables, current_version, mode='auto', poll_seconds=0.01)
+        feed.source = stream
+        queue = feed.subscribe()
+        try:
+            message = await asyncio.wait_for(queue.get(), 5)
+        finally:
+            feed.unsubscribe(queue)
+            feed.close()
+        return feed, stream, message
+
+    feed, stream, message = asyncio.run(scenario())
+    assert message.startswith(b"id: ") and b"event: snapshot" in message
+    assert b'"high_water":42' in message
+    assert stream.closed
+    assert feed.source.name == 'poll'
+
+
+def test_changestream_mode_does_not_fall_back():
+    feed = LiveFeed(None, None, None, mode='changestream')
+    feed.source = StandaloneChangeStream()
+    assert not feed.fall_back(OperationFailure("no replica set", code=40573))
+    assert feed.source.name == 'changestream'
+
+
+class RecordingChangeStream:
+    name = 'changestream'
+
+    def __init__(self):
+        self.opened_at = []
+
+    def open(self, start_at=None):
+        self.opened_at.append(start_at)
+
+    def next_batch(self, high_water):
+        return []
+
+    def close(self):
+        pass
+
+
+TABLES = {
+    'Customers': pd.DataFrame({'Customer ID': ['C1']}),
+    'Products': pd.DataFrame({'Product ID': ['P1'], 'Category': ['Furniture']}),
+    'Location': pd.DataFrame({'Postal Code': [1], 'Region': ['East'], 'State': ['Ohio']})
+}
+
+
+def order(row_id, sales):
+    return {'Row ID': row_id, 'Customer ID': 'C1', 'Product ID': 'P1', 'Postal Code': 1, 'Sales': sales, 'Profit': 1.0}
+
+
+def run_feed(monkeypatch, source, start, batches_to_apply):
+    monkeypatch.setattr(live, 'get_start', lambda: start)
+
+    async def snapshot():
+        return {'total-sales': {'_id': None, 'total_sales': 100.0}}
+
+    async def load_tables(version):
+        return TABLES
+
+    async def current_version():
+        return 7
+
+    async def scenario():
+        feed = LiveFeed(snapshot, load_tables, current_version, mode='changestream')
+        feed.source = source
+        await feed.refresh(7)
+        for documents in batches_to_apply:
+            await feed.apply(documents)
+        return feed
+
+    return asyncio.run(scenario())
+
+
+def test_change_stream_starts_at_the_version_and_keeps_low_row_ids(monkeypatch):
+    bumped_at = Timestamp(1700000000, 3)
+    stream = RecordingChangeStream()
+    # A reloaded file inserts Row IDs below the high water mark of the version.
+    feed = run_feed(monkeypatch, stream, (500, bumped_at), [[order(12, 5.0)], [order(13, 2.0)]])
+    assert stream.opened_at == [bumped_at]
+    assert feed.high_water == 500
+    assert feed.values['total-sales'] == {None: 107.0}
+
+
+def test_polling_skips_rows_of_the_version(monkeypatch):
+    feed = run_feed(monkeypatch, EmptyPolling(), (500, None), [[order(499, 5.0), order(501, 2.0)], [order(501, 2.0)]])
+    assert feed.high_water == 501
+    assert feed.values['total-sales'] == {None: 102.0}
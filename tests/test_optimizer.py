@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+import pytest
+
+from backends import ArrowBackend
+from dimensions import join_locally
+from optimizer import find_unique_lookups, get_check_pipelines, optimize_pipeline, results_match, split_pipeline
+from pipelines import (
+    SOURCE_COLLECTIONS, SOURCE_ORDERS, SOURCE_ROLLUP, get_source_pipeline, get_sales_by_category_pipeline
+)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+CHECK_PIPELINES = get_check_pipelines()
+
+
+@pytest.fixture(scope='module')
+def arrow(tmp_path_factory):
+    backend = ArrowBackend(data_dir=DATA_DIR, cache_dir=str(tmp_path_factory.mktemp('parquet')))
+    backend.load()
+    return backend
+
+
+@pytest.fixture(scope='module')
+def unique_lookups(arrow):
+    async def aggregate(collection, pipeline):
+        return arrow.run(collection, pipeline)
+
+    def find(source):
+        lookups = [stage['$lookup'] for stage in get_source_pipeline(source) if '$lookup' in stage]
+        return asyncio.run(find_unique_lookups(aggregate, SOURCE_COLLECTIONS[source], lookups))
+
+    return {source: find(source) for source in (SOURCE_ORDERS, SOURCE_ROLLUP)}
+
+
+def test_unique_lookups_on_the_sample_data(unique_lookups):
+    # Product ID and postal code 92024 are duplicated in their tables.
+    assert unique_lookups == {SOURCE_ORDERS: ['customer_details'], SOURCE_ROLLUP: []}
+
+
+@pytest.mark.parametrize('source', [SOURCE_ORDERS, SOURCE_ROLLUP])
+@pytest.mark.parametrize('name', list(CHECK_PIPELINES))
+def test_rewritten_kpis_match_the_original(arrow, unique_lookups, source, name):
+    # The test mode of optimizer.py: each KPI as written, rewritten on the
+    # server and rewritten with the joins done in process.
+    collection = SOURCE_COLLECTIONS[source]
+    pipeline = CHECK_PIPELINES[name](source=source)
+    split = split_pipeline(pipeline, unique_lookups[source])
+    assert split is not None, "every KPI of the test mode is rewritten"
+    expected = arrow.run(collection, pipeline)
+    assert results_match(expected, arrow.run(collection, split[0] + split[1]))
+    assert results_match(expected, join_locally(arrow.run(collection, split[0]), split[1], arrow.tables))
+
+
+def test_unused_unique_join_is_dropped():
+    pipeline = get_sales_by_category_pipeline(source=SOURCE_ORDERS)
+    rewritten = optimize_pipeline(pipeline, ['customer_details'])
+    joined = [stage['$lookup']['as'] for stage in rewritten if '$lookup' in stage]
+    assert joined == ['product_details', 'location_details']
+    assert optimize_pipeline(pipeline) != pipeline
+    assert 'customer_details' in [stage['$lookup']['as'] for stage in optimize_pipeline(pipeline) if '$lookup' in stage]
+
+
+@pytest.mark.parametrize('pipeline', [
+    [{'$group': {'_id': '$Region', 'total': {'$sum': '$Sales'}}}],
+    get_sales_by_category_pipeline(source=SOURCE_ORDERS)[:-2],
+    get_source_pipeline(SOURCE_ROLLUP) + [
+        {'$group': {'_id': '$product_details.Category', 'first': {'$first': '$Sales'}}}
+    ],
+    get_source_pipeline(SOURCE_ROLLUP) + [
+        {'$group': {'_id': '$product_details.Category', 'sales': {'$sum': '$location_details.Sales'}}}
+    ]
+], ids=['no-join', 'no-group', 'order-dependent', 'joined-accumulator'])
+def test_unsupported_shapes_are_left_unchanged(pipeline):
+    assert split_pipeline(pipeline) is None
+    assert optimize_pipeline(pipeline) is pipeline
@@ -0,0 +1,97 @@
+import asyncio
+
+import httpx
+import pandas as pd
+import pytest
+from fastapi import HTTPException
+
+import main
+
+from columnar import evaluate
+from pagination import decode_cursor, encode_cursor, split_page
+from pipelines import get_paginated_pipeline
+
+SALES_KEYS = [('total_sales', -1), ('_id', 1)]
+MATRIX_KEYS = [('total_sales', -1), ('_id.product', 1), ('_id.region', 1)]
+
+
+def read_all_pages(frame, pipeline, keys, limit):
+    pages = []
+    after = None
+    while True:
+        rows = evaluate(frame, get_paginated_pipeline(pipeline, keys, decode_cursor(after), limit), {})
+        rows, after = split_page(rows, keys, limit)
+        pages.append(rows)
+        if after is None:
+            return pages
+
+
+@pytest.mark.parametrize('values', [
+    [125.5, 'Paper'],
+    [0, 'a/b+c=d'],
+    [None, 'Chairs', 3],
+    ['Épée', -1.25, 'Été']
+])
+def test_cursor_round_trip(values):
+    token = encode_cursor(values)
+    assert '=' not in token and '/' not in token and '+' not in token
+    assert decode_cursor(token) == values
+
+
+@pytest.mark.parametrize('token', ['not a cursor!', encode_cursor({'after': 1})[:-2], encode_cursor({'a': 1})])
+def test_invalid_cursor_is_a_bad_request(token):
+    with pytest.raises(HTTPException) as error:
+        decode_cursor(token)
+    assert error.value.status_code == 400
+
+
+def test_pages_break_ties_on_the_unique_key():
+    # Many products share a total: the _id decides their order.
+    frame = pd.DataFrame({
+        '_id': [f"P{i:02d}" for i in range(23)][::-1],
+        'total_sales': [100.0] * 9 + [50.0] * 8 + [75.0, 75.0, 10.0, 10.0, 10.0, 5.0]
+    })
+    pipeline = [{'$sort': {'total_sales': -1}}]
+    expected = evaluate(frame, get_paginated_pipeline(pipeline, SALES_KEYS), {})
+
+    for limit in (1, 3, 4, 9, 23, 50):
+        pages = read_all_pages(frame, pipeline, SALES_KEYS, limit)
+        rows = [row for page in pages for row in page]
+        assert rows == expected
+        assert all(len(page) == limit for page in pages[:-1])
+        assert len(pages) == max(1, -(-len(frame) // limit))
+
+
+def test_pages_follow_nested_keys():
+    frame = pd.DataFrame({
+        '_id.product': ['Chair', 'Chair', 'Desk', 'Desk', 'Lamp', 'Chair', 'Lamp'],
+        '_id.region': ['West', 'East', 'East', 'West', 'East', 'Central', 'West'],
+        'total_sales': [10.0, 10.0, 10.0, 7.0, 7.0, 10.0, 2.0]
+    })
+    pipeline = [{'$sort': {'total_sales': -1}}]
+    rows = [row for page in read_all_pages(frame, pipeline, MATRIX_KEYS, 2) for row in page]
+    assert [(row['_id']['product'], row['_id']['region'], row['total_sales']) for row in rows] == [
+        ('Chair', 'Central', 10.0), ('Chair', 'East', 10.0), ('Chair', 'West', 10.0), ('Desk', 'East', 10.0),
+        ('Desk', 'West', 7.0), ('Lamp', 'East', 7.0), ('Lamp', 'West', 2.0)
+    ]
+
+
+def test_last_page_has_no_cursor():
+    rows = [{'_id': 'a', 'total_sales': 3.0}, {'_id': 'b', 'total_sales': 2.0}]
+    assert split_page(rows, SALES_KEYS, 2) == (rows, None)
+    page, cursor = split_page(rows + [{'_id': 'c', 'total_sales': 1.0}], SALES_KEYS, 2)
+    assert page == rows and decode_cursor(cursor) == [2.0, 'b']
+
+
+@pytest.mark.parametrize('path', [
+    '/kpi/top-categories', '/kpi/top-products-by-quantity', '/kpi/top-profitable-products', '/kpi/bundle',
+    '/kpi/sales-by-product'
+])
+@pytest.mark.parametrize('limit', [0, -1])
+def test_non_positive_limits_are_client_errors(path, limit):
+    # Rejected before any query runs, with either backend.
+    async def fetch():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(path, params={'limit': limit, 'page': 'produits'})
+    assert asyncio.run(fetch()).status_code == 422
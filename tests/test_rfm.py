@@ -0,0 +1,39 @@
+from datetime import datetime
+
+import rfm
+
+
+def customer(customer_id, last_purchase, total_sales=100.0, frequency=2):
+    return {'_id': customer_id, 'last_purchase': last_purchase, 'total_sales': total_sales, 'frequency': frequency}
+
+
+def test_recency_counts_days_to_the_last_order_date(monkeypatch):
+    monkeypatch.setattr(rfm, 'RFM_REFERENCE_DATE', None)
+    orders = [customer('A', datetime(2023, 12, 30)), customer('B', datetime(2023, 12, 20))]
+    frame = rfm.build_rfm_frame(orders)
+    assert frame.set_index('Customer ID')['Recency'].to_dict() == {'A': 0, 'B': 10}
+    assert rfm.get_reference_date(frame) == datetime(2023, 12, 30)
+
+
+def test_reference_date_setting_overrides_the_data(monkeypatch):
+    monkeypatch.setattr(rfm, 'RFM_REFERENCE_DATE', '2024-01-09')
+    frame = rfm.build_rfm_frame([customer('A', datetime(2023, 12, 30))])
+    assert frame['Recency'].tolist() == [10]
+
+
+def test_elbow_fits_outside_the_lock(monkeypatch):
+    orders = [customer(f'C{i}', datetime(2023, 1, 1 + i), 10.0 * i, i) for i in range(1, 11)]
+    matrix = rfm.RFMMatrix(n_jobs=1)
+    matrix.update(1, orders)
+    fitted = []
+
+    def fit_inertia(values, k, minibatch=False):
+        # Another request or a refresh can take the lock meanwhile.
+        assert not matrix.lock.locked()
+        fitted.append(k)
+        return k, float(10 - k)
+
+    monkeypatch.setattr(rfm, 'fit_inertia', fit_inertia)
+    assert matrix.elbow(3) == [9.0, 8.0, 7.0]
+    assert matrix.elbow(4) == [9.0, 8.0, 7.0, 6.0]
+    assert fitted == [1, 2, 3, 4]
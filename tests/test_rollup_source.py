@@ -0,0 +1,51 @@
+import asyncio
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import main
+from backends import ArrowBackend
+from instrumentation import InstrumentedBackend, QueryStats
+from ingest import TABLES, detect_delimiter
+from optimizer import results_match
+from pipelines import (
+    SOURCE_COLLECTIONS, SOURCE_ORDERS, SOURCE_ROLLUP, get_sales_by_region_pipeline, get_sales_by_category_pipeline
+)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+def serve(monkeypatch, tmp_path, drop_customers=0):
+    # The API over a copy of the sample CSVs, without the first customers.
+    data_dir = tmp_path / 'data'
+    shutil.copytree(DATA_DIR, data_dir, ignore=shutil.ignore_patterns('parquet'))
+    if drop_customers:
+        path = str(data_dir / TABLES['Customers']['file'])
+        separator = detect_delimiter(path)
+        customers = pd.read_csv(path, sep=separator, dtype=str)
+        customers.iloc[drop_customers:].to_csv(path, sep=separator, index=False)
+    arrow = ArrowBackend(data_dir=str(data_dir), cache_dir=str(tmp_path / 'parquet'))
+    arrow.load()
+    monkeypatch.setattr(main, 'backend', InstrumentedBackend(arrow, QueryStats()))
+    monkeypatch.setattr(main.data_version, 'loader', arrow.data_version)
+    monkeypatch.setattr(main.data_version, 'version', None)
+    main.kpi_cache.invalidate()
+    return arrow
+
+
+@pytest.mark.parametrize('drop_customers', [0, 5])
+def test_rollup_kpis_match_orders(monkeypatch, tmp_path, drop_customers):
+    arrow = serve(monkeypatch, tmp_path, drop_customers)
+    source = asyncio.run(main.get_kpi_source(SOURCE_ROLLUP))
+    assert source == (SOURCE_ORDERS if drop_customers else SOURCE_ROLLUP)
+    for pipeline_fn in (get_sales_by_region_pipeline, get_sales_by_category_pipeline):
+        served = asyncio.run(main.run_kpi(pipeline_fn))
+        expected = arrow.run(SOURCE_COLLECTIONS[SOURCE_ORDERS], pipeline_fn(source=SOURCE_ORDERS))
+        assert results_match(expected, served)
+    if drop_customers:
+        # The rollup alone would still count the orders of the missing customers.
+        orders = arrow.run(SOURCE_COLLECTIONS[SOURCE_ORDERS], get_sales_by_region_pipeline(source=SOURCE_ORDERS))
+        rollup = arrow.run(SOURCE_COLLECTIONS[SOURCE_ROLLUP], get_sales_by_region_pipeline(source=SOURCE_ROLLUP))
+        assert not results_match(orders, rollup)
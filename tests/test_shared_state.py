@@ -0,0 +1,48 @@
+import os
+import stat
+
+import pandas as pd
+import pytest
+
+from shared_state import SharedState
+
+
+def test_values_round_trip_per_version(tmp_path):
+    state = SharedState(str(tmp_path / 'state'))
+    frame = pd.DataFrame({'Region': ['East', 'West'], 'Sales': [1.5, 2.5]})
+    assert state.set('kpi', 1, ('sales-by-region',), [{'_id': 'East', 'total_sales': 1.5}])
+    assert state.set('dimensions', 1, 'Location', frame)
+    assert state.get('kpi', 1, ('sales-by-region',)) == (True, [{'_id': 'East', 'total_sales': 1.5}])
+    found, loaded = state.get('dimensions', 1, 'Location')
+    assert found and loaded.equals(frame)
+    assert state.get('kpi', 2, ('sales-by-region',)) == (False, None)
+
+
+def test_directory_is_private(tmp_path):
+    SharedState(str(tmp_path / 'state'))
+    assert stat.S_IMODE(os.stat(tmp_path / 'state').st_mode) == 0o700
+
+
+def test_refuses_a_directory_others_can_write(tmp_path):
+    directory = tmp_path / 'state'
+    directory.mkdir()
+    directory.chmod(0o777)
+    with pytest.raises(PermissionError):
+        SharedState(str(directory))
+
+
+def test_refuses_a_parent_others_can_write(tmp_path):
+    parent = tmp_path / 'planted'
+    parent.mkdir()
+    parent.chmod(0o777)
+    with pytest.raises(PermissionError):
+        SharedState(str(parent / 'arrow'))
+
+
+@pytest.mark.skipif(not hasattr(os, 'geteuid') or os.geteuid() != 0, reason="chown needs root")
+def test_refuses_a_directory_owned_by_another_user(tmp_path):
+    directory = tmp_path / 'state'
+    directory.mkdir(mode=0o700)
+    os.chown(directory, 12345, 12345)
+    with pytest.raises(PermissionError):
+        SharedState(str(directory))
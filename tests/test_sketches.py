@@ -0,0 +1,139 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sketches import (
+    ALL, HyperLogLog, TDigest, SketchStore, build_sketch_documents, encode_grouped_digests, hash_values,
+    index_documents, register_ranks
+)
+
+PRECISION = 12
+COMPRESSION = 200
+
+
+def hyperloglog(values, precision=PRECISION):
+    sketch = HyperLogLog(precision)
+    index, rank = register_ranks(hash_values(values), precision)
+    np.maximum.at(sketch.registers, index, rank)
+    return sketch
+
+
+def tdigest(values, compression=COMPRESSION):
+    values = np.asarray(values, dtype=float)
+    blob = encode_grouped_digests(np.zeros(len(values), dtype=np.int64), 1, values, compression)[0]
+    return TDigest.from_bytes(blob)
+
+
+def order_ids(start, stop):
+    return [f"CA-{i:07d}" for i in range(start, stop)]
+
+
+@pytest.mark.parametrize('count', [10, 1000, 20000, 200000])
+def test_hyperloglog_within_error_bound(count):
+    sketch = hyperloglog(order_ids(0, count))
+    # Four standard errors: the hashes are deterministic, this never flakes.
+    assert abs(sketch.estimate() - count) <= 4 * sketch.relative_error() * count + 1
+
+
+def test_hyperloglog_ignores_duplicates():
+    values = order_ids(0, 5000)
+    assert hyperloglog(values * 3).estimate() == hyperloglog(values).estimate()
+
+
+@pytest.mark.parametrize('count', [50, 50000])
+def test_hyperloglog_bytes_round_trip(count):
+    # Sparse then dense encodings.
+    sketch = hyperloglog(order_ids(0, count))
+    decoded = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert decoded.precision == PRECISION
+    assert np.array_equal(decoded.registers, sketch.registers)
+
+
+def test_hyperloglog_merge_is_associative_and_exact():
+    a, b, c = (order_ids(start, start + 30000) for start in (0, 20000, 40000))
+
+    def merged(x, y):
+        return HyperLogLog(PRECISION, x.registers.copy()).merge(y)
+
+    left = merged(merged(hyperloglog(a), hyperloglog(b)), hyperloglog(c))
+    right = merged(hyperloglog(a), merged(hyperloglog(b), hyperloglog(c)))
+    union = hyperloglog(a + b + c)
+    assert np.array_equal(left.registers, right.registers)
+    assert np.array_equal(left.registers, union.registers)
+
+
+def test_hyperloglog_refuses_other_precisions():
+    with pytest.raises(ValueError):
+        hyperloglog(['a']).merge(hyperloglog(['a'], precision=10))
+
+
+def empirical_rank(values, estimate):
+    return np.searchsorted(np.sort(values), estimate, side='right') / len(values)
+
+
+@pytest.mark.parametrize('q', [0.01, 0.25, 0.5, 0.75, 0.9, 0.99])
+def test_tdigest_quantiles_within_rank_error(q):
+    values = np.random.default_rng(7).lognormal(4, 1, 100000)
+    digest = tdigest(values)
+    estimate = digest.quantile(q)
+    assert abs(empirical_rank(values, estimate) - q) <= digest.rank_error(q) + 0.002
+    assert digest.count == len(values)
+    assert digest.total == pytest.approx(values.sum())
+    assert (digest.minimum, digest.maximum) == (values.min(), values.max())
+
+
+def test_tdigest_merge_is_associative():
+    rng = np.random.default_rng(11)
+    parts = [rng.lognormal(4, 1, 20000), rng.normal(300, 40, 20000), rng.exponential(80, 20000)]
+    values = np.concatenate(parts)
+    a, b, c = (tdigest(part) for part in parts)
+    left = TDigest.merge_all([TDigest.merge_all([a, b]), c])
+    right = TDigest.merge_all([a, TDigest.merge_all([b, c])])
+    for digest in (left, right):
+        assert digest.count == len(values)
+        assert digest.total == pytest.approx(values.sum())
+        assert (digest.minimum, digest.maximum) == (values.min(), values.max())
+    for q in (0.05, 0.5, 0.95):
+        # Merge order only moves an estimate within the rank error.
+        assert abs(empirical_rank(values, left.quantile(q)) - empirical_rank(values, right.quantile(q))) \
+            <= left.rank_error(q) + right.rank_error(q) + 0.002
+        assert abs(empirical_rank(values, left.quantile(q)) - q) <= left.rank_error(q) + 0.002
+
+
+def test_tdigest_bytes_round_trip():
+    digest = tdigest(np.arange(1000.0))
+    decoded = TDigest.from_bytes(digest.to_bytes())
+    assert np.array_equal(decoded.means, digest.means) and np.array_equal(decoded.weights, digest.weights)
+    assert decoded.quantile(0.5) == digest.quantile(0.5)
+
+
+def test_daily_sketches_merge_to_the_exact_totals():
+    rng = np.random.default_rng(3)
+    lines = 6000
+    frame = pd.DataFrame({
+        'order_ref': np.arange(lines),
+        'Order Date': pd.to_datetime('2023-01-01') + pd.to_timedelta(rng.integers(0, 60, lines), unit='D'),
+        'Order ID': [f"O-{i}" for i in rng.integers(0, 2500, lines)],
+        'Customer ID': [f"C-{i}" for i in rng.integers(0, 800, lines)],
+        'Sales': rng.lognormal(4, 1, lines),
+        'location_details.Region': rng.choice(['East', 'West', 'Central', 'South'], lines),
+        'location_details.State': rng.choice(['Texas', 'Ohio'], lines),
+        'product_details.Category': rng.choice(['Furniture', 'Technology'], lines)
+    })
+    store = SketchStore()
+    store.index = index_documents(build_sketch_documents(frame, PRECISION, COMPRESSION))
+
+    start, end = datetime(2023, 1, 10), datetime(2023, 2, 10)
+    window = frame[(frame['Order Date'] >= start) & (frame['Order Date'] < end)]
+    merged = store.query(ALL, start, end)[ALL]
+    assert merged.lines == len(window)
+    assert merged.total_sales == pytest.approx(window['Sales'].sum())
+    for sketch, exact in ((merged.orders, window['Order ID'].nunique()),
+                          (merged.customers, window['Customer ID'].nunique())):
+        assert abs(sketch.estimate() - exact) <= 4 * sketch.relative_error() * exact
+
+    by_region = store.query('region', start, end)
+    assert sorted(by_region) == sorted(window['location_details.Region'].unique())
+    assert sum(sketches.lines for sketches in by_region.values()) == len(window)
@@ -0,0 +1,81 @@
+import time
+
+from pymongo import DESCENDING, ReturnDocument
+
+from config import DATA_VERSION_CHECK_SECONDS
+from database import get_db, run_sync
+
+META_COLLECTION = 'Meta'
+DATA_VERSION_ID = 'data_version'
+ORDERS_COLLECTION = 'Orders'
+
+
+def get_data_version(db):
+    doc = db[META_COLLECTION].find_one({'_id': DATA_VERSION_ID})
+    return doc['version'] if doc else 0
+
+
+def get_data_state(db):
+    # The Meta document of the current version, or {} before the first bump.
+    return db[META_COLLECTION].find_one({'_id': DATA_VERSION_ID}) or {}
+
+
+def get_orders_high_water(db):
+    doc = db[ORDERS_COLLECTION].find_one({}, {'Row ID': 1}, sort=[('Row ID', DESCENDING)])
+    return doc['Row ID'] if doc else 0
+
+
+def bump_data_version(db):
+    # Also records where the orders of the new version end, for the live
+    # feed: the highest Row ID and, on a replica set, the cluster time of
+    # the bump to start its change stream at.
+    high_water = get_orders_high_water(db)
+    with db.client.start_session() as session:
+        doc = db[META_COLLECTION].find_one_and_update(
+            {'_id': DATA_VERSION_ID},
+            {
+                '$inc': {'version': 1},
+                '$set': {'orders_high_water': high_water},
+                '$unset': {'operation_time': ''},
+                '$currentDate': {'updated_at': True}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if session.operation_time is not None:
+            db[META_COLLECTION].update_one(
+                {'_id': DATA_VERSION_ID, 'version': doc['version']},
+                {'$set': {'operation_time': session.operation_time}},
+                session=session
+            )
+    data_version.set(doc['version'])
+    return doc['version']
+
+
+class DataVersion:
+    # Ingest may run in another process, so the stored version is re-read
+    # at most every `check_seconds` instead of on every request.
+
+    def __init__(self, check_seconds=DATA_VERSION_CHECK_SECONDS, loader=None):
+        self.check_seconds = check_seconds
+        self.loader = loader
+        self.version = None
+        self.checked_at = 0.0
+
+    def load(self):
+        if self.loader is not None:
+            return self.loader()
+        return get_data_version(get_db())
+
+    def set(self, version):
+        self.version = version
+        self.checked_at = time.monotonic()
+
+    async def current(self):
+        if self.version is None or time.monotonic() - self.checked_at > self.check_seconds:
+            self.set(await run_sync(self.load))
+        return self.version
+
+
+data_version = DataVersion()